@@ -0,0 +1,368 @@
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+import struct
+import sys
+import zlib
+from ATLogging import BinaryLogFormat, BinaryLogReader, LogEntry, TextLogFormat
+from ATReading import ATResult
+
+
+class SessionAnalysis:
+    """Statistics of one session of the log, built one AT at a time in bounded memory."""
+    ROLLING_WINDOW = 100
+    ROLLING_STEP = 10  # ATs between the window's green rates in the report
+    NORMALISED_BUCKET = .01  # of the AT width
+
+    def __init__(self, version=None, date=None, pixel_width=None):
+        self.version = version
+        self.date = date
+        self.pixel_width = pixel_width
+        self.results = [0, 0, 0]  # per ATResult
+        self.rolling = deque()  # whether each of the last ROLLING_WINDOW ATs was green
+        self.rolling_greens = 0
+        self.rolling_green_rates = []  # of the last ROLLING_WINDOW ATs, every ROLLING_STEP ATs
+        self.early = 0
+        self.late = 0
+        self.timing_offsets = Counter()  # last bar position – green position: count
+        self.white_offsets = Counter()  # the same for whites, normalised by the AT width
+        self.cps_total = 0.
+        self.cps_count = 0
+        self.press_offset_total = 0.  # absolute ms, from the bar motion
+        self.press_uncertainty_total = 0.
+        self.press_count = 0
+
+    @property
+    def total_ats(self):
+        return sum(self.results)
+
+    def add_action_test(self, action_test):
+        self.results[action_test.result] += 1
+        is_green = action_test.result == ATResult.GREEN
+        self.rolling.append(is_green)
+        self.rolling_greens += is_green
+        if len(self.rolling) > self.ROLLING_WINDOW:
+            self.rolling_greens -= self.rolling.popleft()
+        if len(self.rolling) == self.ROLLING_WINDOW and self.total_ats % self.ROLLING_STEP == 0:
+            self.rolling_green_rates.append(self.rolling_greens / self.ROLLING_WINDOW)
+        if action_test.captures_per_second is not None:
+            self.cps_total += action_test.captures_per_second
+            self.cps_count += 1
+        if action_test.bar_positions and action_test.green_position is not None:
+            self.add_timing(action_test, action_test.bar_positions[-1] - action_test.green_position)
+        if action_test.press_offset is not None:
+            self.press_offset_total += abs(action_test.press_offset)
+            self.press_uncertainty_total += action_test.press_uncertainty
+            self.press_count += 1
+
+    def add_timing(self, action_test, offset):
+        self.timing_offsets[offset] += 1
+        if action_test.result != ATResult.GREEN:
+            if offset > 0:
+                self.late += 1
+            else:
+                self.early += 1
+        if action_test.result == ATResult.WHITE and self.pixel_width:
+            bucket = round(offset / self.pixel_width / self.NORMALISED_BUCKET)
+            self.white_offsets[bucket] += 1
+
+    def get_report(self):
+        total = self.total_ats
+        return {"version": self.version, "date": self.date, "pixel_width": self.pixel_width,
+                "action_tests": total,
+                "results": dict(zip(ATResult.names, self.results)),
+                "green_rate": self.results[ATResult.GREEN] / total if total else None,
+                "rolling_green_rates": self.rolling_green_rates,
+                "early": self.early, "late": self.late,
+                "timing_offsets": dict(sorted(self.timing_offsets.items())),
+                "white_offsets_normalised": {round(bucket * self.NORMALISED_BUCKET, 2): count
+                                             for bucket, count in sorted(self.white_offsets.items())},
+                "mean_captures_per_second": self.cps_total / self.cps_count if self.cps_count else None,
+                "mean_press_offset_ms": self.press_offset_total / self.press_count if self.press_count else None,
+                "mean_press_uncertainty_ms":
+                    self.press_uncertainty_total / self.press_count if self.press_count else None}
+
+
+class LogAnalyser:
+    """Streams through a text or binary AT log, session by session.
+
+    Sessions can be analysed in parallel – every process only reads its own part of the file."""
+    SESSION_MARKER = b"---New Session"
+    CHUNK_SIZE = 1 << 20
+    CHUNKS_PER_PROCESS = 4  # sessions get split into this many chunks per process, for an even load
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        with open(filepath, "rb") as file:
+            self.is_binary = file.read(len(BinaryLogFormat.MAGIC)) == BinaryLogFormat.MAGIC
+
+    def find_session_offsets(self):
+        if self.is_binary:
+            reader = BinaryLogReader(self.filepath)
+            offsets = reader.get_session_offsets()
+            reader.close()
+            return offsets or [len(BinaryLogFormat.MAGIC)]
+        offsets = [0]  # ATs before the first header still count
+        position = 0
+        carry = b""
+        with open(self.filepath, "rb") as file:
+            while True:
+                chunk = file.read(self.CHUNK_SIZE)
+                if not chunk:
+                    break
+                data = carry + chunk
+                start = 0
+                while True:
+                    found = data.find(self.SESSION_MARKER, start)
+                    if found == -1:
+                        break
+                    if found == 0 and position - len(carry) == 0 or data[found - 1:found] == b"\n":
+                        offsets.append(position - len(carry) + found)
+                    start = found + 1
+                carry = data[-len(self.SESSION_MARKER) - 1:]
+                position += len(chunk)
+        return sorted(set(offsets))
+
+    def get_session_ranges(self):
+        offsets = self.find_session_offsets()
+        end = os.path.getsize(self.filepath)
+        return list(zip(offsets, offsets[1:] + [end]))
+
+    def analyse(self, processes=1):
+        ranges = self.get_session_ranges()
+        if processes == 1:
+            reports = [self.analyse_range(start, end) for start, end in ranges]
+        else:
+            # a few chunks of sessions per process, rather than sending every short session on its own
+            chunk_size = max(1, len(ranges) // (processes * self.CHUNKS_PER_PROCESS))
+            with ProcessPoolExecutor(processes) as pool:
+                reports = list(pool.map(analyse_range, [self.filepath] * len(ranges), ranges, chunksize=chunk_size))
+        reports = [report for report in reports if report["action_tests"] or report["date"]]
+        return self.combine_reports(reports)
+
+    def analyse_range(self, start, end):
+        analysis = SessionAnalysis()
+        for kind, data in self.read_range(start, end):
+            if kind == LogEntry.SESSION:
+                version, date, pixel_width = data
+                analysis.version, analysis.date, analysis.pixel_width = version, date, pixel_width
+            elif kind == LogEntry.AT:
+                analysis.add_action_test(data[0])
+        return analysis.get_report()
+
+    def read_range(self, start, end):
+        if self.is_binary:
+            reader = BinaryLogReader(self.filepath)
+            yield from reader.read_entries(start, stop_at_next_session=True)
+            reader.close()
+            return
+        with open(self.filepath, "rb") as file:
+            file.seek(start)
+            position = start
+            while position < end:
+                lines = file.readlines(self.CHUNK_SIZE)
+                if not lines:
+                    return
+                for line in lines:
+                    position += len(line)
+                    yield TextLogFormat.parse_line(line.decode(errors="replace"))
+                    if position >= end:
+                        return
+
+    @staticmethod
+    def combine_reports(session_reports):
+        results = Counter()
+        for report in session_reports:
+            results.update(report["results"])
+        total = sum(results.values())
+        return {"action_tests": total,
+                "results": dict(results),
+                "green_rate": results["green"] / total if total else None,
+                "green_rate_trend": [report["green_rate"] for report in session_reports],
+                "captures_per_second_trend": [report["mean_captures_per_second"] for report in session_reports],
+                "sessions": session_reports}
+
+
+class AllTimeMetric:
+    """One all-time statistic the LogIndexer keeps. Its state has to be JSON-serialisable."""
+    name = None
+
+    def get_initial_state(self):
+        return 0
+
+    def add_action_test(self, state, action_test):
+        return state
+
+    def start_session(self, state):
+        return state
+
+
+class TotalATs(AllTimeMetric):
+    name = "total_ats"
+
+    def add_action_test(self, state, action_test):
+        return state + 1
+
+
+class Greens(AllTimeMetric):
+    name = "greens"
+
+    def add_action_test(self, state, action_test):
+        return state + (action_test.result == ATResult.GREEN)
+
+
+class Chains(AllTimeMetric):
+    name = "chains"  # streaks of greens, which end with the session like in Practise
+
+    def get_initial_state(self):
+        return {"current": 0, "best": 0}
+
+    def add_action_test(self, state, action_test):
+        current = state["current"] + 1 if action_test.result == ATResult.GREEN else 0
+        return {"current": current, "best": max(state["best"], current)}
+
+    def start_session(self, state):
+        return {"current": 0, "best": state["best"]}
+
+
+class LogIndexer:
+    """Keeps all-time metrics of a log up to date by only reading what got appended since
+    the checkpoint (the byte offset read up to and every metric's state at that point).
+
+    A metric missing from the checkpoint gets replayed up to the checkpoint once. If the log
+    was replaced or shortened, everything is rebuilt from the start."""
+    METRICS = [TotalATs(), Greens(), Chains()]
+    FINGERPRINT_SIZE = 4096  # bytes at the start of the log that identify it
+
+    def __init__(self, log_filepath, checkpoint_filepath, metrics=None):
+        self.log_filepath = log_filepath
+        self.checkpoint_filepath = checkpoint_filepath
+        self.metrics = metrics or self.METRICS
+        self.offset = 0
+        self.fingerprint = None
+        self.states = {}
+        self.extra = {}  # other data kept in the checkpoint
+        self.had_checkpoint = self.load_checkpoint()
+
+    def load_checkpoint(self):
+        if not os.path.isfile(self.checkpoint_filepath):
+            return False
+        try:
+            with open(self.checkpoint_filepath, "r") as file:
+                checkpoint = json.load(file)
+            self.offset = checkpoint["offset"]
+            self.fingerprint = checkpoint["fingerprint"]
+            self.states = checkpoint["metrics"]
+            self.extra = checkpoint.get("extra", {})
+        except (ValueError, KeyError):
+            print(f"---Checkpoint {self.checkpoint_filepath} broken, rebuilding from the log.")
+            self.offset, self.fingerprint, self.states = 0, None, {}
+            return False
+        return True
+
+    def save_checkpoint(self):
+        checkpoint = {"offset": self.offset, "fingerprint": self.fingerprint,
+                      "metrics": self.states, "extra": self.extra}
+        temporary_filepath = self.checkpoint_filepath + ".tmp"
+        with open(temporary_filepath, "w") as file:
+            json.dump(checkpoint, file)
+        os.replace(temporary_filepath, self.checkpoint_filepath)
+
+    def get_state(self, metric_name):
+        return self.states[metric_name]
+
+    def update(self):
+        if not os.path.isfile(self.log_filepath):
+            self.reset_states(self.metrics)
+            return
+        log_size = os.path.getsize(self.log_filepath)
+        if log_size < self.offset or not self.is_same_log():
+            self.offset = 0
+            self.states = {}
+        missing_metrics = [metric for metric in self.metrics if metric.name not in self.states]
+        self.reset_states(missing_metrics)
+        if missing_metrics and self.offset > 0:
+            self.read_log(missing_metrics, 0, self.offset)
+        self.offset = self.read_log(self.metrics, self.offset, log_size)
+        self.fingerprint = self.get_fingerprint()
+
+    def reset_states(self, metrics):
+        for metric in metrics:
+            self.states[metric.name] = metric.get_initial_state()
+
+    def get_fingerprint(self, size=FINGERPRINT_SIZE):
+        with open(self.log_filepath, "rb") as file:
+            head = file.read(size)
+        return [len(head), zlib.crc32(head)]
+
+    def is_same_log(self):
+        if self.fingerprint is None:
+            return True
+        return self.get_fingerprint(self.fingerprint[0]) == self.fingerprint
+
+    def read_log(self, metrics, start, end):
+        """Applies the log's entries between start and end to the metrics. Returns the offset
+        after the last complete entry (a crash can leave a half-written one at the end)."""
+        for kind, data, offset in self.read_complete_entries(start, end):
+            if kind == LogEntry.SESSION:
+                for metric in metrics:
+                    self.states[metric.name] = metric.start_session(self.states[metric.name])
+            elif kind == LogEntry.AT:
+                for metric in metrics:
+                    self.states[metric.name] = metric.add_action_test(self.states[metric.name], data[0])
+            start = offset
+        return start
+
+    def read_complete_entries(self, start, end):
+        with open(self.log_filepath, "rb") as file:
+            is_binary = file.read(len(BinaryLogFormat.MAGIC)) == BinaryLogFormat.MAGIC
+            if is_binary:
+                yield from self.read_binary_entries(file, max(start, len(BinaryLogFormat.MAGIC)), end)
+                return
+            file.seek(start)
+            position = start
+            while position < end:
+                line = file.readline()
+                if not line.endswith(b"\n"):
+                    return  # unfinished
+                position += len(line)
+                kind, data = TextLogFormat.parse_line(line.decode(errors="replace"))
+                yield kind, data, position
+
+    @staticmethod
+    def read_binary_entries(file, start, end):
+        file.seek(start)
+        data = file.read(end - start)
+        offset = 0
+        while offset < len(data):
+            try:
+                kind, entry, next_offset = BinaryLogFormat.unpack_entry(data, offset)
+            except (struct.error, ValueError, IndexError):
+                return  # unfinished
+            if next_offset > len(data):
+                return
+            offset = next_offset
+            yield kind, entry, start + offset
+
+
+def analyse_range(filepath, session_range):  # for the process pool
+    return LogAnalyser(filepath).analyse_range(*session_range)
+
+
+def main():
+    # python ATAnalysing.py <log file> [processes] – writes <log file>.analysis.json
+    if len(sys.argv) < 2:
+        print("Usage: ATAnalysing.py <log file> [processes]")
+        return
+    filepath = sys.argv[1]
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    analysis = LogAnalyser(filepath).analyse(processes)
+    with open(filepath + ".analysis.json", "w") as file:
+        json.dump(analysis, file, indent=2)
+    print(f"{analysis['action_tests']} ATs in {len(analysis['sessions'])} sessions, "
+          f"green rate {analysis['green_rate']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+from collections import deque
+from mss.screenshot import ScreenShot
+import mmap
+import os
+import struct
+import sys
+import threading
+import zlib
+from ATCapturing import FrameRecording, FrameSource
+
+
+class FrameArchiveFormat:
+    """A magic header, then blocks of frames. A block is a BLOCK_HEADER followed by its frames
+    compressed with zlib – every frame a FRAME_HEADER and its raw BGRA bytes, XORed with the
+    frame of the same size before it in the block (so mostly zeros) unless it's the first,
+    or nothing at all if it's the same as that one. Blocks can be decompressed on their own.
+
+    The sidecar index has an INDEX_ENTRY per block, in order, for finding an AT's
+    or a frame's blocks with a binary search through the memory-mapped index."""
+    EXTENSION = ".atframes"
+    INDEX_EXTENSION = ".idx"
+    MAGIC = b"ATFRAR01"
+    BLOCK_HEADER = struct.Struct("<II")  # compressed size, frame count
+    FRAME_HEADER = struct.Struct("<qIHHB")  # perf_counter_ns timestamp, AT number, width, height, kind
+    # kinds of frames
+    KEY = 0
+    XORED = 1
+    REPEATED = 2
+    # block offset, number of its first frame, timestamp of its first frame, first AT, last AT, frame count
+    INDEX_ENTRY = struct.Struct("<QQqIII")
+    COMPRESSION_LEVEL = 1  # fast – XORed frames compress well anyway
+
+    @classmethod
+    def encode_block(cls, frames):
+        parts = []
+        previous_by_size = {}
+        for timestamp, at_number, width, height, raw in frames:
+            previous = previous_by_size.get((width, height))
+            if previous is None:
+                parts.append(cls.FRAME_HEADER.pack(timestamp, at_number, width, height, cls.KEY))
+                parts.append(bytes(raw))
+            elif raw == previous:  # most are, capturing faster than the screen refreshes
+                parts.append(cls.FRAME_HEADER.pack(timestamp, at_number, width, height, cls.REPEATED))
+            else:
+                parts.append(cls.FRAME_HEADER.pack(timestamp, at_number, width, height, cls.XORED))
+                parts.append(xor_bytes(raw, previous))
+            previous_by_size[(width, height)] = raw
+        data = zlib.compress(b"".join(parts), cls.COMPRESSION_LEVEL)
+        return cls.BLOCK_HEADER.pack(len(data), len(frames)) + data
+
+    @classmethod
+    def decode_block(cls, buffer, offset):
+        """Returns [(timestamp, AT number, width, height, raw)] of the block at offset."""
+        size, count = cls.BLOCK_HEADER.unpack_from(buffer, offset)
+        start = offset + cls.BLOCK_HEADER.size
+        data = zlib.decompress(buffer[start:start + size])
+        frames = []
+        previous_by_size = {}
+        position = 0
+        for _ in range(count):
+            timestamp, at_number, width, height, kind = cls.FRAME_HEADER.unpack_from(data, position)
+            position += cls.FRAME_HEADER.size
+            if kind == cls.REPEATED:
+                raw = previous_by_size[(width, height)]
+            else:
+                length = width * height * FrameRecording.BYTES_PER_PIXEL
+                raw = data[position:position + length]
+                position += length
+                if kind == cls.XORED:
+                    raw = xor_bytes(raw, previous_by_size[(width, height)])
+            previous_by_size[(width, height)] = raw
+            frames.append((timestamp, at_number, width, height, raw))
+        return frames
+
+
+def xor_bytes(a, b):
+    # as big integers, the XOR runs in C
+    return (int.from_bytes(a, "little") ^ int.from_bytes(b, "little")).to_bytes(len(a), "little")
+
+
+class FrameArchiver(FrameSource):
+    """Passes frames through from another source and archives every one of them, tagged
+    with the number of the AT the reader was reading (see FrameArchiveFormat).
+
+    Grabbing only keeps a reference to the frame; blocks get XORed, compressed and written
+    on the archiver's own thread, so archiving doesn't slow capturing down. If writing falls
+    behind by more than queue_quota bytes of frames, new blocks get dropped (and counted)
+    instead of filling the memory."""
+    BLOCK_FRAMES = 256  # a block ends after this many frames, or when the next AT starts
+    QUEUE_QUOTA = 64 * 1024 * 1024
+
+    def __init__(self, source, filepath, queue_quota=QUEUE_QUOTA):
+        self.source = source
+        self.filepath = filepath
+        self.at_number = 0
+        self.block = []
+        self.file = open(filepath, "wb")
+        self.file.write(FrameArchiveFormat.MAGIC)
+        self.index_file = open(filepath + FrameArchiveFormat.INDEX_EXTENSION, "wb")
+        self.offset = len(FrameArchiveFormat.MAGIC)
+        self.frame_number = 0
+        self.condition = threading.Condition()
+        self.blocks = deque()  # (frames, bytes) waiting to be written
+        self.queue_quota = queue_quota
+        self.queued_bytes = 0
+        self.dropped_frames = 0
+        self.failed = False
+        self.running = True
+        self.thread = threading.Thread(target=self.work, name="archiver", daemon=True)
+        self.thread.start()
+
+    def start_at(self, at_number):
+        self.finish_block()
+        self.at_number = at_number
+
+    def timestamped_grab(self, bbox):
+        timestamp, img = self.source.timestamped_grab(bbox)
+        self.block.append((timestamp, self.at_number, img.size.width, img.size.height, img.raw))
+        if len(self.block) >= self.BLOCK_FRAMES:
+            self.finish_block()
+        return timestamp, img
+
+    def grab(self, bbox):
+        return self.timestamped_grab(bbox)[1]
+
+    def finish_block(self):
+        if not self.block or self.failed:
+            self.block = []
+            return
+        size = sum(len(frame[4]) for frame in self.block)
+        with self.condition:
+            if self.queued_bytes + size > self.queue_quota:
+                self.dropped_frames += len(self.block)
+            else:
+                self.blocks.append((self.block, size))
+                self.queued_bytes += size
+                self.condition.notify()
+        self.block = []
+
+    def work(self):
+        while True:
+            with self.condition:
+                while not self.blocks and self.running:
+                    self.condition.wait()
+                if not self.blocks:
+                    return
+                block, size = self.blocks.popleft()
+            try:
+                self.write_block(block)
+            except OSError as error:
+                print(f"---Frame archive couldn't be written ({error}), not archiving anymore.")
+                with self.condition:
+                    self.failed = True
+                    self.blocks.clear()
+                    self.queued_bytes = 0
+                return
+            with self.condition:
+                self.queued_bytes -= size
+
+    def write_block(self, frames):
+        data = FrameArchiveFormat.encode_block(frames)
+        at_numbers = [frame[1] for frame in frames]
+        entry = FrameArchiveFormat.INDEX_ENTRY.pack(self.offset, self.frame_number, frames[0][0],
+                                                    min(at_numbers), max(at_numbers), len(frames))
+        self.file.write(data)
+        self.file.flush()
+        self.index_file.write(entry)  # only after its block, so the index never points past the end
+        self.index_file.flush()
+        self.offset += len(data)
+        self.frame_number += len(frames)
+
+    def sleep(self, seconds):
+        self.source.sleep(seconds)
+
+    def change_bbox(self, bbox):
+        self.source.change_bbox(bbox)
+
+    def take_statistics(self):
+        return self.source.take_statistics()
+
+    def close(self):
+        self.finish_block()
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+        self.file.close()
+        self.index_file.close()
+        self.source.close()
+        if self.dropped_frames:
+            print(f"---Frame archive: {self.dropped_frames} frames left out, writing couldn't keep up.")
+
+
+class FrameArchiveReader:
+    """Reads single ATs or frames of an archive through memory maps, without reading
+    the rest of it."""
+
+    def __init__(self, filepath):
+        self.file = open(filepath, "rb")
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.buffer[:len(FrameArchiveFormat.MAGIC)] != FrameArchiveFormat.MAGIC:
+            self.buffer.close()
+            self.file.close()
+            raise ValueError(f"{filepath} isn't a frame archive")
+        self.index_file = open(filepath + FrameArchiveFormat.INDEX_EXTENSION, "rb")
+        self.index = None
+        self.block_count = os.fstat(self.index_file.fileno()).st_size // FrameArchiveFormat.INDEX_ENTRY.size
+        if self.block_count:  # empty files can't be mapped
+            self.index = mmap.mmap(self.index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def get_entry(self, block):
+        """(offset, first frame number, first timestamp, first AT, last AT, frame count)"""
+        return FrameArchiveFormat.INDEX_ENTRY.unpack_from(self.index, block * FrameArchiveFormat.INDEX_ENTRY.size)
+
+    def find_first_block(self, is_at_or_after):
+        """The first block for which is_at_or_after(entry) is true – it has to be false for
+        all blocks before that one and true for all after."""
+        low, high = 0, self.block_count
+        while low < high:
+            middle = (low + high) // 2
+            if is_at_or_after(self.get_entry(middle)):
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+    def get_frame_count(self):
+        if not self.block_count:
+            return 0
+        entry = self.get_entry(self.block_count - 1)
+        return entry[1] + entry[5]
+
+    def get_last_at_number(self):
+        return self.get_entry(self.block_count - 1)[4] if self.block_count else None
+
+    def read_at(self, at_number):
+        """Every frame archived while reading that AT, as (timestamp, ScreenShot)."""
+        frames = []
+        block = self.find_first_block(lambda entry: entry[4] >= at_number)
+        while block < self.block_count:
+            entry = self.get_entry(block)
+            if entry[3] > at_number:
+                break
+            frames += [frame for frame in FrameArchiveFormat.decode_block(self.buffer, entry[0])
+                       if frame[1] == at_number]
+            block += 1
+        return [self.to_screenshot(frame) for frame in frames]
+
+    def read_frame(self, frame_number):
+        """The frame_number-th frame archived (from 0), as (timestamp, AT number, ScreenShot)."""
+        block = self.find_first_block(lambda entry: entry[1] + entry[5] > frame_number)
+        if block >= self.block_count:
+            raise IndexError(f"only {self.get_frame_count()} frames archived")
+        entry = self.get_entry(block)
+        timestamp, at_number, width, height, raw = \
+            FrameArchiveFormat.decode_block(self.buffer, entry[0])[frame_number - entry[1]]
+        return timestamp, at_number, ScreenShot.from_size(bytearray(raw), width, height)
+
+    @staticmethod
+    def to_screenshot(frame):
+        timestamp, at_number, width, height, raw = frame
+        return timestamp, ScreenShot.from_size(bytearray(raw), width, height)
+
+    def close(self):
+        if self.index is not None:
+            self.index.close()
+        self.index_file.close()
+        self.buffer.close()
+        self.file.close()
+
+
+def export_at(archive_filepath, at_number, recording_filepath):
+    """Saves one AT's frames as a frame recording, for ReplayFrameSource and ATReanalysing."""
+    reader = FrameArchiveReader(archive_filepath)
+    frames = reader.read_at(at_number)
+    reader.close()
+    with open(recording_filepath, "wb") as file:
+        for timestamp, img in frames:
+            file.write(FrameRecording.FRAME_HEADER.pack(timestamp, img.size.width, img.size.height))
+            file.write(img.raw)
+    return len(frames)
+
+
+if __name__ == "__main__":
+    # python ATArchiving.py <archive> <AT number> [<recording>.frames]
+    if len(sys.argv) not in (3, 4):
+        print("Usage: ATArchiving.py <archive> <AT number> [<recording>.frames]")
+    else:
+        at_number = int(sys.argv[2])
+        output = sys.argv[3] if len(sys.argv) == 4 else f"AT{at_number}{FrameRecording.EXTENSION}"
+        print(f"{export_at(sys.argv[1], at_number, output)} frames saved to {output}")
@@ -0,0 +1,305 @@
+from contextlib import redirect_stdout
+from mss.screenshot import ScreenShot
+import argparse
+import io
+import json
+import platform
+import random
+import subprocess
+import time
+from ATCapturing import FrameSource, FramesExhausted, SyntheticFrameSource
+from ATReading import ActionTest, ATReader, Colour, ColourTable, RawATReader, TableATReader, VectorisedATReader
+from ATReanalysing import ProblemCollector
+
+
+class BenchmarkCase:
+    def __init__(self, name, width, green_position, white_positions, bar_speed=250, noise=0,
+                 press_position=None, gap_time=.4, cancel_position=None):
+        self.name = name
+        self.width = width
+        self.green_position = green_position
+        self.white_positions = white_positions
+        self.bar_speed = bar_speed
+        self.noise = noise  # up to this much gets added to or taken from every colour value
+        self.press_position = press_position
+        self.gap_time = gap_time
+        self.cancel_position = cancel_position  # the AT disappears once the bar gets here
+
+    def get_bbox(self):
+        return ATReader.construct_bbox(0, self.width - 1, 2)
+
+    def get_description(self):
+        return {"width": self.width, "green_position": self.green_position,
+                "white_positions": self.white_positions, "bar_speed": self.bar_speed, "noise": self.noise,
+                "press_position": self.press_position, "gap_time": self.gap_time,
+                "cancel_position": self.cancel_position}
+
+
+CASES = [BenchmarkCase("narrow", 150, 70, [60, 85], press_position=71),
+         BenchmarkCase("default", 250, 120, [100, 140], press_position=121),
+         BenchmarkCase("wide", 500, 300, [260, 330], bar_speed=500, press_position=301),
+         BenchmarkCase("very wide", 1000, 700, [640, 760], bar_speed=900, press_position=650),
+         BenchmarkCase("slow bar", 250, 200, [180, 215], bar_speed=120, press_position=190),
+         BenchmarkCase("fast bar", 250, 60, [40, 80], bar_speed=600, press_position=90),
+         BenchmarkCase("noisy", 250, 120, [100, 140], noise=8, press_position=121),
+         BenchmarkCase("very noisy", 500, 300, [260, 330], bar_speed=500, noise=20, press_position=280),
+         BenchmarkCase("back to back", 250, 120, [100, 140], press_position=131, gap_time=.005),
+         # known problems
+         BenchmarkCase("canceled", 250, 120, [100, 140], cancel_position=80),
+         BenchmarkCase("very early red", 250, 120, [100, 140], press_position=3)]
+
+
+class CorpusSource(SyntheticFrameSource):
+    """Draws a case's ATs at any time, with noise and canceling."""
+    NOISY_VARIANTS = 256  # tried for each colour, every pixel then gets one of those that fit
+
+    def __init__(self, case, seed=0):
+        super().__init__(case.green_position, case.white_positions, bar_speed=case.bar_speed,
+                         press_position=case.press_position, gap_time=case.gap_time, at_bbox=case.get_bbox())
+        self.case = case
+        self.random = random.Random(seed)
+        self.noisy_variants = {}  # by clean BGR value
+
+    def draw_frame(self, time_in_session, width, height):
+        if self.case.cancel_position is not None:
+            bar_start_time, result_time, cycle_time = self.get_cycle_times(width)
+            cancel_time = bar_start_time + (self.case.cancel_position - self.BAR_START_X) / self.bar_speed
+            if time_in_session % cycle_time >= cancel_time:
+                rows = [[self.BACKGROUND] * width for _ in range(height)]
+                return self.add_noise(self.rows_to_screenshot(rows, width, height))
+        return self.add_noise(super().draw_frame(time_in_session, width, height))
+
+    def add_noise(self, img):
+        if not self.case.noise:
+            return img
+        raw = bytearray(img.raw)
+        for i in range(0, len(raw), 4):
+            raw[i:i + 3] = self.random.choice(self.get_noisy_variants(bytes(raw[i:i + 3])))
+        return ScreenShot.from_size(raw, img.size.width, img.size.height)
+
+    def get_noisy_variants(self, bgr):
+        """Noisy versions of a colour that classify the same – noise changing how a pixel classifies
+        (e.g. the bar's green no longer 255) would make the case a different AT."""
+        if bgr not in self.noisy_variants:
+            noise = self.case.noise
+            variants = [bgr]
+            for _ in range(self.NOISY_VARIANTS):
+                noisy = bytes(min(255, max(0, value + self.random.randint(-noise, noise))) for value in bgr)
+                if self.classify(noisy) == self.classify(bgr):
+                    variants.append(noisy)
+            self.noisy_variants[bgr] = variants
+        return self.noisy_variants[bgr]
+
+    @staticmethod
+    def classify(bgr):
+        rgb = (bgr[2], bgr[1], bgr[0])
+        return [getattr(Colour, name)(rgb) for name in ColourTable.PREDICATE_NAMES]
+
+    def get_frame_at(self, t):
+        return self.draw_frame(t, self.case.width, 3)
+
+    def get_phase_frames(self, count=20):
+        """Frames for timing single phases: (waiting, located, bar moving, result),
+        the result ones with their timestamps – reading a result waits for its colour."""
+        bar_start_time, result_time, cycle_time = self.get_cycle_times(self.case.width)
+        bar_end_time = result_time
+        if self.case.cancel_position is not None:
+            bar_end_time = bar_start_time + (self.case.cancel_position - self.BAR_START_X) / self.bar_speed
+        waiting = [self.get_frame_at(self.gap_time * i / count) for i in range(count)]
+        waiting += [self.get_frame_at(self.gap_time + self.settle_time * i / count) for i in range(count)]
+        located = [self.get_frame_at(self.gap_time + self.settle_time * (i + 1) / (count + 1)) for i in range(count)]
+        moving = [self.get_frame_at(bar_start_time + (bar_end_time - bar_start_time) * i / count) for i in range(count)]
+        result_times = [self.result_time * (i + 1) / (count + 1) for i in range(count)]
+        result = [(int(t * 1e9), self.get_frame_at(result_time + t)) for t in result_times]
+        return waiting, located, moving, result
+
+    def record(self, cycles=3, capture_rate=1000):
+        """The frames a reader grabbing capture_rate times a second would get."""
+        frames = []
+        cycle_time = self.get_cycle_times(self.case.width)[2]
+        last_refresh_index, img = None, None
+        for index in range(int(cycles * cycle_time * capture_rate)):
+            t = index / capture_rate
+            refresh_index = int(t * self.refresh_rate)
+            if refresh_index != last_refresh_index:  # the screen only changes this often
+                img = self.get_frame_at(refresh_index / self.refresh_rate)
+                last_refresh_index = refresh_index
+            frames.append((int(t * 1e9), img))
+        return frames
+
+
+class MemoryFrameSource(FrameSource):
+    """Plays back (timestamp, frame) pairs. Like a ReplayFrameSource that isn't realtime,
+    sleeping skips the frames recorded meanwhile. Can repeat the frames forever,
+    with the timestamps carrying on."""
+
+    def __init__(self, frames, repeat=False):
+        self.frames = frames
+        self.repeat = repeat
+        self.index = 0
+        self.grabs = 0
+        self.time_offset = 0
+
+    def timestamped_grab(self, bbox):
+        if self.index >= len(self.frames):
+            if not self.repeat:
+                raise FramesExhausted()
+            self.index = 0
+            self.time_offset += self.frames[-1][0] - self.frames[0][0] + self.get_frame_interval()
+        timestamp, img = self.frames[self.index]
+        self.index += 1
+        self.grabs += 1
+        return timestamp + self.time_offset, img
+
+    def get_frame_interval(self):
+        if len(self.frames) < 2:
+            return 1
+        return (self.frames[-1][0] - self.frames[0][0]) // (len(self.frames) - 1)
+
+    def grab(self, bbox):
+        return self.timestamped_grab(bbox)[1]
+
+    def sleep(self, seconds):
+        if self.index == 0 or self.repeat:
+            return
+        wake_up_time = self.frames[self.index - 1][0] + seconds * 1e9
+        while self.index < len(self.frames) and self.frames[self.index][0] < wake_up_time:
+            self.index += 1
+
+
+class Benchmark:
+    MIN_DURATION = .2  # seconds each measurement runs at least for
+    CYCLES = 3  # ATs recorded for reading them like in a session
+
+    def __init__(self, reader_classes, cases=CASES, min_duration=MIN_DURATION):
+        self.reader_classes = reader_classes
+        self.cases = cases
+        self.min_duration = min_duration
+
+    def run(self):
+        results = {reader_class.__name__: {} for reader_class in self.reader_classes}
+        for case in self.cases:
+            source = CorpusSource(case)
+            phase_frames = source.get_phase_frames()
+            recording = source.record(self.CYCLES)
+            for reader_class in self.reader_classes:
+                print(f"{reader_class.__name__}: {case.name}")
+                result = self.run_case(reader_class, case, phase_frames, recording)
+                if result["read_at"]["action_tests"] != self.CYCLES:
+                    print(f"---Read {result['read_at']['action_tests']} ATs instead of {self.CYCLES}!")
+                results[reader_class.__name__][case.name] = result
+        return {"commit": get_commit(), "python": platform.python_version(),
+                "numpy": VectorisedATReader.is_available(),
+                "cases": {case.name: case.get_description() for case in self.cases},
+                "results": results}
+
+    def run_case(self, reader_class, case, phase_frames, recording):
+        waiting, located, moving, result = phase_frames
+        results_source = MemoryFrameSource(result, repeat=True)
+        reader = self.make_reader(reader_class, case, results_source)
+        reader.current_at = ActionTest()
+        with redirect_stdout(io.StringIO()):  # problems get printed
+            return {"contains_at": self.measure(reader.contains_at, waiting),
+                    "locate_sections": self.measure(reader.find_sections, located),
+                    "find_bar": self.measure(lambda img: reader.find_bar(img, 0), moving),
+                    "evaluate_result": self.measure(lambda frame: reader.evaluate_result(), result),
+                    "read_at": self.measure_read_at(reader_class, case, recording)}
+
+    @staticmethod
+    def make_reader(reader_class, case, frame_source):
+        return reader_class(case.get_bbox(), frame_source, ProblemCollector())
+
+    def measure(self, function, frames):
+        count = 0
+        start_time = time.perf_counter_ns()
+        while True:
+            for img in frames:
+                function(img)
+            count += len(frames)
+            elapsed = time.perf_counter_ns() - start_time
+            if elapsed >= self.min_duration * 1e9:
+                return self.get_rates(count, elapsed)
+
+    def measure_read_at(self, reader_class, case, recording):
+        """Reads the recorded ATs like during a session – the rate is of the frames grabbed."""
+        grabs, elapsed = 0, 0
+        while elapsed < self.min_duration * 1e9:
+            source = MemoryFrameSource(recording)
+            reader = self.make_reader(reader_class, case, source)
+            start_time = time.perf_counter_ns()
+            ats = self.read_all(reader)
+            elapsed += time.perf_counter_ns() - start_time
+            grabs += source.grabs
+        rates = self.get_rates(grabs, elapsed)
+        rates["action_tests"] = ats  # per reading of the recording
+        return rates
+
+    @staticmethod
+    def read_all(reader):
+        """Reads ATs until the frames run out, returns how many."""
+        ats = 0
+        try:
+            while True:
+                reader.read_at()
+                ats += 1
+        except FramesExhausted:
+            return ats
+
+    @staticmethod
+    def get_rates(frames, elapsed_ns):
+        return {"frames": frames, "frames_per_second": round(frames / elapsed_ns * 1e9, 1),
+                "us_per_frame": round(elapsed_ns / frames / 1000, 3)}
+
+
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(old, new, threshold=.1):
+    """Prints the measurements that got more than threshold slower or faster."""
+    for reader_name, cases in new["results"].items():
+        for case_name, phases in cases.items():
+            for phase, rates in phases.items():
+                try:
+                    old_rates = old["results"][reader_name][case_name][phase]
+                except KeyError:
+                    continue
+                change = rates["us_per_frame"] / old_rates["us_per_frame"] - 1
+                if abs(change) > threshold:
+                    word = "slower" if change > 0 else "faster"
+                    print(f"{reader_name} {case_name} {phase}: {abs(change):.0%} {word} "
+                          f"({old_rates['us_per_frame']} -> {rates['us_per_frame']} µs per frame)")
+
+
+def main():
+    # python ATBenchmarking.py [--output benchmark.json] [--compare earlier.json]
+    readers = {reader_class.__name__: reader_class
+               for reader_class in (ATReader, RawATReader, VectorisedATReader, TableATReader)}
+    parser = argparse.ArgumentParser(description="Times the reader on generated ATs, no display needed.")
+    parser.add_argument("--readers", nargs="+", choices=list(readers),
+                        default=["ATReader", "RawATReader", "VectorisedATReader"])
+    parser.add_argument("--cases", nargs="+", choices=[case.name for case in CASES])
+    parser.add_argument("--duration", type=float, default=Benchmark.MIN_DURATION,
+                        help="seconds each measurement runs at least for")
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--compare", help="an earlier output to compare with")
+    arguments = parser.parse_args()
+    reader_classes = [readers[name] for name in arguments.readers]
+    if VectorisedATReader in reader_classes and not VectorisedATReader.is_available():
+        print("---NumPy not installed, skipping VectorisedATReader.")
+        reader_classes.remove(VectorisedATReader)
+    cases = [case for case in CASES if arguments.cases is None or case.name in arguments.cases]
+    results = Benchmark(reader_classes, cases, arguments.duration).run()
+    with open(arguments.output, "w") as file:
+        json.dump(results, file, indent=2)
+    if arguments.compare:
+        with open(arguments.compare, "r") as file:
+            compare_results(json.load(file), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,641 @@
+from mss import mss
+from mss.screenshot import ScreenShot
+import mss.tools as mss_tools
+from collections import deque
+import os
+import struct
+import threading
+import time
+
+
+class FramesExhausted(Exception):
+    pass
+
+
+class FrameSource:
+    """Where ATReader gets its frames from. Subclasses implement grab(bbox)."""
+
+    def grab(self, bbox):
+        raise NotImplementedError
+
+    def timestamped_grab(self, bbox):
+        return time.perf_counter_ns(), self.grab(bbox)
+
+    def sleep(self, seconds):
+        time.sleep(seconds)  # replays can skip ahead instead
+
+    def change_bbox(self, bbox):
+        pass  # only sources made for one bbox need to know
+
+    def take_statistics(self):
+        return None  # only buffering sources keep statistics
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class LiveFrameSource(FrameSource):
+    """Grabs the real screen with one long-lived mss instance per thread."""
+
+    def __init__(self):
+        self.local = threading.local()  # mss instances can't be shared between threads
+        self.instances = []
+
+    def grab(self, bbox):
+        sct = getattr(self.local, "sct", None)
+        if sct is None:
+            sct = self.local.sct = mss()
+            self.instances.append(sct)
+        return sct.grab(bbox)
+
+    def close(self):
+        for sct in self.instances:
+            sct.close()
+        self.instances = []
+        self.local = threading.local()
+
+
+class ThreadedFrameSource(FrameSource):
+    """Grabs one bbox as fast as possible on its own thread into a ring buffer
+    of (perf_counter_ns timestamp, frame) entries, which grabs then consume in order.
+
+    Frames overwritten before being consumed count as dropped, frames identical
+    to the one before as duplicates. Other bboxes are grabbed directly. While the
+    reader sleeps, e.g. polling idly, capturing pauses and it wakes up to a fresh frame."""
+    RING_SIZE = 64
+    MAX_WAIT = .05  # the capture thread checks again at least this often, whatever it waits for
+
+    def __init__(self, source, bbox, ring_size=RING_SIZE):
+        self.source = source
+        self.bbox = bbox
+        self.ring = deque(maxlen=ring_size)
+        self.ring_size = ring_size
+        self.condition = threading.Condition()
+        self.captured_frames = 0
+        self.dropped_frames = 0
+        self.duplicate_frames = 0
+        self.max_occupancy = 0
+        self.capture_error = None
+        self.paused_until = 0.  # perf_counter time the reader sleeps until
+        self.waking = False  # the reader hasn't taken the frame it woke up to yet
+        self.running = True
+        self.thread = threading.Thread(target=self.capture, name="capture", daemon=True)
+        self.thread.start()
+
+    @property
+    def occupancy(self):
+        return len(self.ring)
+
+    def capture(self):
+        last_raw = None
+        while self.running:
+            with self.condition:
+                while self.running and (time.perf_counter() < self.paused_until or self.waking and self.ring):
+                    remaining = self.paused_until - time.perf_counter()
+                    self.condition.wait(min(remaining, self.MAX_WAIT) if remaining > 0 else self.MAX_WAIT)
+                bbox, paused_until = self.bbox, self.paused_until
+            try:
+                timestamp, img = self.source.timestamped_grab(bbox)
+            except Exception as error:  # e.g. FramesExhausted – hand it over to the reader
+                with self.condition:
+                    self.capture_error = error
+                    self.condition.notify_all()
+                return
+            with self.condition:
+                if bbox != self.bbox or paused_until != self.paused_until:
+                    continue  # changed while grabbing, or from before the reader went to sleep
+                self.captured_frames += 1
+                if img.raw == last_raw:
+                    self.duplicate_frames += 1
+                if len(self.ring) == self.ring_size:
+                    self.dropped_frames += 1  # the oldest frame gets pushed out unread
+                self.ring.append((timestamp, img))
+                self.max_occupancy = max(self.max_occupancy, len(self.ring))
+                self.condition.notify_all()
+            last_raw = img.raw
+
+    def timestamped_grab(self, bbox):
+        if bbox != self.bbox:
+            return self.source.timestamped_grab(bbox)
+        with self.condition:
+            while not self.ring:
+                if self.capture_error is not None:
+                    raise self.capture_error
+                self.condition.wait()
+            if self.waking:
+                self.waking = False
+                self.condition.notify_all()  # back to capturing as fast as possible
+            return self.ring.popleft()
+
+    def grab(self, bbox):
+        return self.timestamped_grab(bbox)[1]
+
+    def sleep(self, seconds):
+        with self.condition:
+            self.paused_until = time.perf_counter() + seconds
+            self.waking = True
+            self.ring.clear()  # like replays, wake up to what's showing by then
+            self.condition.notify_all()
+        self.source.sleep(seconds)
+
+    def change_bbox(self, bbox):
+        with self.condition:
+            self.bbox = bbox
+            self.ring.clear()
+            self.condition.notify_all()
+
+    def take_statistics(self):
+        with self.condition:
+            statistics = {"captured": self.captured_frames, "dropped": self.dropped_frames,
+                          "duplicates": self.duplicate_frames, "max_occupancy": self.max_occupancy}
+            self.captured_frames = self.dropped_frames = self.duplicate_frames = 0
+            self.max_occupancy = len(self.ring)
+        return statistics
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()  # in case it's paused
+        self.thread.join()
+        self.source.close()
+
+
+class PollingScheduler:
+    """Paces the grabs while waiting for an AT to load up.
+
+    Idle (nothing of the AT on screen) it polls every idle_interval, backing off up to
+    MAX_IDLE_INTERVAL. Armed (part of the AT border is showing) it grabs as fast as possible.
+    Keeps the CPU time and wall time spent in both modes and how late detections could be."""
+    IDLE_INTERVAL = .01
+    MAX_IDLE_INTERVAL = .03
+    BACKOFF = 1.5
+    ARMED_TIMEOUT = 1.  # back to idle if the AT doesn't fully appear by then
+    IDLE = "idle"
+    ARMED = "armed"
+
+    def __init__(self, idle_interval=IDLE_INTERVAL, sleep=time.sleep):
+        self.idle_interval = idle_interval
+        self.sleep = sleep
+        self.max_idle_interval = max(idle_interval, self.MAX_IDLE_INTERVAL)
+        self.mode = self.IDLE
+        self.interval = idle_interval
+        self.armed_since = None
+        self.can_arm = True
+        self.mode_started = None  # (wall time, cpu time)
+        self.last_grab_time = None
+        self.wall_times = {self.IDLE: 0., self.ARMED: 0.}
+        self.cpu_times = {self.IDLE: 0., self.ARMED: 0.}
+        self.grabs = {self.IDLE: 0, self.ARMED: 0}
+        self.detections = 0
+        self.total_detection_delay = 0.
+        self.max_detection_delay = 0.
+
+    def start_waiting(self):
+        self.switch_mode(self.IDLE)
+        self.last_grab_time = None
+
+    def on_grab(self, timestamp):
+        self.grabs[self.mode] += 1
+        # the AT could have appeared at any point since the grab before
+        delay = (timestamp - self.last_grab_time) / 1e9 if self.last_grab_time is not None else 0.
+        self.last_grab_time = timestamp
+        return delay
+
+    def wait_after_miss(self, is_at_appearing):
+        if not is_at_appearing:
+            self.can_arm = True
+        if is_at_appearing and self.can_arm and self.mode == self.IDLE:
+            self.switch_mode(self.ARMED)
+            self.armed_since = time.perf_counter()
+        elif self.mode == self.ARMED and time.perf_counter() - self.armed_since > self.ARMED_TIMEOUT:
+            # e.g. a dark scene behind the AT – don't arm again until it's gone
+            self.switch_mode(self.IDLE)
+            self.can_arm = False
+        if self.mode == self.ARMED:
+            return
+        self.sleep(self.interval)
+        self.interval = min(self.interval * self.BACKOFF, self.max_idle_interval)
+
+    def wait_while_showing(self):
+        """Between grabs while the last AT is still showing – it only has to be noticed going
+        as soon as a new one would be noticed appearing."""
+        self.sleep(self.idle_interval)
+
+    def finish_waiting(self, detection_delay):
+        self.detections += 1
+        self.total_detection_delay += detection_delay
+        self.max_detection_delay = max(self.max_detection_delay, detection_delay)
+        self.switch_mode(None)
+
+    def switch_mode(self, mode):
+        now = time.perf_counter(), time.thread_time()
+        if self.mode_started is not None and self.mode is not None:
+            self.wall_times[self.mode] += now[0] - self.mode_started[0]
+            self.cpu_times[self.mode] += now[1] - self.mode_started[1]
+        self.mode = mode
+        self.mode_started = now
+        self.interval = self.idle_interval
+
+    def get_metrics(self):
+        metrics = {"detections": self.detections,
+                   "max_detection_delay": self.max_detection_delay,
+                   "mean_detection_delay": self.total_detection_delay / max(1, self.detections)}
+        for mode in (self.IDLE, self.ARMED):
+            metrics[mode] = {"wall_time": self.wall_times[mode], "cpu_time": self.cpu_times[mode],
+                             "grabs": self.grabs[mode]}
+        return metrics
+
+    def get_summary(self):
+        metrics = self.get_metrics()
+        parts = []
+        for mode in (self.IDLE, self.ARMED):
+            wall_time, cpu_time = metrics[mode]["wall_time"], metrics[mode]["cpu_time"]
+            cpu_percentage = round(100 * cpu_time / wall_time) if wall_time else 0
+            parts.append(f"{mode} {wall_time:.1f} s ({cpu_percentage}% CPU)")
+        delay = round(metrics["mean_detection_delay"] * 1000, 1)
+        return f"Waiting: {', '.join(parts)}, detections {delay} ms late on average"
+
+
+class FrameRecording:
+    EXTENSION = ".frames"
+    # every frame: perf_counter_ns timestamp, width, height, then the raw BGRA bytes
+    FRAME_HEADER = struct.Struct("<qII")
+    BYTES_PER_PIXEL = 4
+
+
+class RecordingFrameSource(FrameSource):
+    """Passes frames through from another source and saves them for replaying.
+    With a bbox, only the frames of it get saved – not e.g. whole monitors grabbed
+    for locating the AT, which a replay would take for frames of the AT."""
+
+    def __init__(self, source, filepath, bbox=None):
+        self.source = source
+        self.bbox = bbox
+        self.file = open(filepath, "wb")
+
+    def timestamped_grab(self, bbox):
+        timestamp, img = self.source.timestamped_grab(bbox)
+        if self.bbox is None or tuple(bbox) == tuple(self.bbox):
+            header = FrameRecording.FRAME_HEADER.pack(timestamp, img.size.width, img.size.height)
+            self.file.write(header)
+            self.file.write(img.raw)
+        return timestamp, img
+
+    def grab(self, bbox):
+        return self.timestamped_grab(bbox)[1]
+
+    def sleep(self, seconds):
+        self.source.sleep(seconds)
+
+    def change_bbox(self, bbox):
+        if self.bbox is not None:
+            self.bbox = bbox
+        self.source.change_bbox(bbox)
+
+    def take_statistics(self):
+        return self.source.take_statistics()
+
+    def close(self):
+        self.file.close()
+        self.source.close()
+
+
+class FlightRecorder(FrameSource):
+    """Passes frames through from another source, keeping the last ones in a ring preallocated
+    for frames of the bbox size. When the reader reports a problem, the ring gets copied
+    and the writer saves it as a frame recording, plus a PNG of the problem frame.
+
+    Saves each problem once per AT, at most once per min_interval seconds and only while
+    the folder stays under quota bytes – problems can't slow reading down or fill the disk."""
+    FRAMES = 120
+    QUOTA = 50 * 1024 * 1024
+    MIN_INTERVAL = 2.
+
+    def __init__(self, source, bbox, writer, folder, frames=FRAMES, quota=QUOTA, min_interval=MIN_INTERVAL):
+        self.source = source
+        self.writer = writer
+        self.folder = folder
+        self.frames = frames
+        self.quota = quota
+        self.min_interval = min_interval
+        self.make_ring(bbox)
+        os.makedirs(folder, exist_ok=True)
+        self.used_bytes = self.get_folder_size()
+        self.last_save_time = None
+        self.saved_problems = set()  # (AT number, tag)
+        self.skipped_saves = 0
+        self.session_name = time.strftime("%Y-%m-%d_%H-%M-%S")
+
+    def make_ring(self, bbox):
+        x_left, y_top, x_right, y_bottom = bbox
+        self.slot_size = (x_right - x_left) * (y_bottom - y_top) * FrameRecording.BYTES_PER_PIXEL
+        self.ring = bytearray(self.frames * self.slot_size)
+        self.headers = [None] * self.frames  # (timestamp, width, height) per slot
+        self.next_slot = 0
+
+    def change_bbox(self, bbox):
+        self.source.change_bbox(bbox)
+        self.make_ring(bbox)
+
+    def get_folder_size(self):
+        return sum(entry.stat().st_size for entry in os.scandir(self.folder) if entry.is_file())
+
+    def timestamped_grab(self, bbox):
+        timestamp, img = self.source.timestamped_grab(bbox)
+        self.keep_frame(timestamp, img)
+        return timestamp, img
+
+    def grab(self, bbox):
+        return self.timestamped_grab(bbox)[1]
+
+    def keep_frame(self, timestamp, img):
+        raw = img.raw
+        if len(raw) > self.slot_size:
+            return  # not from the AT
+        start = self.next_slot * self.slot_size
+        self.ring[start:start + len(raw)] = raw
+        self.headers[self.next_slot] = (timestamp, img.size.width, img.size.height)
+        self.next_slot = (self.next_slot + 1) % self.frames
+
+    def report_problem(self, tag, at_number, img):
+        """Returns the path the frames get saved to (without extension), None if they won't be."""
+        if (at_number, tag) in self.saved_problems:
+            return None
+        now = time.perf_counter()
+        if self.last_save_time is not None and now - self.last_save_time < self.min_interval:
+            self.skipped_saves += 1
+            return None
+        frames = self.take_snapshot()
+        problem_raw = bytes(img.raw)
+        size = sum(FrameRecording.FRAME_HEADER.size + len(data) for header, data in frames) + len(problem_raw)
+        if self.used_bytes + size > self.quota:
+            self.skipped_saves += 1
+            return None
+        self.used_bytes += size
+        self.last_save_time = now
+        self.saved_problems.add((at_number, tag))
+        filepath = f"{self.folder}/{self.session_name}_AT{at_number}_{tag}"
+        self.writer.replace(filepath + FrameRecording.EXTENSION, lambda: self.encode_frames(frames))
+        width, height = img.size.width, img.size.height
+        self.writer.replace(filepath + ".png", lambda: self.encode_png(problem_raw, width, height))
+        return filepath
+
+    def take_snapshot(self):
+        frames = []
+        for index in range(self.frames):
+            slot = (self.next_slot + index) % self.frames  # oldest first
+            header = self.headers[slot]
+            if header is None:
+                continue
+            timestamp, width, height = header
+            start = slot * self.slot_size
+            frames.append((header, bytes(self.ring[start:start + width * height * FrameRecording.BYTES_PER_PIXEL])))
+        return frames
+
+    @staticmethod
+    def encode_frames(frames):
+        return b"".join(FrameRecording.FRAME_HEADER.pack(*header) + data for header, data in frames)
+
+    @staticmethod
+    def encode_png(raw, width, height):
+        img = ScreenShot.from_size(bytearray(raw), width, height)
+        return mss_tools.to_png(img.rgb, img.size)
+
+    def sleep(self, seconds):
+        self.source.sleep(seconds)
+
+    def take_statistics(self):
+        return self.source.take_statistics()
+
+    def close(self):
+        self.source.close()
+
+
+class ReplayFrameSource(FrameSource):
+    """Plays back frames saved by RecordingFrameSource.
+
+    In realtime mode each grab returns the frame that was on screen at the same
+    time after the start as during recording, otherwise every grab returns the next frame
+    and sleeping just skips the frames recorded meanwhile."""
+
+    def __init__(self, filepath, realtime=True):
+        self.file = open(filepath, "rb")
+        self.realtime = realtime
+        self.start_time = None
+        self.first_timestamp = None
+        self.current_frame = None
+        self.next_header = self.read_header()
+
+    def read_header(self):
+        header = self.file.read(FrameRecording.FRAME_HEADER.size)
+        if len(header) < FrameRecording.FRAME_HEADER.size:
+            return None
+        return FrameRecording.FRAME_HEADER.unpack(header)
+
+    def grab(self, bbox):
+        if not self.realtime or self.start_time is None:
+            self.current_frame = self.take_next_frame()
+            if self.realtime:
+                self.start_time = time.perf_counter_ns()
+                self.first_timestamp = self.current_frame[0]
+            return self.current_frame[1]
+        if self.next_header is None:
+            raise FramesExhausted()
+        elapsed = time.perf_counter_ns() - self.start_time
+        # skip to the newest frame that was on screen this long after the start
+        newest = None
+        while self.next_header is not None and self.next_header[0] - self.first_timestamp <= elapsed:
+            newest = self.next_header, self.file.tell()
+            self.skip_frame_data(self.next_header)
+            self.next_header = self.read_header()
+        if newest is not None:
+            header, data_position = newest
+            next_position = self.file.tell()
+            self.file.seek(data_position)
+            self.current_frame = self.read_frame_data(header)
+            self.file.seek(next_position)
+        return self.current_frame[1]
+
+    def sleep(self, seconds):
+        if self.realtime or self.current_frame is None:
+            time.sleep(seconds)
+            return
+        wake_up_time = self.current_frame[0] + seconds * 1e9
+        while self.next_header is not None and self.next_header[0] < wake_up_time:
+            self.skip_frame_data(self.next_header)
+            self.next_header = self.read_header()
+
+    def take_next_frame(self):
+        if self.next_header is None:
+            raise FramesExhausted()
+        frame = self.read_frame_data(self.next_header)
+        self.next_header = self.read_header()
+        return frame
+
+    def read_frame_data(self, header):
+        timestamp, width, height = header
+        raw = self.file.read(self.get_data_size(header))
+        return timestamp, ScreenShot.from_size(bytearray(raw), width, height)
+
+    def skip_frame_data(self, header):
+        self.file.seek(self.get_data_size(header), 1)
+
+    @staticmethod
+    def get_data_size(header):
+        timestamp, width, height = header
+        return width * height * FrameRecording.BYTES_PER_PIXEL
+
+    def close(self):
+        self.file.close()
+
+
+class SyntheticFrameSource(FrameSource):
+    """Draws action tests in at_bbox (the first grabbed bbox if None): a dark top row,
+    the green/white/red sections and a bar moving at bar_speed (pixels per second)
+    until it's pressed at press_position. Grabs of other regions get cropped from it.
+
+    The picture only changes refresh_rate times a second, like a real monitor."""
+    BACKGROUND = (120, 110, 100)
+    DARK = (20, 20, 20)
+    GREEN = (0, 255, 0)
+    WHITE = (235, 235, 235)
+    RED = (200, 20, 20)
+    BAR = (190, 255, 190)
+    RESULT_RED = (250, 0, 0)
+    RESULT_GREEN = (0, 230, 0)
+    BAR_START_X = 1
+
+    def __init__(self, green_position, white_positions, green_width=3, bar_speed=250,
+                 press_position=None, refresh_rate=144, gap_time=.4, settle_time=.1,
+                 result_time=.08, at_bbox=None, clock=time.perf_counter):
+        self.green_position = green_position
+        self.green_width = green_width
+        self.white_positions = white_positions
+        self.bar_speed = bar_speed
+        self.press_position = press_position
+        self.refresh_rate = refresh_rate
+        self.gap_time = gap_time
+        self.settle_time = settle_time
+        self.result_time = result_time
+        self.at_bbox = at_bbox
+        self.clock = clock
+        self.start_time = None
+        self.last_refresh_index = None
+        self.last_frame = None
+
+    def grab(self, bbox):
+        if self.start_time is None:
+            self.start_time = self.clock()
+        if self.at_bbox is None:
+            self.at_bbox = bbox
+        refresh_index = int((self.clock() - self.start_time) * self.refresh_rate)
+        if refresh_index != self.last_refresh_index:
+            x_left, y_top, x_right, y_bottom = self.at_bbox
+            self.last_frame = self.draw_frame(refresh_index / self.refresh_rate, x_right - x_left, y_bottom - y_top)
+            self.last_refresh_index = refresh_index
+        if tuple(bbox) == tuple(self.at_bbox):
+            return self.last_frame
+        return self.crop(self.last_frame, bbox)
+
+    def crop(self, frame, bbox):
+        x_left, y_top, x_right, y_bottom = bbox
+        at_left, at_top = self.at_bbox[0], self.at_bbox[1]
+        background = bytes((self.BACKGROUND[2], self.BACKGROUND[1], self.BACKGROUND[0], 255))
+        raw = bytearray()
+        for y in range(y_top - at_top, y_bottom - at_top):
+            for x in range(x_left - at_left, x_right - at_left):
+                if 0 <= x < frame.size.width and 0 <= y < frame.size.height:
+                    offset = (y * frame.size.width + x) * 4
+                    raw += frame.raw[offset:offset + 4]
+                else:
+                    raw += background
+        return ScreenShot.from_size(raw, x_right - x_left, y_bottom - y_top)
+
+    def get_cycle_times(self, width):
+        last_x = self.press_position if self.press_position is not None else width - 1
+        bar_time = (last_x - self.BAR_START_X) / self.bar_speed
+        bar_start_time = self.gap_time + self.settle_time
+        result_time = bar_start_time + bar_time
+        cycle_time = result_time + self.result_time
+        return bar_start_time, result_time, cycle_time
+
+    def get_result_colour(self):
+        if self.press_position is None:
+            return self.RESULT_RED  # never pressed
+        section_colour = self.get_section_colour(self.press_position)
+        if section_colour == self.GREEN:
+            return self.RESULT_GREEN
+        if section_colour == self.WHITE:
+            return None  # white result
+        return self.RESULT_RED
+
+    def draw_frame(self, time_in_session, width, height):
+        bar_start_time, result_time, cycle_time = self.get_cycle_times(width)
+        t = time_in_session % cycle_time
+        if t < self.gap_time:
+            rows = [[self.BACKGROUND] * width for _ in range(height)]
+        elif t < result_time:
+            bar_x = self.BAR_START_X + int(max(0., t - bar_start_time) * self.bar_speed)
+            rows = self.draw_at(width, height, bar_x)
+        else:
+            rows = self.draw_at(width, height, None)
+            result_colour = self.get_result_colour()
+            if result_colour is not None:
+                rows[-1] = [result_colour] * width
+        return self.rows_to_screenshot(rows, width, height)
+
+    def draw_at(self, width, height, bar_x):
+        top = [self.DARK] * width
+        sections = [self.get_section_colour(x) for x in range(width)]
+        if bar_x is not None and bar_x < width:
+            top[bar_x] = self.BAR
+        return [top] + [list(sections) for _ in range(height - 1)]
+
+    def get_section_colour(self, x):
+        white_start, white_end = self.white_positions
+        if self.green_position <= x < self.green_position + self.green_width:
+            return self.GREEN
+        if white_start <= x <= white_end:
+            return self.WHITE
+        return self.RED
+
+    @staticmethod
+    def rows_to_screenshot(rows, width, height):
+        raw = bytearray()
+        for row in rows:
+            for r, g, b in row:
+                raw += bytes((b, g, r, 255))
+        return ScreenShot.from_size(raw, width, height)
+
+
+def main():
+    import sys
+    from ATReading import ATReader, VectorisedATReader
+
+    if len(sys.argv) > 1:
+        source = ReplayFrameSource(sys.argv[1])
+    else:
+        source = SyntheticFrameSource(green_position=120, white_positions=[100, 140], press_position=118)
+    bbox = ATReader.construct_bbox(0, 249, 2)
+    reader_class = VectorisedATReader if VectorisedATReader.is_available() else ATReader
+    reader = reader_class(bbox, frame_source=source)
+    at_count = 0
+    try:
+        while True:
+            reader.read_at()
+            at_count += 1
+    except (FramesExhausted, KeyboardInterrupt):
+        pass
+    finally:
+        source.close()
+    print(f"{at_count} ATs read.")
+
+
+if __name__ == "__main__":
+    main()
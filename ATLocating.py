@@ -0,0 +1,130 @@
+from mss import mss
+from mss.screenshot import ScreenShot
+import json
+import os
+from ATReading import ATReader, np
+
+
+class ATLocator:
+    """Finds where the AT is from one grab of the whole monitor.
+
+    An AT shows as a dark row with red sections two rows below it. Rows with the most of that
+    get found on every COLUMN_STEP-th column first, then only the best row is looked at in full.
+    Found locations get cached per monitor resolution. Needs NumPy."""
+    COLUMN_STEP = 4
+    MIN_WIDTH = 60  # pixels of red under dark for a row to count
+    MAX_BAR_WIDTH = 4  # the bar can split the dark row
+    LOCATE_INTERVAL = 2.  # seconds of waiting idly for an AT before looking for it elsewhere
+    DATA_FOLDER_NAME = "Data"  # same as ATLogger's
+    CACHE_FILENAME = "atLocations.json"
+
+    def __init__(self, frame_source, monitor_bbox=None):
+        self.frame_source = frame_source
+        self.monitor_bbox = monitor_bbox or self.get_monitor_bbox()
+        self.cache_filepath = self.DATA_FOLDER_NAME + "/" + self.CACHE_FILENAME
+
+    @staticmethod
+    def is_available():
+        return np is not None
+
+    @staticmethod
+    def get_monitor_bbox():
+        with mss() as sct:
+            monitor = sct.monitors[1]  # the primary one
+        return (monitor["left"], monitor["top"],
+                monitor["left"] + monitor["width"], monitor["top"] + monitor["height"])
+
+    def get_resolution_key(self):
+        x_left, y_top, x_right, y_bottom = self.monitor_bbox
+        return f"{x_right - x_left}x{y_bottom - y_top}"
+
+    def get_cached_location(self):
+        return self.load_cache().get(self.get_resolution_key())
+
+    def load_cache(self):
+        if not os.path.isfile(self.cache_filepath):
+            return {}
+        try:
+            with open(self.cache_filepath, "r") as file:
+                return json.load(file)
+        except ValueError:
+            return {}
+
+    def save_location(self, location):
+        cache = self.load_cache()
+        cache[self.get_resolution_key()] = list(location)
+        with open(self.cache_filepath, "w") as file:
+            json.dump(cache, file)
+
+    def locate(self):
+        """Returns (x left, x right, y top) like in prefs, None if there's no AT on screen."""
+        img = self.frame_source.grab(self.monitor_bbox)
+        location = self.find_at(img)
+        if location is None:
+            return None
+        x_left, x_right, y_top = location
+        location = (x_left + self.monitor_bbox[0], x_right + self.monitor_bbox[0], y_top + self.monitor_bbox[1])
+        self.save_location(location)
+        return location
+
+    def find_at(self, img):
+        bgra = np.frombuffer(img.raw, dtype=np.uint8).reshape(img.size.height, img.size.width, 4)
+        y_dark = self.find_dark_row(bgra[:, ::self.COLUMN_STEP])
+        if y_dark is None:
+            return None
+        dark_top = self.is_dark(bgra[y_dark])
+        red_bottom = self.is_colour_red(bgra[y_dark + 2])
+        x_first, x_last = self.find_red_under_dark(dark_top, red_bottom)
+        if x_last - x_first + 1 < self.MIN_WIDTH:
+            return None
+        # the edge columns next to the red count as the AT's border, if their top is dark too
+        x_left = x_first - 1 if x_first > 0 and dark_top[x_first - 1] else x_first
+        x_right = x_last + 1 if x_last + 1 < dark_top.size and dark_top[x_last + 1] else x_last
+        location = (x_left, x_right, y_dark + 2)  # the bbox's y top is its bottom row
+        if not self.is_at_there(img, location):
+            return None
+        return location
+
+    def find_dark_row(self, bgra):
+        dark = self.is_dark(bgra)
+        red = self.is_colour_red(bgra)
+        # the last dark row above the sections: red one and two rows below
+        signature = dark[:-2] & red[1:-1] & red[2:]
+        counts = np.count_nonzero(signature, axis=1)
+        y = int(np.argmax(counts))
+        if counts[y] * self.COLUMN_STEP < self.MIN_WIDTH:
+            return None
+        return y
+
+    @classmethod
+    def find_red_under_dark(cls, dark_top, red_bottom):
+        """The first and last red column of the dark run (the AT's top) with the most red under it."""
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], dark_top.view(np.int8), [0]))))
+        runs = []
+        for start, end in zip(edges[::2].tolist(), edges[1::2].tolist()):
+            if runs and start - runs[-1][1] <= cls.MAX_BAR_WIDTH:
+                runs[-1][1] = end  # only split by the bar
+            else:
+                runs.append([start, end])
+        best, best_count = (0, -1), 0
+        for start, end in runs:
+            red_xs = np.flatnonzero(red_bottom[start:end])
+            if red_xs.size > best_count:
+                best, best_count = (start + int(red_xs[0]), start + int(red_xs[-1])), red_xs.size
+        return best
+
+    @staticmethod
+    def is_dark(bgra):
+        return (bgra[..., 0] < 50) & (bgra[..., 1] < 50) & (bgra[..., 2] < 50)  # Colour.is_dark
+
+    @staticmethod
+    def is_colour_red(bgra):
+        return (bgra[..., 2] >= 145) & (bgra[..., 1] <= 35) & (bgra[..., 0] <= 35)  # Colour.is_colour_red
+
+    def is_at_there(self, img, location):
+        """Checks the found strip the same way the reader checks for an AT."""
+        x_left, y_top, x_right, y_bottom = bbox = ATReader.construct_bbox(*location)
+        bgra = np.frombuffer(img.raw, dtype=np.uint8).reshape(img.size.height, img.size.width, 4)
+        strip = bgra[y_top:y_bottom, x_left:x_right]
+        strip_img = ScreenShot.from_size(bytearray(strip.tobytes()), x_right - x_left, y_bottom - y_top)
+        return ATReader(bbox, self.frame_source).contains_at(strip_img)
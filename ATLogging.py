@@ -1,18 +1,28 @@
+from array import array
+import mmap
 import os
+import re
+import struct
+import sys
 import time
+from ATReading import ActionTest, ATResult
 
 
 class ATLogger:
-    VERSION = 1.2
+    VERSION = 1.3
     DATA_FOLDER_NAME = "Data"
 
-    def __init__(self, log_short=False, filename="ATs.log"):
+    def __init__(self, log_short=False, filename="ATs.log", writer=None):
         self.log_short = log_short
         self.filepath = self.DATA_FOLDER_NAME + "/" + filename
         if not self.does_file_exist():
             self.make_data_folder()
             self.make_new_file()
-        self.file = open(self.filepath, "a")
+        self.writer = writer
+        self.file = self.open_file() if writer is None else None
+
+    def open_file(self):
+        return open(self.filepath, "a")
 
     def log_at(self, action_test):
         self.write_to_file(action_test.get_log_line(self.log_short) + "\n")
@@ -20,10 +30,13 @@ class ATLogger:
     def log_new_session(self, used_bbox):
         date = time.strftime("%d. %m. %Y %H:%M")
         pixel_width = used_bbox[2] - used_bbox[0]
-        line = f"---New Session (v{self.VERSION}) ({date}) ({pixel_width} pixels wide)\n"
-        self.write_to_file(line)
+        line = TextLogFormat.get_session_line(self.VERSION, date, pixel_width)
+        self.write_to_file(line + "\n")
 
     def write_to_file(self, text):
+        if self.writer is not None:
+            self.writer.append(self.filepath, text)
+            return
         self.file.write(text)
         self.file.flush()
 
@@ -37,3 +50,323 @@ class ATLogger:
 
     def make_new_file(self):
         open(self.filepath, "w").close()
+
+
+class BinaryATLogger(ATLogger):
+    """Logs to a binary file (see BinaryLogFormat) next to where the text log would be.
+
+    Session starts also go to a sidecar index file, so sessions can be found without scanning."""
+    EXTENSION = ".bin"
+    INDEX_EXTENSION = ".idx"
+
+    def __init__(self, log_short=False, filename="ATs.log", writer=None):
+        super().__init__(log_short, filename + self.EXTENSION, writer)
+        self.index_filepath = self.filepath + self.INDEX_EXTENSION
+        self.size = os.path.getsize(self.filepath)  # where the next record starts
+
+    def open_file(self):
+        return open(self.filepath, "ab")
+
+    def make_new_file(self):
+        with open(self.filepath, "wb") as file:
+            file.write(BinaryLogFormat.MAGIC)
+        open(self.filepath + self.INDEX_EXTENSION, "wb").close()
+
+    def log_at(self, action_test):
+        self.write_to_file(BinaryLogFormat.pack_at(action_test, self.log_short))
+
+    def log_new_session(self, used_bbox):
+        date = time.strftime("%d. %m. %Y %H:%M")
+        pixel_width = used_bbox[2] - used_bbox[0]
+        self.write_to_index(BinaryLogFormat.INDEX_ENTRY.pack(self.size))
+        self.write_to_file(BinaryLogFormat.pack_session(str(self.VERSION), date, pixel_width))
+
+    def write_to_file(self, data):
+        self.size += len(data)
+        super().write_to_file(data)
+
+    def write_to_index(self, data):
+        if self.writer is not None:
+            self.writer.append(self.index_filepath, data)
+            return
+        with open(self.index_filepath, "ab") as file:
+            file.write(data)
+
+
+class LogEntry:
+    # kinds of entries a log consists of
+    SESSION = 0  # data: (version, date, pixel width)
+    AT = 1  # data: (action test, whether logged short)
+    TEXT = 2  # data: a line that isn't either of the above
+
+
+class TextLogFormat:
+    SESSION_PATTERN = re.compile(r"---New Session \(v(.*?)\) \((.*?)\) \((\d+) pixels wide\)$")
+    AT_PATTERN = re.compile(r"(\w+) (\S+) (\S+)-(\S+) (\[[\d, ]*\]|\S+) (\S+) (\S+)(?: ([+-][\d.]+)\+-([\d.]+)ms(?: ([+-][\d.]+)/([+-][\d.]+)ms)?)?$")
+
+    @staticmethod
+    def get_session_line(version, date, pixel_width):
+        return f"---New Session (v{version}) ({date}) ({pixel_width} pixels wide)"
+
+    @classmethod
+    def parse_line(cls, line):
+        """Returns (kind, data) – see LogEntry."""
+        line = line.rstrip("\n")
+        match = cls.SESSION_PATTERN.match(line)
+        if match:
+            version, date, pixel_width = match.groups()
+            return LogEntry.SESSION, (version, date, int(pixel_width))
+        match = cls.AT_PATTERN.match(line)
+        if match:
+            try:
+                action_test, log_short = cls.parse_at(match.groups())
+            except (ValueError, OverflowError):  # e.g. a position too big for the array
+                return LogEntry.TEXT, line
+            return LogEntry.AT, (action_test, log_short)
+        return LogEntry.TEXT, line
+
+    @classmethod
+    def parse_at(cls, fields):
+        (result_name, green, white_start, white_end, bar_positions, still_frames, cps,
+         offset, uncertainty, white_start_offset, white_end_offset) = fields
+        action_test = ActionTest()
+        action_test.result = ATResult.names.index(result_name)
+        action_test.green_position = cls.parse_optional(green, int)
+        action_test.white_positions = [cls.parse_optional(white_start, int), cls.parse_optional(white_end, int)]
+        action_test.still_frames = cls.parse_optional(still_frames, int)
+        action_test.captures_per_second = cls.parse_optional(cps, float)
+        if offset is not None:  # since v1.3
+            action_test.press_offset, action_test.press_uncertainty = float(offset), float(uncertainty)
+        if white_start_offset is not None:
+            action_test.white_offsets = [float(white_start_offset), float(white_end_offset)]
+        log_short = not bar_positions.startswith("[")
+        if not log_short:
+            action_test.bar_positions = array("H", [int(x) for x in bar_positions[1:-1].split(",") if x.strip()])
+        elif bar_positions != "?":
+            action_test.bar_positions.append(int(bar_positions))  # only the last one is known
+        return action_test, log_short
+
+    @staticmethod
+    def parse_optional(text, data_type):
+        return None if text == "None" else data_type(text)
+
+    @classmethod
+    def read_entries(cls, filepath):
+        with open(filepath, "r") as file:
+            for line in file:
+                yield cls.parse_line(line)
+
+    @classmethod
+    def format_entry(cls, kind, data):
+        if kind == LogEntry.SESSION:
+            return cls.get_session_line(*data)
+        if kind == LogEntry.AT:
+            action_test, log_short = data
+            return action_test.get_log_line(log_short)
+        return data
+
+
+class BinaryLogFormat:
+    """A magic header, then records. An AT record is a fixed-size AT_RECORD followed by
+    its bar positions (array 'H') and capture times in perf_counter_ns (array 'q'),
+    then its PRESS_TIMING if it has the HAS_PRESS_TIMING flag and its WHITE_TIMING if it has
+    the HAS_WHITE_TIMING flag.
+    Session records have the session header's version and date as UTF-8 after them,
+    text records (anything else found in a converted text log) their line."""
+    MAGIC = b"ATLOGB01"
+    # kind, flags, result, green, white start, white end, still frames, captures per second,
+    # number of bar positions, number of capture times
+    AT_RECORD = struct.Struct("<BBBhhhIdII")
+    SESSION_RECORD = struct.Struct("<BIBB")  # kind, pixel width, version length, date length
+    TEXT_RECORD = struct.Struct("<BI")  # kind, length
+    INDEX_ENTRY = struct.Struct("<Q")  # offset of a session record
+    PRESS_TIMING = struct.Struct("<dd")  # press offset, press uncertainty
+    WHITE_TIMING = struct.Struct("<dd")  # offsets from the white section's start and end
+    NONE_POSITION = -1
+    # flags
+    SHORT = 1
+    NO_STILL_FRAMES = 2
+    NO_CAPTURES_PER_SECOND = 4
+    HAS_PRESS_TIMING = 8  # since v1.3
+    HAS_WHITE_TIMING = 16
+
+    @classmethod
+    def pack_at(cls, action_test, log_short):
+        bar_positions = action_test.bar_positions
+        if log_short:
+            bar_positions = bar_positions[-1:]
+        bar_times = action_test.bar_times[-len(bar_positions):] if bar_positions else array("q")
+        flags = cls.SHORT if log_short else 0
+        if action_test.still_frames is None:
+            flags |= cls.NO_STILL_FRAMES
+        if action_test.captures_per_second is None:
+            flags |= cls.NO_CAPTURES_PER_SECOND
+        press_timing = b""
+        if action_test.press_offset is not None:
+            flags |= cls.HAS_PRESS_TIMING
+            press_timing = cls.PRESS_TIMING.pack(action_test.press_offset, action_test.press_uncertainty)
+        if action_test.white_offsets is not None:
+            flags |= cls.HAS_WHITE_TIMING
+            press_timing += cls.WHITE_TIMING.pack(*action_test.white_offsets)
+        white_start, white_end = action_test.white_positions
+        header = cls.AT_RECORD.pack(LogEntry.AT, flags, action_test.result,
+                                    cls.pack_position(action_test.green_position),
+                                    cls.pack_position(white_start), cls.pack_position(white_end),
+                                    action_test.still_frames or 0, action_test.captures_per_second or 0.,
+                                    len(bar_positions), len(bar_times))
+        return header + bar_positions.tobytes() + bar_times.tobytes() + press_timing
+
+    @classmethod
+    def pack_position(cls, position):
+        return cls.NONE_POSITION if position is None else position
+
+    @classmethod
+    def unpack_position(cls, position):
+        return None if position == cls.NONE_POSITION else position
+
+    @classmethod
+    def pack_session(cls, version, date, pixel_width):
+        version, date = version.encode(), date.encode()
+        return cls.SESSION_RECORD.pack(LogEntry.SESSION, pixel_width, len(version), len(date)) + version + date
+
+    @classmethod
+    def pack_text(cls, line):
+        line = line.encode()
+        return cls.TEXT_RECORD.pack(LogEntry.TEXT, len(line)) + line
+
+    @classmethod
+    def pack_entry(cls, kind, data):
+        if kind == LogEntry.SESSION:
+            version, date, pixel_width = data
+            return cls.pack_session(version, date, pixel_width)
+        if kind == LogEntry.AT:
+            return cls.pack_at(*data)
+        return cls.pack_text(data)
+
+    @classmethod
+    def unpack_entry(cls, buffer, offset):
+        """Returns (kind, data, offset of the next record)."""
+        kind = buffer[offset]
+        if kind == LogEntry.SESSION:
+            _, pixel_width, version_length, date_length = cls.SESSION_RECORD.unpack_from(buffer, offset)
+            start = offset + cls.SESSION_RECORD.size
+            version = bytes(buffer[start:start + version_length]).decode()
+            date = bytes(buffer[start + version_length:start + version_length + date_length]).decode()
+            return kind, (version, date, pixel_width), start + version_length + date_length
+        if kind == LogEntry.TEXT:
+            _, length = cls.TEXT_RECORD.unpack_from(buffer, offset)
+            start = offset + cls.TEXT_RECORD.size
+            return kind, bytes(buffer[start:start + length]).decode(), start + length
+        return cls.unpack_at(buffer, offset)
+
+    @classmethod
+    def unpack_at(cls, buffer, offset):
+        (kind, flags, result, green, white_start, white_end, still_frames, cps,
+         bar_count, time_count) = cls.AT_RECORD.unpack_from(buffer, offset)
+        action_test = ActionTest()
+        action_test.result = result
+        action_test.green_position = cls.unpack_position(green)
+        action_test.white_positions = [cls.unpack_position(white_start), cls.unpack_position(white_end)]
+        action_test.still_frames = None if flags & cls.NO_STILL_FRAMES else still_frames
+        action_test.captures_per_second = None if flags & cls.NO_CAPTURES_PER_SECOND else cps
+        start = offset + cls.AT_RECORD.size
+        times_start = start + bar_count * 2
+        end = times_start + time_count * 8
+        action_test.bar_positions.frombytes(buffer[start:times_start])
+        action_test.bar_times.frombytes(buffer[times_start:end])
+        if flags & cls.HAS_PRESS_TIMING:
+            action_test.press_offset, action_test.press_uncertainty = cls.PRESS_TIMING.unpack_from(buffer, end)
+            end += cls.PRESS_TIMING.size
+        if flags & cls.HAS_WHITE_TIMING:
+            action_test.white_offsets = list(cls.WHITE_TIMING.unpack_from(buffer, end))
+            end += cls.WHITE_TIMING.size
+        return kind, (action_test, bool(flags & cls.SHORT)), end
+
+
+class BinaryLogReader:
+    """Reads a binary log through a memory map."""
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.file = open(filepath, "rb")
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.buffer[:len(BinaryLogFormat.MAGIC)] != BinaryLogFormat.MAGIC:
+            self.close()
+            raise ValueError(f"{filepath} isn't a binary AT log")
+
+    def read_entries(self, offset=len(BinaryLogFormat.MAGIC), stop_at_next_session=False):
+        size = len(self.buffer)
+        first_offset = offset
+        while offset < size:
+            kind, data, next_offset = BinaryLogFormat.unpack_entry(self.buffer, offset)
+            if stop_at_next_session and kind == LogEntry.SESSION and offset != first_offset:
+                return
+            yield kind, data
+            offset = next_offset
+
+    def get_session_offsets(self):
+        index_filepath = self.filepath + BinaryATLogger.INDEX_EXTENSION
+        if not os.path.isfile(index_filepath):
+            return self.find_session_offsets()
+        with open(index_filepath, "rb") as file:
+            data = file.read()
+        entry_size = BinaryLogFormat.INDEX_ENTRY.size
+        usable_size = len(data) - len(data) % entry_size
+        return [offset for (offset,) in BinaryLogFormat.INDEX_ENTRY.iter_unpack(data[:usable_size])]
+
+    def find_session_offsets(self):
+        offsets = []
+        offset = len(BinaryLogFormat.MAGIC)
+        while offset < len(self.buffer):
+            kind, data, next_offset = BinaryLogFormat.unpack_entry(self.buffer, offset)
+            if kind == LogEntry.SESSION:
+                offsets.append(offset)
+            offset = next_offset
+        return offsets
+
+    def read_session(self, index):
+        offset = self.get_session_offsets()[index]
+        return self.read_entries(offset, stop_at_next_session=True)
+
+    def close(self):
+        self.buffer.close()
+        self.file.close()
+
+
+def convert_text_to_binary(text_filepath, binary_filepath):
+    offset = len(BinaryLogFormat.MAGIC)
+    with open(binary_filepath, "wb") as binary_file, \
+            open(binary_filepath + BinaryATLogger.INDEX_EXTENSION, "wb") as index_file:
+        binary_file.write(BinaryLogFormat.MAGIC)
+        with open(text_filepath, "r") as text_file:
+            for line in text_file:
+                line = line.rstrip("\n")
+                kind, data = TextLogFormat.parse_line(line)
+                if TextLogFormat.format_entry(kind, data) != line:
+                    kind, data = LogEntry.TEXT, line  # keep anything that wouldn't come back the same
+                try:
+                    record = BinaryLogFormat.pack_entry(kind, data)
+                except (ValueError, OverflowError, struct.error):  # e.g. a number too big for its field
+                    kind, data = LogEntry.TEXT, line
+                    record = BinaryLogFormat.pack_entry(kind, data)
+                if kind == LogEntry.SESSION:
+                    index_file.write(BinaryLogFormat.INDEX_ENTRY.pack(offset))
+                binary_file.write(record)
+                offset += len(record)
+
+
+def convert_binary_to_text(binary_filepath, text_filepath):
+    reader = BinaryLogReader(binary_filepath)
+    with open(text_filepath, "w") as text_file:
+        for kind, data in reader.read_entries():
+            text_file.write(TextLogFormat.format_entry(kind, data) + "\n")
+    reader.close()
+
+
+if __name__ == "__main__":
+    # python ATLogging.py to-binary|to-text <from file> <to file>
+    conversions = {"to-binary": convert_text_to_binary, "to-text": convert_binary_to_text}
+    if len(sys.argv) != 4 or sys.argv[1] not in conversions:
+        print("Usage: ATLogging.py to-binary|to-text <from file> <to file>")
+    else:
+        conversions[sys.argv[1]](sys.argv[2], sys.argv[3])
@@ -0,0 +1,205 @@
+from bisect import bisect_left
+import cProfile
+import heapq
+import os
+import pstats
+import sys
+import time
+import tracemalloc
+from ATCapturing import FrameSource
+
+
+class PhaseHistogram:
+    """Counts values into fixed buckets, like a Prometheus histogram – adding one is a bisect."""
+    SECONDS_BUCKETS = [.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5.]
+
+    def __init__(self, buckets=SECONDS_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.
+        self.count = 0
+
+    def add(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def get_cumulative_counts(self):
+        total = 0
+        for count in self.counts:
+            total += count
+            yield total
+
+
+class PhaseMetrics:
+    """What one phase took, summed up over all ATs."""
+
+    def __init__(self):
+        self.wall = PhaseHistogram()
+        self.cpu = PhaseHistogram()
+        self.grabs = 0
+        self.allocated_blocks = 0  # net, so it can go down too
+
+    def add(self, wall_seconds, cpu_seconds, grabs, allocated_blocks):
+        self.wall.add(wall_seconds)
+        self.cpu.add(cpu_seconds)
+        self.grabs += grabs
+        self.allocated_blocks += allocated_blocks
+
+
+class CountingFrameSource(FrameSource):
+    """Passes everything through to another source, counting the grabs for the profiler."""
+
+    def __init__(self, source):
+        self.source = source
+        self.grabs = 0
+
+    def timestamped_grab(self, bbox):
+        self.grabs += 1
+        return self.source.timestamped_grab(bbox)
+
+    def grab(self, bbox):
+        self.grabs += 1
+        return self.source.grab(bbox)
+
+    def sleep(self, seconds):
+        self.source.sleep(seconds)
+
+    def change_bbox(self, bbox):
+        self.source.change_bbox(bbox)
+
+    def take_statistics(self):
+        return self.source.take_statistics()
+
+    def close(self):
+        self.source.close()
+
+
+class PhaseProfiler:
+    """Measures wall time, CPU time (of the reading thread), grabs and the net change in
+    allocated memory blocks for every phase of reading an AT and for the whole AT, and exports
+    them in the Prometheus text format. Readers and Practise only call it if they have one, so it costs nothing when off.
+
+    With keep_slowest, every AT also runs under cProfile and tracemalloc – much slower –
+    and the profiles of the slowest ones get saved when closing."""
+    AT = "at"  # the phase name for the whole AT, processing included
+    AT_START_PHASE = "settling"  # an AT counts from here, waiting for it to show up isn't it being slow
+    TOP_ALLOCATIONS = 25  # lines of the allocation report
+
+    def __init__(self, keep_slowest=0, folder=None):
+        self.phases = {}  # name: PhaseMetrics
+        self.frame_source = None  # the CountingFrameSource made by wrap()
+        self.keep_slowest = keep_slowest
+        self.folder = folder
+        self.slowest = []  # heap of (wall seconds, AT number, profile, allocation lines)
+        self.at_profile = None
+        self.at_start = None
+        if keep_slowest:
+            tracemalloc.start()
+
+    def wrap(self, frame_source):
+        self.frame_source = CountingFrameSource(frame_source)
+        return self.frame_source
+
+    def take_sample(self):
+        grabs = self.frame_source.grabs if self.frame_source is not None else 0
+        return time.perf_counter_ns(), time.thread_time_ns(), grabs, sys.getallocatedblocks()
+
+    def add(self, phase, start, end):
+        metrics = self.phases.get(phase)
+        if metrics is None:
+            metrics = self.phases[phase] = PhaseMetrics()
+        metrics.add((end[0] - start[0]) / 1e9, (end[1] - start[1]) / 1e9, end[2] - start[2], end[3] - start[3])
+
+    def run_phase(self, phase, function, *args):
+        if phase == self.AT_START_PHASE:
+            self.start_at()  # again if the AT went away while settling
+        start = self.take_sample()
+        result = function(*args)
+        self.add(phase, start, self.take_sample())
+        return result
+
+    def start_at(self):
+        if self.at_profile is not None:
+            self.at_profile.disable()
+        if self.keep_slowest:
+            tracemalloc.clear_traces()
+            self.at_profile = cProfile.Profile()
+            self.at_profile.enable()
+        self.at_start = self.take_sample()
+
+    def finish_at(self, at_number):
+        if self.at_start is None:
+            return
+        end = self.take_sample()
+        if self.at_profile is not None:
+            self.at_profile.disable()
+        self.add(self.AT, self.at_start, end)
+        if self.at_profile is not None:
+            self.keep_if_slow((end[0] - self.at_start[0]) / 1e9, at_number)
+            self.at_profile = None
+        self.at_start = None
+
+    def keep_if_slow(self, wall_seconds, at_number):
+        if len(self.slowest) == self.keep_slowest and wall_seconds <= self.slowest[0][0]:
+            return
+        # only snapshot the ATs that get kept, it's slow
+        statistics = tracemalloc.take_snapshot().statistics("lineno")[:self.TOP_ALLOCATIONS]
+        allocations = [str(statistic) for statistic in statistics]
+        entry = (wall_seconds, at_number, self.at_profile, allocations)
+        if len(self.slowest) < self.keep_slowest:
+            heapq.heappush(self.slowest, entry)
+        else:
+            heapq.heapreplace(self.slowest, entry)
+
+    def save_slowest(self):
+        """Saves a .prof (for pstats or snakeviz) and the top allocations per kept AT."""
+        if not self.slowest:
+            return []
+        os.makedirs(self.folder, exist_ok=True)
+        filepaths = []
+        for wall_seconds, at_number, profile, allocations in sorted(self.slowest, reverse=True):
+            filepath = f"{self.folder}/AT{at_number}_{round(wall_seconds * 1000)}ms"
+            pstats.Stats(profile).dump_stats(filepath + ".prof")
+            with open(filepath + "_allocations.txt", "w") as file:
+                file.write("\n".join(allocations) + "\n")
+            filepaths.append(filepath)
+        return filepaths
+
+    def close(self):
+        filepaths = self.save_slowest()
+        if self.keep_slowest:
+            tracemalloc.stop()
+        if filepaths:
+            print(f"Profiles of the {len(filepaths)} slowest ATs saved to {self.folder}")
+
+    def get_metrics_text(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        self.add_histograms(lines, "at_phase_wall_seconds", "Wall time per phase of reading an AT.",
+                            lambda metrics: metrics.wall)
+        self.add_histograms(lines, "at_phase_cpu_seconds", "CPU time of the reading thread per phase.",
+                            lambda metrics: metrics.cpu)
+        self.add_values(lines, "at_phase_grabs_total", "counter", "Frames grabbed per phase.",
+                        lambda metrics: metrics.grabs)
+        self.add_values(lines, "at_phase_allocated_blocks_net", "gauge",
+                        "Change in allocated memory blocks per phase (allocated minus freed, can be negative).",
+                        lambda metrics: metrics.allocated_blocks)
+        return "\n".join(lines) + "\n"
+
+    def add_histograms(self, lines, name, description, get_histogram):
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} histogram")
+        for phase, metrics in self.phases.items():
+            histogram = get_histogram(metrics)
+            bounds = [str(bound) for bound in histogram.buckets] + ["+Inf"]
+            for bound, count in zip(bounds, histogram.get_cumulative_counts()):
+                lines.append(f'{name}_bucket{{phase="{phase}",le="{bound}"}} {count}')
+            lines.append(f'{name}_sum{{phase="{phase}"}} {histogram.sum:.9f}')
+            lines.append(f'{name}_count{{phase="{phase}"}} {histogram.count}')
+
+    def add_values(self, lines, name, metric_type, description, get_value):
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for phase, metrics in self.phases.items():
+            lines.append(f'{name}{{phase="{phase}"}} {get_value(metrics)}')
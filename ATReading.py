@@ -1,55 +1,199 @@
-from mss import mss
 import mss.tools as mss_tools
+from mss.screenshot import ScreenShot
+from ATCapturing import LiveFrameSource, PollingScheduler
+from array import array
+import inspect
+import math
+import os
 import time
+import zlib
+try:
+    import numpy as np
+except ImportError:  # optional – the per-pixel reader works without it
+    np = None
 
 # KNOWN ISSUES:
 # - canceled ATs get read as white
 # - difficult prints are broken
 # - redding very early is broken
-# - ATs *right* after each other might not get registered
+# - a new AT replacing the last one without it disappearing in between is only noticed
+#   once its bar shows, unless its white section is elsewhere
 
 
 class ATReader:
+    EDGE_WIDTH = 2  # pixel columns at each side that the edge phases look at
+    BYTES_PER_PIXEL = 4
+    # the phases move on when the frames show it's time, these are only the limits
+    SETTLE_TIME = .005  # the sections must read the same in frames at least this far apart
+    MAX_SETTLE_TIME = .0275  # read them anyway after this, like the fixed wait used to
+    RESULT_TIMEOUT = .02  # no red or green by then after the bar is gone means white
+    PHASE_METHODS = {"idle": "wait_for_last_at_to_go", "loading": "wait_to_load_up",
+                     "settling": "wait_for_sections_to_settle", "watching": "watch_bar",
+                     "resolving": "evaluate_result"}
+
     @staticmethod
     def construct_bbox(x_left, x_right, y_top):
         return (x_left, y_top - 2, x_right + 1, y_top + 1)
 
-    def __init__(self, bbox):
+    @staticmethod
+    def get_location(bbox):  # the other way round
+        return bbox[0], bbox[2] - 1, bbox[3] - 1
+
+    def __init__(self, bbox, frame_source=None, writer=None, use_regions=False, scheduler=None,
+                 flight_recorder=None, locator=None):
         self.bbox = bbox
+        self.frame_source = frame_source or LiveFrameSource()
+        self.writer = writer  # images get saved right away if None
+        self.use_regions = use_regions  # only grab what each phase needs
+        self.scheduler = scheduler or PollingScheduler(sleep=self.frame_source.sleep)
+        self.flight_recorder = flight_recorder  # a FlightRecorder the frame source passes through
+        self.locator = locator  # an ATLocator to look for the AT elsewhere when it doesn't show up
+        self.colour_table = None  # a ColourTable, if the reader can use one
+        self.watch_interval = None  # seconds between captures of the bar, flat out if None
+        self.profiler = None  # a PhaseProfiler to measure every phase with
+        self.archiver = None  # a FrameArchiver the frame source passes through, to tag frames by AT
+        self.name = None  # printed with every AT when reading several at once
+        self.last_result_filename = "lastResult.png"
         self.current_at = None
+        self.last_at = None
+        self.at_number = 0
+        self.phase = ATPhase.LOADING
+        self.reporting_problems = True
 
     def read_at(self):
+        """Goes through the phases until an AT's result is known. Each phase reads frames until
+        they show the next one has started and returns it: idle (the last AT still showing)
+        → loading → settling → watching → resolving → idle again, for the next call."""
         self.setup_new_at()
-        self.wait_to_load_up()
-        self.locate_sections()
-        self.watch_bar()
-        self.evaluate_result()
-        self.current_at.print()
+        while True:
+            phase = self.phase
+            run_phase = getattr(self, self.PHASE_METHODS[phase])
+            if self.profiler is None:
+                self.phase = run_phase()
+            else:
+                self.phase = self.profiler.run_phase(phase, run_phase)
+            if phase == ATPhase.RESOLVING:
+                break
+        self.current_at.print(self.name)
         return self.current_at
 
     def setup_new_at(self):
+        self.last_at = self.current_at
         self.current_at = ActionTest()
+        self.at_number += 1
+        if self.archiver is not None:
+            self.archiver.start_at(self.at_number)
+        # no discarding old frames – a buffering source keeps what was captured while
+        # the last AT got processed, so one following right after isn't missed
+
+    def wait_for_last_at_to_go(self):
+        while True:
+            timestamp, img = self.frame_source.timestamped_grab(self.bbox)
+            if not self.contains_at(img) or self.has_at_changed(img):
+                return ATPhase.LOADING
+            self.scheduler.wait_while_showing()
+
+    def has_at_changed(self, img):
+        """Whether a new AT is showing where the last one's result was."""
+        if self.is_result_red(img) or self.is_result_green(img):
+            return False
+        if self.find_bar(img, 0) is not False:
+            return True  # the last one's bar was gone before its result
+        self.reporting_problems = False  # a fading AT isn't a problem
+        try:
+            green_pos, white_pos = self.find_sections(img)
+        finally:
+            self.reporting_problems = True
+        # the white section reads the most reliably
+        return white_pos != self.last_at.white_positions
 
     def wait_to_load_up(self):
-        attempts = 0
-        with mss() as sct:
-            while True:
-                img = sct.grab(self.bbox)
-                if self.contains_at(img):
-                    time.sleep(.0275)  # a tiny bit for the green to settle
-                    return attempts
-                attempts += 1
+        wait_frame_times = self.current_at.wait_frame_times
+        self.scheduler.start_waiting()
+        locate_time = None  # of the last search for the AT elsewhere
+        while True:
+            timestamp, img = self.grab_edges()
+            wait_frame_times.append(timestamp)
+            detection_delay = self.scheduler.on_grab(timestamp)
+            if self.contains_at(img):
+                self.scheduler.finish_waiting(detection_delay)
+                self.current_at.detection_delay = detection_delay
+                return ATPhase.SETTLING
+            if locate_time is None:
+                locate_time = timestamp
+            # armed, the AT is probably about to show where it is
+            if (self.locator is not None and self.scheduler.mode == self.scheduler.IDLE
+                    and timestamp - locate_time >= self.locator.LOCATE_INTERVAL * 1e9):
+                self.relocate()
+                locate_time = timestamp
+            self.scheduler.wait_after_miss(self.is_at_appearing(img))
+
+    def relocate(self):
+        location = self.locator.locate()
+        if location is None:
+            return
+        bbox = self.construct_bbox(*location)
+        if bbox != self.bbox:
+            print(f"-AT found somewhere else: {location[0]}-{location[1]}, {location[2]}")
+            self.change_bbox(bbox)
+
+    def change_bbox(self, bbox):
+        self.bbox = bbox
+        self.frame_source.change_bbox(bbox)
+
+    def is_at_showing_at(self, location):
+        """Whether an AT shows at (x left, x right, y top), e.g. a remembered location."""
+        return self.contains_at(self.frame_source.grab(self.construct_bbox(*location)))
 
     def contains_at(self, img):
+        return self.is_edge_red(img) and self.is_top_row_dark(img)
+
+    def is_at_appearing(self, img):
+        return self.is_edge_red(img) or self.is_top_row_dark(img)
+
+    def is_edge_red(self, img):
         x_right = img.size.width - 1
         # check the pixels NEXT to the border (border can be darker)
         is_left_red = Colour.is_colour_red(img.pixel(1, 2))
         is_right_red = Colour.is_colour_red(img.pixel(x_right - 1, 2))
-        is_top_row_dark = self.is_top_row_dark(img)
-        return (is_left_red or is_right_red) and is_top_row_dark
+        return is_left_red or is_right_red
+
+    def wait_for_sections_to_settle(self):
+        """The green can take a moment to show – it's settled once frames SETTLE_TIME apart
+        agree on where all sections are."""
+        start_time, sections = None, None
+        self.reporting_problems = False  # only for the frame finally read
+        try:
+            while True:
+                timestamp, img = self.frame_source.timestamped_grab(self.bbox)
+                if not self.contains_at(img):
+                    return ATPhase.LOADING  # gone again, or wasn't an AT
+                if start_time is None:
+                    start_time, sections_time = timestamp, timestamp
+                new_sections = self.find_sections(img)
+                if new_sections != sections:
+                    sections, sections_time = new_sections, timestamp
+                elif timestamp - sections_time >= self.SETTLE_TIME * 1e9 and self.are_sections_complete(sections):
+                    break
+                if timestamp - start_time >= self.MAX_SETTLE_TIME * 1e9:
+                    break
+        finally:
+            self.reporting_problems = True
+        self.locate_sections(img)
+        return ATPhase.WATCHING
+
+    @staticmethod
+    def are_sections_complete(sections):
+        green_pos, white_pos = sections
+        return green_pos is not None and None not in white_pos
+
+    def locate_sections(self, img):
+        green_pos, white_pos = self.find_sections(img)
+        self.current_at.green_position = green_pos
+        self.current_at.white_positions = white_pos
+        self.inform_user_if_locating_failed(img)
 
-    def locate_sections(self):  # would use refactoring
-        img = mss().grab(self.bbox)
+    def find_sections(self, img):  # would use refactoring
         green_pos = None
         white_pos = [None, None]  # start and end
         for x in range(img.size.width):
@@ -71,9 +215,7 @@ class ATReader:
         # cover the edge case where the end of an AT is white
         if white_pos[1] is None and white_pos[0] is not None:
             white_pos[1] = img.size.width - 1
-        self.current_at.green_position = green_pos
-        self.current_at.white_positions = white_pos
-        self.inform_user_if_locating_failed(img)
+        return green_pos, white_pos
 
     def determine_section_in_column(self, img, x):
         rgb_middle = img.pixel(x, 1)
@@ -107,32 +249,96 @@ class ATReader:
             self.inform_user_about_problem("whiteNotFound", img)
 
     def inform_user_about_problem(self, image_name, img):
-        print("---Problem: " + image_name + ".png")
-        mss_tools.to_png(img.rgb, img.size, output=(image_name + ".png"))
+        if not self.reporting_problems:
+            return
+        if self.flight_recorder is None:
+            print("---Problem: " + image_name + ".png")
+            self.save_image(img, image_name + ".png")
+            return
+        filepath = self.flight_recorder.report_problem(image_name, self.at_number, img)
+        saved = f" (frames saved to {filepath})" if filepath is not None else ""
+        print(f"---Problem: {image_name}{saved}")
+
+    def save_image(self, img, filepath):
+        if self.writer is None:
+            mss_tools.to_png(img.rgb, img.size, output=filepath)
+        else:  # the PNG gets encoded on the writer thread
+            self.writer.replace(filepath, lambda: mss_tools.to_png(img.rgb, img.size))
 
     def watch_bar(self):
         last_x = 0
         still_frames = 0
-        bar_positions = []
-        start_time = time.time()
-        with mss() as sct:
-            while True:
-                img = sct.grab(self.bbox)
-                new_x = self.find_bar(img, last_x)
-                if new_x is False:
-                    # couldn't find – done!
-                    break
-                if new_x == last_x:
-                    # same frame
-                    still_frames += 1
-                    continue
-                last_x = new_x
-                bar_positions.append(last_x)
-        time_took = time.time() - start_time
-        captures = len(bar_positions) + still_frames + 1  # +1 for when not found
+        identical_frames = 0
+        previous_row, compared_x = None, 0
+        # the bar only moves right, so there can't be more positions than pixels
+        width = self.bbox[2] - self.bbox[0]
+        bar_positions = array("H", [0]) * width
+        bar_times = array("q", [0]) * width  # when each bar position was captured
+        bar_count = 0
+        frame_times = self.current_at.frame_times
+        start_time = time.perf_counter()
+        grab_time = None
+        self.frame_source.take_statistics()  # only count frames from watching
+        while True:
+            if self.watch_interval is not None and grab_time is not None:
+                # the motion model makes up for the captures in between
+                self.frame_source.sleep(max(0., self.watch_interval - (time.perf_counter() - grab_time)))
+            grab_time = time.perf_counter()
+            timestamp, img, x_offset = self.grab_bar_region(compared_x)
+            frame_times.append(timestamp)
+            # find_bar only reads the top row from where it started last time,
+            # so if that part is unchanged, so is the bar
+            if self.get_top_row_from(img, compared_x - x_offset) == previous_row:
+                identical_frames += 1
+                still_frames += 1
+                continue
+            previous_row = self.get_top_row_from(img, last_x - x_offset)
+            compared_x = last_x
+            new_x = self.find_bar(img, last_x - x_offset)
+            if new_x is False:
+                # couldn't find – done!
+                break
+            new_x += x_offset
+            if new_x == last_x:
+                # same frame
+                still_frames += 1
+                continue
+            last_x = new_x
+            bar_positions[bar_count] = last_x
+            bar_times[bar_count] = timestamp
+            bar_count += 1
+        time_took = time.perf_counter() - start_time
+        del bar_positions[bar_count:], bar_times[bar_count:]
+        captures = bar_count + still_frames + 1  # +1 for when not found
         self.current_at.bar_positions = bar_positions
+        self.current_at.bar_times = bar_times
         self.current_at.still_frames = still_frames
+        self.current_at.unique_frames = captures - identical_frames
         self.current_at.captures_per_second = round(captures / time_took, 2)
+        self.current_at.apply_bar_motion(BarMotion.fit(bar_positions, bar_times, timestamp))
+        self.apply_capture_statistics(self.frame_source.take_statistics())
+        return ATPhase.RESOLVING
+
+    def apply_capture_statistics(self, statistics):
+        if statistics is None:
+            return
+        self.current_at.dropped_frames = statistics["dropped"]
+        self.current_at.duplicate_frames = statistics["duplicates"]
+        self.current_at.max_ring_occupancy = statistics["max_occupancy"]
+
+    def grab_bar_region(self, start_x):
+        """Returns the timestamp, the image and the x in the strip the image starts at."""
+        if not self.use_regions:
+            timestamp, img = self.frame_source.timestamped_grab(self.bbox)
+            return timestamp, img, 0
+        # the bar only moves right, so the top row behind it is enough
+        x_left, y_top, x_right, y_bottom = self.bbox
+        timestamp, img = self.frame_source.timestamped_grab((x_left + start_x, y_top, x_right, y_top + 1))
+        return timestamp, img, start_x
+
+    def get_top_row_from(self, img, x):
+        # a view for comparing, no copy
+        return memoryview(img.raw)[x * self.BYTES_PER_PIXEL:img.size.width * self.BYTES_PER_PIXEL]
 
     def find_bar(self, img, minimum_x):
         width = img.size.width
@@ -143,13 +349,39 @@ class ATReader:
         return False
 
     def evaluate_result(self):
-        time.sleep(.02)  # wait a tiny bit for the colour to be clear
-        img = mss().grab(self.bbox)
-        mss_tools.to_png(img.rgb, img.size, output="lastResult.png")
-
-        is_red = self.is_result_red(img)
-        is_green = self.is_result_green(img)
+        frame_times = self.current_at.frame_times
+        bar_gone_time = frame_times[-1] if frame_times else None
+        while True:
+            timestamp, img = self.grab_edges()
+            is_red = self.is_result_red(img)
+            is_green = self.is_result_green(img)
+            if bar_gone_time is None:
+                bar_gone_time = timestamp
+            if is_red or is_green or timestamp - bar_gone_time >= self.RESULT_TIMEOUT * 1e9:
+                break
+        if self.use_regions:  # the edges alone would be a black strip
+            img = self.frame_source.grab(self.bbox)
+        self.save_image(img, self.last_result_filename)
         self.apply_result_with_red_green(is_red, is_green)
+        return ATPhase.IDLE
+
+    def grab_edges(self):
+        """Grabs the strip, or with use_regions just its edge columns, which is all that
+        contains_at and the result checks look at. The rest of the strip is left black."""
+        if not self.use_regions:
+            return self.frame_source.timestamped_grab(self.bbox)
+        x_left, y_top, x_right, y_bottom = self.bbox
+        width, height = x_right - x_left, y_bottom - y_top
+        timestamp, left = self.frame_source.timestamped_grab((x_left, y_top, x_left + self.EDGE_WIDTH, y_bottom))
+        right = self.frame_source.grab((x_right - self.EDGE_WIDTH, y_top, x_right, y_bottom))
+        row_bytes = width * self.BYTES_PER_PIXEL
+        edge_bytes = self.EDGE_WIDTH * self.BYTES_PER_PIXEL
+        raw = bytearray(row_bytes * height)
+        for y in range(height):
+            row_start, edge_start = y * row_bytes, y * edge_bytes
+            raw[row_start:row_start + edge_bytes] = left.raw[edge_start:edge_start + edge_bytes]
+            raw[row_start + row_bytes - edge_bytes:row_start + row_bytes] = right.raw[edge_start:edge_start + edge_bytes]
+        return timestamp, ScreenShot.from_size(raw, width, height)
 
     def is_top_row_dark(self, img):
         right_x = img.size.width - 1
@@ -180,18 +412,225 @@ class ATReader:
             self.current_at.result = ATResult.WHITE
 
 
+class RawATReader(ATReader):
+    """Reads the screenshot's raw BGRA bytes directly instead of img.pixel tuples.
+
+    Gives the same results as ATReader without allocating anything per pixel. Sections are
+    still found by ATReader's find_sections: checking columns in raw bytes takes three offsets
+    and a few calls each, which turned out slower than img.pixel."""
+
+    def __init__(self, bbox, frame_source=None, writer=None, use_regions=False, scheduler=None,
+                 flight_recorder=None, locator=None):
+        super().__init__(bbox, frame_source, writer, use_regions, scheduler, flight_recorder, locator)
+        self.row_offsets = None
+        self.row_offsets_size = None
+        self.buffer = None  # of the image being read
+
+    def get_buffer(self, img):
+        width, height = img.size.width, img.size.height
+        if (width, height) != self.row_offsets_size:
+            row_bytes = width * self.BYTES_PER_PIXEL
+            self.row_offsets = [y * row_bytes for y in range(height)]
+            self.row_offsets_size = (width, height)
+        self.buffer = memoryview(img.raw)
+        return self.buffer
+
+    def offset(self, x, y):
+        return self.row_offsets[y] + x * self.BYTES_PER_PIXEL
+
+    def is_edge_red(self, img):
+        buf = self.get_buffer(img)
+        x_right = img.size.width - 1
+        # check the pixels NEXT to the border (border can be darker)
+        is_left_red = BGRAColour.is_colour_red(buf, self.offset(1, 2))
+        is_right_red = BGRAColour.is_colour_red(buf, self.offset(x_right - 1, 2))
+        return is_left_red or is_right_red
+
+    def find_bar(self, img, minimum_x):
+        self.get_buffer(img)
+        # the top row's green channel from minimum_x on, one byte per pixel – the bar is
+        # where it's pure green (see BGRAColour.has_pure_green), so bytes.find does the search
+        greens = img.raw[self.offset(minimum_x, 0) + 1:self.offset(img.size.width, 0):self.BYTES_PER_PIXEL]
+        x = greens.find(255)
+        return False if x == -1 else x + minimum_x
+
+    def is_top_row_dark(self, img):
+        buf = self.get_buffer(img)
+        right_x = img.size.width - 1
+        is_left_dark = BGRAColour.is_dark(buf, self.offset(0, 0))
+        is_right_dark = BGRAColour.is_dark(buf, self.offset(right_x, 0))
+        return is_left_dark and is_right_dark
+
+    def is_result_red(self, img):
+        buf = self.get_buffer(img)
+        right_x = img.size.width - 1
+        is_left_red = BGRAColour.is_very_red(buf, self.offset(0, 2))
+        is_right_red = BGRAColour.is_very_red(buf, self.offset(right_x, 2))
+        return is_left_red and is_right_red
+
+    def is_result_green(self, img):
+        buf = self.get_buffer(img)
+        right_x = img.size.width - 1
+        is_left_green = BGRAColour.is_colour_green(buf, self.offset(0, 2))
+        is_right_green = BGRAColour.is_colour_green(buf, self.offset(right_x, 2))
+        return is_left_green and is_right_green
+
+
+class VectorisedATReader(ATReader):
+    """Classifies the whole grabbed strip at once with NumPy.
+
+    Gives the same sections and bar positions as the per-pixel ATReader."""
+
+    @staticmethod
+    def is_available():
+        return np is not None
+
+    @staticmethod
+    def strip_to_rgb(img):
+        # raw is BGRA; int16 so the masks can add and subtract channels
+        bgra = np.frombuffer(img.raw, dtype=np.uint8).reshape(img.size.height, img.size.width, 4)
+        return bgra[:, :, 2::-1].astype(np.int16)
+
+    def get_section_masks(self, img):
+        """Returns whether each column's top is quite dark, its middle green
+        and its bottom mostly red."""
+        if self.colour_table is not None:
+            top, middle, bottom = self.colour_table.classify_strip(img)
+            green = ColourTable.IS_QUITE_GREEN | ColourTable.HAS_PURE_GREEN
+            return (top & ColourTable.IS_QUITE_DARK) != 0, (middle & green) == green, \
+                (bottom & ColourTable.IS_MOSTLY_RED) != 0
+        top, middle, bottom = self.strip_to_rgb(img)
+        green_candidate = ColourMasks.is_quite_green(middle) & ColourMasks.has_pure_green(middle)
+        return ColourMasks.is_quite_dark(top), green_candidate, ColourMasks.is_mostly_red(bottom)
+
+    def find_sections(self, img):
+        top_dark, green_candidate, bottom_mostly_red = self.get_section_masks(img)
+        if (green_candidate & ~top_dark).any():
+            self.inform_user_about_problem("lightPixelAboveGreen", img)
+
+        # same decisions as determine_section_in_column, for every column
+        sections = np.where(top_dark, ATResult.WHITE, ATResult.RED)
+        sections[bottom_mostly_red] = ATResult.RED
+        sections[green_candidate] = np.where(top_dark, ATResult.GREEN, ATResult.WHITE)[green_candidate]
+        return self.find_section_boundaries(sections, img)
+
+    def find_section_boundaries(self, sections, img):
+        green_xs = np.flatnonzero(sections == ATResult.GREEN)
+        white_xs = np.flatnonzero(sections == ATResult.WHITE)
+        green_pos = int(green_xs[0]) if green_xs.size else None
+        white_pos = [None, None]  # start and end
+        if not white_xs.size:
+            return green_pos, white_pos
+        white_pos[0] = int(white_xs[0])
+        red_xs = np.flatnonzero(sections[white_pos[0]:] == ATResult.RED)
+        if not red_xs.size:
+            # the end of the AT is white
+            white_pos[1] = img.size.width - 1
+            return green_pos, white_pos
+        white_pos[1] = white_pos[0] + int(red_xs[0]) - 1
+        if (green_xs > white_pos[1]).any():
+            self.inform_user_about_problem("whiteEndsBeforeGreen", img)
+        if (white_xs > white_pos[1]).any():
+            self.inform_user_about_problem("whiteStartsAfterEnding", img)
+        return green_pos, white_pos
+
+    def find_bar(self, img, minimum_x):
+        bgra = np.frombuffer(img.raw, dtype=np.uint8).reshape(img.size.height, img.size.width, 4)
+        green_row = bgra[0, minimum_x:, 1]
+        found_xs = np.flatnonzero(green_row == 255)  # has_pure_green
+        if not found_xs.size:
+            return False
+        return minimum_x + int(found_xs[0])
+
+
+class TableATReader(RawATReader):
+    """A RawATReader that classifies each pixel with a single ColourTable lookup."""
+
+    def __init__(self, bbox, frame_source=None, writer=None, use_regions=False, scheduler=None,
+                 flight_recorder=None, locator=None):
+        super().__init__(bbox, frame_source, writer, use_regions, scheduler, flight_recorder, locator)
+        self.colour_table = ColourTable.get_instance()
+        self.table = self.colour_table.data
+
+    def classify(self, buf, i):
+        return self.table[buf[i] | buf[i + 1] << 8 | buf[i + 2] << 16]
+
+    def find_sections(self, img):
+        self.get_buffer(img)  # the column checks below read self.buffer
+        return super().find_sections(img)
+
+    def determine_section_in_column(self, img, x):
+        buf = self.buffer
+        middle = self.classify(buf, self.offset(x, 1))
+        green = ColourTable.IS_QUITE_GREEN | ColourTable.HAS_PURE_GREEN
+        if middle & green == green:
+            return self.check_further_for_green(img, x)
+        if self.classify(buf, self.offset(x, 2)) & ColourTable.IS_MOSTLY_RED:
+            return ATResult.RED
+        return self.check_furhter_for_white(img, x)
+
+    def check_further_for_green(self, img, x):
+        # green section! but check just in case
+        if not self.classify(self.buffer, self.offset(x, 0)) & ColourTable.IS_QUITE_DARK:
+            # false alarm?
+            self.inform_user_about_problem("lightPixelAboveGreen", img)
+            return ATResult.WHITE
+        return ATResult.GREEN
+
+    def check_furhter_for_white(self, img, x):
+        # looks white – but it could be the bar
+        if self.classify(self.buffer, self.offset(x, 0)) & ColourTable.IS_QUITE_DARK:
+            return ATResult.WHITE
+        return ATResult.RED
+
+
 class ActionTest:
-    bar_positions = []
-    green_position = None
-    white_positions = [None, None]  # start, end
-    still_frames = None
-    result = None
-    captures_per_second = None
-
-    def print(self):
+    """Everything read about one AT. Positions and times are kept in arrays rather than
+    lists of ints, which matters for the long logs and sessions kept in memory."""
+    __slots__ = ("bar_positions", "green_position", "white_positions", "still_frames", "unique_frames",
+                 "result", "captures_per_second", "detection_delay",
+                 "dropped_frames", "duplicate_frames", "max_ring_occupancy",
+                 "wait_frame_times", "frame_times", "bar_times",
+                 "bar_speed", "press_offset", "press_uncertainty", "white_offsets")
+
+    def __init__(self):
+        self.bar_positions = array("H")
+        self.green_position = None
+        self.white_positions = [None, None]  # start, end
+        self.still_frames = None
+        self.unique_frames = None  # captures that differed from the one before
+        self.result = None
+        self.captures_per_second = None
+        self.detection_delay = None  # the longest the AT could have been on screen before noticed
+        # only known when capturing on a separate thread
+        self.dropped_frames = None
+        self.duplicate_frames = None
+        self.max_ring_occupancy = None
+        # perf_counter_ns of every capture
+        self.wait_frame_times = array("q")
+        self.frame_times = array("q")  # while watching the bar
+        self.bar_times = array("q")  # of the captures in bar_positions
+        # from the BarMotion, if there was enough of it
+        self.bar_speed = None  # pixels per second
+        self.press_offset = None  # ms from the bar reaching the green to the press, early is negative
+        self.press_uncertainty = None  # ± ms
+        self.white_offsets = None  # ms like press_offset, from the white section's start and end
+
+    def apply_bar_motion(self, bar_motion):
+        if bar_motion is None or self.green_position is None:
+            return
+        self.bar_speed = bar_motion.speed
+        self.press_offset = bar_motion.get_offset(self.green_position)
+        self.press_uncertainty = bar_motion.get_uncertainty()
+        if None not in self.white_positions:
+            self.white_offsets = [bar_motion.get_offset(x) for x in self.white_positions]
+
+    def print(self, reader_name=None):
         result_name = ATResult.names[self.result]
         if self.result == ATResult.GREEN:
             timing = "ok"
+        elif self.press_offset is not None:
+            timing = "late" if self.press_offset > 0 else "early"
         elif self.bar_positions and self.green_position:
             last_pos = self.bar_positions[-1]
             if last_pos > self.green_position:
@@ -201,19 +640,95 @@ class ActionTest:
         else:
             timing = "?"
         white_start, white_end = self.white_positions
-        print(f"{result_name} ({timing}): {self.green_position} {white_start}-{white_end} ...{self.bar_positions[-4:]}")
+        press = ""
+        if self.press_offset is not None:
+            press = f"{self.press_offset:+.1f} ± {self.press_uncertainty:.1f} ms"
+            if self.white_offsets is not None and self.result != ATResult.GREEN:
+                press += f", white {self.white_offsets[0]:+.1f}/{self.white_offsets[1]:+.1f} ms"
+            press = f" ({press})"
+        prefix = f"{reader_name}: " if reader_name is not None else ""
+        print(f"{prefix}{result_name} ({timing}): {self.green_position} {white_start}-{white_end} ...{self.bar_positions[-4:].tolist()}{press}")
+        if self.dropped_frames:
+            print(f"---Capture: {self.dropped_frames} frames dropped (ring buffer full)")
 
     def get_log_line(self, log_short=False):
         result_name = ATResult.get_result_name(self.result)
         white_start, white_end = self.white_positions
-        bar_positions = self.bar_positions
         if log_short:
             if self.bar_positions:
                 bar_positions = self.bar_positions[-1]
             else:
                 bar_positions = "?"
+        else:
+            bar_positions = f"[{', '.join(map(str, self.bar_positions))}]"
         cps = self.captures_per_second
-        return f"{result_name} {self.green_position} {white_start}-{white_end} {bar_positions} {self.still_frames} {cps}"
+        line = f"{result_name} {self.green_position} {white_start}-{white_end} {bar_positions} {self.still_frames} {cps}"
+        if self.press_offset is not None:
+            line += f" {self.press_offset:+.1f}+-{self.press_uncertainty:.1f}ms"
+            if self.white_offsets is not None:
+                line += f" {self.white_offsets[0]:+.1f}/{self.white_offsets[1]:+.1f}ms"
+        return line
+
+
+class BarMotion:
+    """The bar moves at a constant speed, so a line fitted through its captured positions
+    tells where it was between captures – and where it got stopped, to a fraction of a pixel.
+
+    The press happened after the last capture with the bar and before the first without it;
+    it's taken to be halfway, so the uncertainty is half that gap plus how badly the line fits.
+    Fewer captures per second just mean a wider gap, not a wrong position.
+
+    The first position gets left out, the bar can wait there a while before it starts moving."""
+    MIN_POSITIONS = 3
+
+    def __init__(self, speed, start_position, stop_time, stop_gap, residual):
+        self.speed = speed  # pixels per second
+        self.start_position = start_position  # at the first capture used
+        self.stop_time = stop_time  # seconds after the first capture used
+        self.stop_gap = stop_gap  # seconds between the last capture with the bar and the first without
+        self.residual = residual  # pixels, the fit's standard error
+
+    @classmethod
+    def fit(cls, bar_positions, bar_times, gone_time=None):
+        """bar_times are perf_counter_ns, gone_time when the bar was first missing.
+        Returns None without enough positions to go on."""
+        if len(bar_times) != len(bar_positions):
+            return None
+        bar_positions, bar_times = bar_positions[1:], bar_times[1:]
+        count = len(bar_positions)
+        if count < cls.MIN_POSITIONS:
+            return None
+        times = [(timestamp - bar_times[0]) / 1e9 for timestamp in bar_times]
+        mean_time = sum(times) / count
+        mean_position = sum(bar_positions) / count
+        time_variance = sum((t - mean_time) ** 2 for t in times)
+        if time_variance == 0:
+            return None
+        speed = sum((t - mean_time) * (x - mean_position) for t, x in zip(times, bar_positions)) / time_variance
+        if speed <= 0:
+            return None
+        start_position = mean_position - speed * mean_time
+        squared_errors = sum((x - start_position - speed * t) ** 2 for t, x in zip(times, bar_positions))
+        residual = math.sqrt(squared_errors / (count - 2)) if count > 2 else 0.
+        if gone_time is None or gone_time <= bar_times[-1]:
+            stop_gap = times[-1] / (count - 1)  # a typical gap between captures
+        else:
+            stop_gap = (gone_time - bar_times[-1]) / 1e9
+        return cls(speed, start_position, times[-1] + stop_gap / 2, stop_gap, residual)
+
+    def get_position(self, t):
+        return self.start_position + self.speed * t
+
+    def get_stop_position(self):
+        return self.get_position(self.stop_time)
+
+    def get_offset(self, x):
+        """ms from the bar reaching x to it getting stopped, negative if it didn't reach it."""
+        return (self.get_stop_position() - x) / self.speed * 1000
+
+    def get_uncertainty(self):
+        """± ms of get_offset."""
+        return math.hypot(self.stop_gap / 2, self.residual / self.speed) * 1000
 
 
 class ATResult:
@@ -227,6 +742,14 @@ class ATResult:
         return cls.names[index]
 
 
+class ATPhase:
+    IDLE = "idle"
+    LOADING = "loading"
+    SETTLING = "settling"
+    WATCHING = "watching"
+    RESOLVING = "resolving"
+
+
 class Colour:
     @staticmethod
     def is_colour_red(rgb):
@@ -259,3 +782,193 @@ class Colour:
     @staticmethod
     def is_quite_dark(rgb):
         return sum(rgb) < 270
+
+
+class ColourMasks:
+    """Colour predicates for whole arrays of RGB pixels (last axis is RGB)."""
+
+    @staticmethod
+    def is_colour_red(rgb):
+        return (rgb[..., 0] >= 145) & (rgb[..., 1] <= 35) & (rgb[..., 2] <= 35)
+
+    @staticmethod
+    def is_very_red(rgb):
+        return (rgb[..., 0] >= 225) & (rgb[..., 1] <= 15) & (rgb[..., 2] <= 15)
+
+    @staticmethod
+    def is_mostly_red(rgb):
+        return (rgb[..., 0] - rgb[..., 1]) >= 15
+
+    @staticmethod
+    def is_colour_green(rgb):
+        return (rgb[..., 0] < 50) & (rgb[..., 1] > 200) & (rgb[..., 2] < 50)
+
+    @staticmethod
+    def is_quite_green(rgb):
+        return (rgb[..., 1] > 200) & ((rgb[..., 1] - rgb[..., 0]) > 50)
+
+    @staticmethod
+    def has_pure_green(rgb):
+        return rgb[..., 1] == 255
+
+    @staticmethod
+    def is_dark(rgb):
+        return rgb.max(axis=-1) < 50
+
+    @staticmethod
+    def is_quite_dark(rgb):
+        return rgb.sum(axis=-1) < 270
+
+
+class BGRAColour:
+    """Colour predicates for the pixel starting at offset i in a raw BGRA buffer."""
+
+    @staticmethod
+    def is_colour_red(buf, i):
+        return buf[i + 2] >= 145 and buf[i + 1] <= 35 and buf[i] <= 35
+
+    @staticmethod
+    def is_very_red(buf, i):
+        return buf[i + 2] >= 225 and buf[i + 1] <= 15 and buf[i] <= 15
+
+    @staticmethod
+    def is_mostly_red(buf, i):
+        return (buf[i + 2] - buf[i + 1]) >= 15
+
+    @staticmethod
+    def is_colour_green(buf, i):
+        return buf[i + 2] < 50 and buf[i + 1] > 200 and buf[i] < 50
+
+    @staticmethod
+    def is_quite_green(buf, i):
+        return buf[i + 1] > 200 and (buf[i + 1] - buf[i + 2]) > 50
+
+    @staticmethod
+    def has_pure_green(buf, i):
+        return buf[i + 1] == 255
+
+    @staticmethod
+    def is_dark(buf, i):
+        return buf[i] < 50 and buf[i + 1] < 50 and buf[i + 2] < 50
+
+    @staticmethod
+    def is_quite_dark(buf, i):
+        return buf[i] + buf[i + 1] + buf[i + 2] < 270
+
+
+class ColourTable:
+    """Every Colour predicate for every 24-bit colour, one bit each, so classifying
+    a pixel takes a single lookup at (r << 16) | (g << 8) | b – which is also what
+    a BGRA pixel's first three bytes read as a little-endian number.
+
+    Built once and cached in the data folder, rebuilt whenever the predicates change."""
+    IS_COLOUR_RED = 1
+    IS_VERY_RED = 2
+    IS_MOSTLY_RED = 4
+    IS_COLOUR_GREEN = 8
+    IS_QUITE_GREEN = 16
+    HAS_PURE_GREEN = 32
+    IS_DARK = 64
+    IS_QUITE_DARK = 128
+    PREDICATE_NAMES = ["is_colour_red", "is_very_red", "is_mostly_red", "is_colour_green",
+                       "is_quite_green", "has_pure_green", "is_dark", "is_quite_dark"]
+    SIZE = 1 << 24
+    PROGRESS_STEP = 16  # red values between progress messages when building without NumPy
+    DATA_FOLDER_NAME = "Data"  # same as ATLogger's
+    FILENAME = "colourTable.bin"
+    _instance = None
+
+    def __init__(self, data):
+        self.data = data
+        self.array = None  # NumPy view, made when first needed
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            cls._instance = cls.load_or_build()
+        return cls._instance
+
+    @classmethod
+    def get_signature(cls):
+        # changes whenever the predicates do
+        try:
+            source = inspect.getsource(Colour) + inspect.getsource(ColourMasks)
+        except OSError:  # no source to compare – rebuild every time to be safe
+            return None
+        return zlib.crc32(source.encode()).to_bytes(4, "little")
+
+    @classmethod
+    def load_or_build(cls):
+        filepath = cls.DATA_FOLDER_NAME + "/" + cls.FILENAME
+        signature = cls.get_signature()
+        if signature is not None and os.path.isfile(filepath):
+            with open(filepath, "rb") as file:
+                data = file.read()
+            if data[:len(signature)] == signature and len(data) == len(signature) + cls.SIZE:
+                return cls(data[len(signature):])
+        if np is None:
+            print("---Building the colour table without NumPy takes minutes, it's saved for next time.")
+        else:
+            print("Building the colour table...")
+        table = cls.build()
+        if not os.path.exists(cls.DATA_FOLDER_NAME):
+            os.mkdir(cls.DATA_FOLDER_NAME)
+        with open(filepath, "wb") as file:
+            file.write((signature or bytes(4)) + table.data)
+        return table
+
+    @classmethod
+    def build(cls):
+        if np is not None:
+            return cls.build_with_numpy()
+        predicates = [getattr(Colour, name) for name in cls.PREDICATE_NAMES]
+        data = bytearray(cls.SIZE)
+        index = 0
+        for r in range(256):
+            if r % cls.PROGRESS_STEP == 0:
+                print(f"-Colour table {r * 100 // 256}% built")
+            for g in range(256):
+                for b in range(256):
+                    rgb = (r, g, b)
+                    bits = 0
+                    for bit, predicate in enumerate(predicates):
+                        if predicate(rgb):
+                            bits |= 1 << bit
+                    data[index] = bits
+                    index += 1
+        return cls(bytes(data))
+
+    @classmethod
+    def build_with_numpy(cls):
+        data = np.zeros(cls.SIZE, dtype=np.uint8)
+        g, b = np.divmod(np.arange(1 << 16, dtype=np.int32), 256)
+        for r in range(256):  # a slice at a time keeps memory low
+            rgb = np.stack([np.full_like(g, r), g, b], axis=-1)
+            bits = np.zeros(len(g), dtype=np.uint8)
+            for bit, name in enumerate(cls.PREDICATE_NAMES):
+                bits |= getattr(ColourMasks, name)(rgb).astype(np.uint8) << bit
+            data[r << 16:(r + 1) << 16] = bits
+        return cls(data.tobytes())
+
+    def classify(self, rgb):
+        return self.data[(rgb[0] << 16) | (rgb[1] << 8) | rgb[2]]
+
+    def get_array(self):
+        if self.array is None:
+            self.array = np.frombuffer(self.data, dtype=np.uint8)
+        return self.array
+
+    def classify_strip(self, img):
+        """The bits of every pixel in the image, as a (height, width) array."""
+        pixels = np.frombuffer(img.raw, dtype="<u4").reshape(img.size.height, img.size.width)
+        return np.take(self.get_array(), pixels & 0xFFFFFF)
+
+    def verify(self, step=1):
+        """Checks the table against the Colour predicates for every step-th colour."""
+        predicates = [getattr(Colour, name) for name in self.PREDICATE_NAMES]
+        for index in range(0, self.SIZE, step):
+            rgb = (index >> 16, (index >> 8) & 255, index & 255)
+            bits = self.data[index]
+            for bit, predicate in enumerate(predicates):
+                if bool(bits & (1 << bit)) != predicate(rgb):
+                    raise AssertionError(f"{self.PREDICATE_NAMES[bit]}{rgb} differs from the table")
@@ -0,0 +1,313 @@
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from mss.screenshot import ScreenShot
+import argparse
+import io
+import json
+import os
+import re
+import struct
+import time
+import zlib
+from ATAnalysing import LogAnalyser
+from ATCapturing import FrameRecording, FramesExhausted, ReplayFrameSource
+from ATLogging import LogEntry
+from ATReading import ATResult, RawATReader, VectorisedATReader
+
+
+class ProblemCollector:
+    """Stands in for the writer of a reader, noting the problems instead of saving images."""
+
+    def __init__(self):
+        self.problems = []
+
+    def replace(self, filepath, content):
+        name = os.path.splitext(os.path.basename(filepath))[0]
+        if name != "lastResult" and name not in self.problems:
+            self.problems.append(name)
+
+    def append(self, filepath, text):
+        pass
+
+    def take_problems(self):
+        problems, self.problems = self.problems, []
+        return problems
+
+
+class PNGDecoding:
+    """Just enough PNG to read back the strips that ATReader saves (8-bit RGB or RGBA)."""
+    SIGNATURE = b"\x89PNG\r\n\x1a\n"
+    CHUNK_HEADER = struct.Struct(">I4s")
+    IHDR = struct.Struct(">IIBBBBB")
+    CHANNELS = {2: 3, 6: 4}  # per colour type
+
+    @classmethod
+    def read_screenshot(cls, filepath):
+        with open(filepath, "rb") as file:
+            data = file.read()
+        if not data.startswith(cls.SIGNATURE):
+            raise ValueError(f"{filepath} is not a PNG")
+        header, compressed = None, bytearray()
+        offset = len(cls.SIGNATURE)
+        while offset < len(data):
+            length, chunk_type = cls.CHUNK_HEADER.unpack_from(data, offset)
+            chunk = data[offset + cls.CHUNK_HEADER.size:offset + cls.CHUNK_HEADER.size + length]
+            offset += cls.CHUNK_HEADER.size + length + 4  # + CRC
+            if chunk_type == b"IHDR":
+                header = cls.IHDR.unpack(chunk)
+            elif chunk_type == b"IDAT":
+                compressed += chunk
+            elif chunk_type == b"IEND":
+                break
+        width, height, bit_depth, colour_type, _, _, interlace = header
+        if bit_depth != 8 or colour_type not in cls.CHANNELS or interlace:
+            raise ValueError(f"{filepath}: unsupported PNG type")
+        channels = cls.CHANNELS[colour_type]
+        rows = cls.unfilter(zlib.decompress(compressed), width * channels, height, channels)
+        raw = bytearray(width * height * 4)
+        for y, row in enumerate(rows):
+            start = y * width * 4
+            raw[start:start + width * 4:4] = row[2::channels]  # blue
+            raw[start + 1:start + width * 4:4] = row[1::channels]
+            raw[start + 2:start + width * 4:4] = row[0::channels]
+            raw[start + 3:start + width * 4:4] = b"\xff" * width
+        return ScreenShot.from_size(raw, width, height)
+
+    @staticmethod
+    def unfilter(data, row_size, height, bpp):
+        rows = []
+        previous = bytearray(row_size)
+        for y in range(height):
+            start = y * (row_size + 1)
+            filter_type = data[start]
+            row = bytearray(data[start + 1:start + 1 + row_size])
+            if filter_type == 1:  # sub
+                for i in range(bpp, row_size):
+                    row[i] = (row[i] + row[i - bpp]) & 0xff
+            elif filter_type == 2:  # up
+                for i in range(row_size):
+                    row[i] = (row[i] + previous[i]) & 0xff
+            elif filter_type == 3:  # average
+                for i in range(row_size):
+                    left = row[i - bpp] if i >= bpp else 0
+                    row[i] = (row[i] + (left + previous[i]) // 2) & 0xff
+            elif filter_type == 4:  # paeth
+                for i in range(row_size):
+                    left = row[i - bpp] if i >= bpp else 0
+                    up_left = previous[i - bpp] if i >= bpp else 0
+                    row[i] = (row[i] + PNGDecoding.paeth(left, previous[i], up_left)) & 0xff
+            rows.append(row)
+            previous = row
+        return rows
+
+    @staticmethod
+    def paeth(a, b, c):
+        p = a + b - c
+        pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+        if pa <= pb and pa <= pc:
+            return a
+        return b if pb <= pc else c
+
+
+class Reanalyser:
+    """Runs the current reader logic over recorded frame sequences and saved strips,
+    in parallel, and compares the results with what got logged when they were recorded."""
+    COMPARED_FIELDS = ["result", "green_position", "white_positions", "last_bar_position"]
+    # whole sessions recorded by Practise (record whole sessions in prefs), -2 etc. for more ATs
+    SESSION_RECORDING_PATTERN = re.compile(r"(\d{4}-\d\d-\d\d_\d\d-\d\d-\d\d)(?:-\d+)?\.frames$")
+    SESSION_START_SLACK = 60  # seconds between the recording starting and the session getting logged
+
+    def __init__(self, paths, processes=None):
+        self.recordings, self.strips = self.find_files(paths)
+        self.processes = processes or os.cpu_count()
+
+    @staticmethod
+    def find_files(paths):
+        recordings, strips = [], []
+        for path in paths:
+            filepaths = [path]
+            if os.path.isdir(path):
+                filepaths = sorted(os.path.join(folder, filename)
+                                   for folder, _, filenames in os.walk(path) for filename in filenames)
+            for filepath in filepaths:
+                extension = os.path.splitext(filepath)[1].lower()
+                if extension == FrameRecording.EXTENSION:
+                    recordings.append(filepath)
+                elif extension == ".png":
+                    strips.append(filepath)
+        return recordings, strips
+
+    def run(self):
+        with ProcessPoolExecutor(self.processes) as pool:
+            recordings = list(pool.map(reanalyse_recording, self.recordings))
+            strips = list(pool.map(reanalyse_strip, self.strips, chunksize=16))
+        return {"recordings": dict(zip(self.recordings, recordings)),
+                "strips": dict(zip(self.strips, strips))}
+
+    def compare_with_log(self, recordings, log_filepath, first_session=None):
+        """Compares the ATs of every whole-session recording with the logged session it
+        recorded, found by the start time in its name. With first_session, the recordings
+        (sorted by name) are taken to be the consecutive sessions from there on instead.
+
+        Returns the differences and the recordings that aren't of a logged session – problem
+        frames or single exported ATs, which can't be lined up with the log."""
+        sessions = self.read_logged_sessions(log_filepath)
+        if first_session is None:
+            session_indexes = self.match_sessions(recordings, sessions)
+        else:
+            if first_session < 0:
+                first_session += len(sessions)
+            session_indexes = dict(zip(recordings, range(first_session, first_session + len(recordings))))
+        differences = []
+        unmatched = [filepath for filepath in recordings if filepath not in session_indexes]
+        for filepath, session_index in session_indexes.items():
+            ats = recordings[filepath]
+            logged = sessions[session_index][1] if session_index < len(sessions) else []
+            for index in range(max(len(ats), len(logged))):
+                reanalysed_at = ats[index] if index < len(ats) else None
+                logged_at = logged[index] if index < len(logged) else None
+                fields = self.get_different_fields(reanalysed_at, logged_at)
+                if fields:
+                    differences.append({"recording": filepath, "session": session_index, "index": index,
+                                        "fields": fields,
+                                        "logged": logged_at and logged_at["line"],
+                                        "reanalysed": reanalysed_at and reanalysed_at.get("line")})
+        return differences, unmatched
+
+    @classmethod
+    def match_sessions(cls, recordings, sessions):
+        """{recording: index of the logged session} for the recordings named by their start time.
+        Logged sessions only have their start minute, so it's the first one not taken yet
+        that started within SESSION_START_SLACK of the recording."""
+        session_indexes = {}
+        taken = set()
+        for filepath in sorted(recordings):
+            match = cls.SESSION_RECORDING_PATTERN.search(os.path.basename(filepath))
+            if not match:
+                continue
+            start = time.mktime(time.strptime(match.group(1), "%Y-%m-%d_%H-%M-%S"))
+            dates = {time.strftime("%d. %m. %Y %H:%M", time.localtime(start + seconds))
+                     for seconds in (0, cls.SESSION_START_SLACK)}
+            for index, (date, ats) in enumerate(sessions):
+                if date in dates and index not in taken:
+                    session_indexes[filepath] = index
+                    taken.add(index)
+                    break
+        return session_indexes
+
+    @classmethod
+    def get_different_fields(cls, reanalysed_at, logged_at):
+        if reanalysed_at is None or logged_at is None:
+            return ["missing"]
+        if "error" in reanalysed_at:
+            return ["error"]
+        return [field for field in cls.COMPARED_FIELDS if reanalysed_at[field] != logged_at[field]]
+
+    @staticmethod
+    def read_logged_sessions(log_filepath):
+        """[(start date, [described AT])] of every session in the log."""
+        analyser = LogAnalyser(log_filepath)
+        sessions = []
+        for start, end in analyser.get_session_ranges():
+            date, has_header, ats = None, False, []
+            for kind, data in analyser.read_range(start, end):
+                if kind == LogEntry.SESSION:
+                    has_header = True
+                    date = data[1]
+                elif kind == LogEntry.AT:
+                    action_test, log_short = data
+                    ats.append(describe_action_test(action_test, log_short))
+            if has_header or ats:
+                sessions.append((date, ats))
+        return sessions
+
+
+def get_reader_class():
+    return VectorisedATReader if VectorisedATReader.is_available() else RawATReader
+
+
+def describe_action_test(action_test, log_short=False):
+    bar_positions = action_test.bar_positions
+    return {"result": ATResult.get_result_name(action_test.result),
+            "green_position": action_test.green_position,
+            "white_positions": list(action_test.white_positions),
+            "last_bar_position": bar_positions[-1] if bar_positions else None,
+            "line": action_test.get_log_line(log_short)}
+
+
+def reanalyse_recording(filepath):  # for the process pool
+    source = ReplayFrameSource(filepath, realtime=False)
+    header = source.next_header
+    if header is None:
+        return []
+    timestamp, width, height = header
+    collector = ProblemCollector()
+    reader = get_reader_class()((0, 0, width, height), source, collector)
+    ats = []
+    with redirect_stdout(io.StringIO()):  # the reader prints every AT
+        while True:
+            try:
+                action_test = reader.read_at()
+                description = describe_action_test(action_test)
+            except FramesExhausted:
+                break  # an AT cut off by the end of the recording doesn't count
+            except Exception as error:
+                description = {"error": str(error)}
+            description["problems"] = collector.take_problems()
+            ats.append(description)
+    source.close()
+    return ats
+
+
+def reanalyse_strip(filepath):  # for the process pool
+    """Strips are single frames – what a frame shows depends on when it was saved,
+    so it gets checked both as an AT to locate and as a result."""
+    try:
+        img = PNGDecoding.read_screenshot(filepath)
+    except (OSError, ValueError, struct.error, zlib.error) as error:
+        return {"error": str(error)}
+    if img.size.height != 3:
+        return {"error": "not an AT strip (3 pixels high)"}
+    collector = ProblemCollector()
+    reader = get_reader_class()((0, 0, img.size.width, img.size.height), writer=collector)
+    with redirect_stdout(io.StringIO()):
+        green_position, white_positions = reader.find_sections(img)
+        is_red, is_green = reader.is_result_red(img), reader.is_result_green(img)
+    if is_red == is_green:
+        result = None if is_red else ATResult.get_result_name(ATResult.WHITE)
+    else:
+        result = ATResult.get_result_name(ATResult.RED if is_red else ATResult.GREEN)
+    return {"contains_at": reader.contains_at(img), "green_position": green_position,
+            "white_positions": white_positions, "result": result,
+            "problems": collector.take_problems()}
+
+
+def main():
+    # python ATReanalysing.py <folders or files> [--log Data/ATs.log] – writes reanalysis.json
+    parser = argparse.ArgumentParser(description="Reads recorded frames (.frames) and saved strips (.png) again.")
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--log", help="compare the recordings with this log")
+    parser.add_argument("--session", type=int, help="index of the logged session the first recording is from "
+                                                    "(by default recordings get matched by their start time)")
+    parser.add_argument("--processes", type=int)
+    parser.add_argument("--output", default="reanalysis.json")
+    arguments = parser.parse_args()
+    reanalyser = Reanalyser(arguments.paths, arguments.processes)
+    results = reanalyser.run()
+    at_count = sum(len(ats) for ats in results["recordings"].values())
+    print(f"{at_count} ATs in {len(reanalyser.recordings)} recordings, {len(reanalyser.strips)} strips.")
+    if arguments.log:
+        differences, unmatched = reanalyser.compare_with_log(results["recordings"], arguments.log, arguments.session)
+        results["differences"] = differences
+        if unmatched:
+            print(f"{len(unmatched)} recordings aren't of a logged session, not compared.")
+        print(f"{len(differences)} ATs differ from the log.")
+        for difference in differences[:20]:
+            print(f"  {difference['recording']} #{difference['index']} ({', '.join(difference['fields'])}): "
+                  f"{difference['logged']} -> {difference['reanalysed']}")
+    with open(arguments.output, "w") as file:
+        json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
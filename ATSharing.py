@@ -0,0 +1,397 @@
+from mss.screenshot import ScreenShot
+from collections import deque
+from multiprocessing import shared_memory
+import struct
+import threading
+import time
+from ATCapturing import FrameSource, FramesExhausted, LiveFrameSource
+
+BYTES_PER_PIXEL = 4
+GRAB_COST_PIXELS = 100000  # a grab costs about as much as copying this many more pixels
+
+
+def get_area(bbox):
+    return (bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
+
+
+def get_union(a, b):
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+
+def is_inside(bbox, region):
+    return (region[0] <= bbox[0] and region[1] <= bbox[1]
+            and bbox[2] <= region[2] and bbox[3] <= region[3])
+
+
+def group_bboxes(bboxes):
+    """The regions to grab so every bbox is inside one. Bboxes share a region when grabbing
+    the area around them too costs less than another grab – ATs side by side do,
+    ATs far above each other don't."""
+    regions = []
+    own_areas = []
+    for bbox in bboxes:
+        for index, region in enumerate(regions):
+            union = get_union(region, bbox)
+            if get_area(union) <= own_areas[index] + get_area(bbox) + GRAB_COST_PIXELS:
+                regions[index] = union
+                own_areas[index] += get_area(bbox)
+                break
+        else:
+            regions.append(tuple(bbox))
+            own_areas.append(get_area(bbox))
+    return regions
+
+
+def crop_raw(raw, region, bbox):
+    """The pixels of bbox out of the raw BGRA pixels of region. Bboxes as wide as the region
+    are one contiguous run of rows, so they're a view without copying anything."""
+    raw = memoryview(raw)
+    region_width = region[2] - region[0]
+    width = bbox[2] - bbox[0]
+    row_bytes = region_width * BYTES_PER_PIXEL
+    first_row = bbox[1] - region[1]
+    if width == region_width:
+        return raw[first_row * row_bytes:(first_row + bbox[3] - bbox[1]) * row_bytes]
+    cropped = bytearray(width * (bbox[3] - bbox[1]) * BYTES_PER_PIXEL)
+    width_bytes = width * BYTES_PER_PIXEL
+    start = first_row * row_bytes + (bbox[0] - region[0]) * BYTES_PER_PIXEL
+    for offset in range(0, len(cropped), width_bytes):
+        cropped[offset:offset + width_bytes] = raw[start:start + width_bytes]
+        start += row_bytes
+    return cropped
+
+
+def crop(img, region, bbox):
+    if tuple(bbox) == tuple(region):
+        return img
+    return ScreenShot.from_size(crop_raw(img.raw, region, bbox), bbox[2] - bbox[0], bbox[3] - bbox[1])
+
+
+class SharedCapture:
+    """Grabs the regions of several ATs as fast as possible on its own thread, and keeps
+    the last ring_size frame sets – (timestamp, frame) per region – for SharedFrameSources
+    to read, each at its own pace. However many ATs there are, every frame gets grabbed
+    once per region (see group_bboxes), not once per AT."""
+    RING_SIZE = 64
+
+    def __init__(self, source, bboxes, ring_size=RING_SIZE):
+        self.source = source
+        self.regions = group_bboxes(bboxes)
+        self.ring_size = ring_size
+        self.ring = deque(maxlen=ring_size)
+        self.sequence = -1  # of the newest frame set
+        self.condition = threading.Condition()
+        self.capture_error = None
+        self.running = True
+        self.thread = threading.Thread(target=self.capture, name="shared capture", daemon=True)
+        self.thread.start()
+
+    def find_region(self, bbox):
+        for index, region in enumerate(self.regions):
+            if is_inside(bbox, region):
+                return index
+        return None
+
+    def capture(self):
+        while self.running:
+            try:
+                frames = [self.source.timestamped_grab(region) for region in self.regions]
+            except Exception as error:  # e.g. FramesExhausted – hand it over to the readers
+                self.stop(error)
+                return
+            self.publish(frames)
+
+    def publish(self, frames):
+        with self.condition:
+            self.ring.append(frames)
+            self.sequence += 1
+            self.condition.notify_all()
+
+    def stop(self, error):
+        with self.condition:
+            if self.capture_error is None:
+                self.capture_error = error
+            self.condition.notify_all()
+
+    def get_summary(self):
+        return (f"Shared capture: {self.sequence + 1} frame sets of {len(self.regions)} "
+                f"region{'s' if len(self.regions) != 1 else ''}")
+
+    def stop_capturing(self):
+        """The readers get FramesExhausted once they've read what's left."""
+        self.running = False
+        self.thread.join()  # before stopping, so nothing gets published after it
+        self.stop(FramesExhausted("the shared capture was closed"))
+
+    def close(self):
+        """Only once nothing reads from it anymore – see stop_capturing."""
+        self.stop_capturing()
+        self.source.close()
+
+
+class SharedFrameSource(FrameSource):
+    """One AT's view of a SharedCapture. Grabs go through the shared frames in order,
+    cropped to the bbox grabbed; frames pushed out of the ring before being read count as
+    dropped. Bboxes outside of the shared regions (e.g. a whole monitor to locate the AT in)
+    get grabbed directly."""
+
+    def __init__(self, capture, bbox):
+        self.capture = capture
+        self.bbox = bbox
+        self.next_sequence = capture.sequence + 1
+        self.last_raw = None
+        self.first_sequence = self.next_sequence  # of the frame sets the statistics are about
+        self.dropped_frames = 0
+        self.duplicate_frames = 0
+        self.max_occupancy = 0
+
+    def timestamped_grab(self, bbox):
+        index = self.capture.find_region(bbox)
+        if index is None:
+            return self.capture.source.timestamped_grab(bbox)
+        timestamp, img = self.take_next_frames()[index]
+        img = crop(img, self.capture.regions[index], bbox)
+        if bbox == self.bbox:
+            if img.raw == self.last_raw:
+                self.duplicate_frames += 1
+            self.last_raw = img.raw
+        return timestamp, img
+
+    def take_next_frames(self):
+        capture = self.capture
+        with capture.condition:
+            while self.next_sequence > capture.sequence:
+                if capture.capture_error is not None:
+                    raise capture.capture_error
+                capture.condition.wait()
+            oldest = capture.sequence - len(capture.ring) + 1
+            if self.next_sequence < oldest:
+                self.dropped_frames += oldest - self.next_sequence
+                self.next_sequence = oldest
+            self.max_occupancy = max(self.max_occupancy, capture.sequence - self.next_sequence + 1)
+            frames = capture.ring[self.next_sequence - oldest]
+            self.next_sequence += 1
+        return frames
+
+    def grab(self, bbox):
+        return self.timestamped_grab(bbox)[1]
+
+    def skip_old_frames(self):
+        with self.capture.condition:
+            self.next_sequence = self.capture.sequence + 1
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+        self.skip_old_frames()  # the other ATs keep the capture going, so skip what it got meanwhile
+
+    def change_bbox(self, bbox):
+        self.bbox = bbox  # grabbed directly if it's moved out of the shared regions
+        self.skip_old_frames()
+
+    def take_statistics(self):
+        with self.capture.condition:
+            sequence = self.capture.sequence
+        statistics = {"captured": sequence + 1 - self.first_sequence, "dropped": self.dropped_frames,
+                      "duplicates": self.duplicate_frames, "max_occupancy": self.max_occupancy}
+        self.first_sequence = sequence + 1
+        self.dropped_frames = self.duplicate_frames = self.max_occupancy = 0
+        return statistics
+
+    # closing the capture is up to whoever made it
+
+
+class SharedMemoryFormat:
+    """A HEADER, then ring_size slots, each a SLOT_HEADER and a TIMESTAMP and the raw
+    BGRA pixels of every region. A slot's sequence is -1 while it's being written, so
+    readers in other processes can tell if it changed while they were copying it."""
+    HEADER = struct.Struct("<qB")  # sequence of the newest frame set (-1 before the first), closed
+    SLOT_HEADER = struct.Struct("<q")  # sequence of the frame set in the slot
+    TIMESTAMP = struct.Struct("<q")  # perf_counter_ns, the same clock in every process
+
+    @classmethod
+    def get_region_offsets(cls, regions):
+        """The offsets of every region's timestamp in a slot, and the size of a slot."""
+        offsets = []
+        offset = cls.SLOT_HEADER.size
+        for region in regions:
+            offsets.append(offset)
+            offset += cls.TIMESTAMP.size + get_area(region) * BYTES_PER_PIXEL
+        return offsets, offset
+
+    @classmethod
+    def get_size(cls, regions, ring_size):
+        return cls.HEADER.size + ring_size * cls.get_region_offsets(regions)[1]
+
+
+class SharedMemoryCapture(SharedCapture):
+    """A SharedCapture that also copies every frame set into shared memory (see
+    SharedMemoryFormat), for SharedMemoryFrameSources in other processes to read."""
+
+    def __init__(self, source, bboxes, ring_size=SharedCapture.RING_SIZE):
+        regions = group_bboxes(bboxes)
+        self.memory = shared_memory.SharedMemory(create=True, size=SharedMemoryFormat.get_size(regions, ring_size))
+        self.buffer = self.memory.buf
+        SharedMemoryFormat.HEADER.pack_into(self.buffer, 0, -1, False)
+        self.region_offsets, self.slot_size = SharedMemoryFormat.get_region_offsets(regions)
+        super().__init__(source, bboxes, ring_size)
+
+    def make_frame_source(self, bbox):
+        """A SharedMemoryFrameSource for bbox, to hand over to another process."""
+        return SharedMemoryFrameSource(self.memory.name, self.regions, self.ring_size, bbox)
+
+    def publish(self, frames):
+        sequence = self.sequence + 1
+        slot = SharedMemoryFormat.HEADER.size + sequence % self.ring_size * self.slot_size
+        SharedMemoryFormat.SLOT_HEADER.pack_into(self.buffer, slot, -1)
+        for (timestamp, img), offset in zip(frames, self.region_offsets):
+            start = slot + offset
+            SharedMemoryFormat.TIMESTAMP.pack_into(self.buffer, start, timestamp)
+            start += SharedMemoryFormat.TIMESTAMP.size
+            self.buffer[start:start + len(img.raw)] = img.raw
+        SharedMemoryFormat.SLOT_HEADER.pack_into(self.buffer, slot, sequence)
+        SharedMemoryFormat.HEADER.pack_into(self.buffer, 0, sequence, False)
+        super().publish(frames)
+
+    def stop(self, error):
+        if self.memory is not None:
+            SharedMemoryFormat.HEADER.pack_into(self.buffer, 0, self.sequence, True)
+        super().stop(error)
+
+    def close(self):
+        super().close()
+        if self.memory is None:
+            return
+        self.buffer.release()
+        self.buffer = None
+        self.memory.close()
+        self.memory.unlink()  # a process attaching after this would get FileNotFoundError
+        self.memory = None
+
+
+class SharedMemoryFrameSource(FrameSource):
+    """One AT's view of a SharedMemoryCapture, from another process. Like a SharedFrameSource,
+    except that it has to copy its pixels out of shared memory before the slot gets reused,
+    and that it polls for new frames, as there's nothing to wait on across processes."""
+    POLL_INTERVAL = .0005
+
+    def __init__(self, name, regions, ring_size, bbox):
+        self.name = name  # attached to on the first grab, so it can be pickled until then
+        self.regions = regions
+        self.ring_size = ring_size
+        self.bbox = bbox
+        self.region_offsets, self.slot_size = SharedMemoryFormat.get_region_offsets(regions)
+        self.memory = None
+        self.buffer = None
+        self.next_sequence = 0
+        self.last_raw = None
+        self.first_sequence = 0
+        self.dropped_frames = 0
+        self.duplicate_frames = 0
+        self.max_occupancy = 0
+        self.direct_source = None  # for bboxes outside of the shared regions
+
+    def attach(self):
+        # worker processes share the resource tracker of the one that made it, which unlinks it
+        try:
+            self.memory = shared_memory.SharedMemory(name=self.name)
+        except FileNotFoundError:  # unlinked already, it was closed before this got going
+            raise FramesExhausted("the shared capture was closed") from None
+        self.buffer = self.memory.buf
+        self.next_sequence = SharedMemoryFormat.HEADER.unpack_from(self.buffer, 0)[0] + 1
+        self.first_sequence = self.next_sequence
+
+    def find_region(self, bbox):
+        for index, region in enumerate(self.regions):
+            if is_inside(bbox, region):
+                return index
+        return None
+
+    def timestamped_grab(self, bbox):
+        index = self.find_region(bbox)
+        if index is None:
+            if self.direct_source is None:
+                self.direct_source = LiveFrameSource()
+            return self.direct_source.timestamped_grab(bbox)
+        if self.buffer is None:
+            self.attach()
+        while True:
+            sequence = self.wait_for_next_frames()
+            frame = self.copy_frame(sequence, index, bbox)
+            if frame is not None:
+                break
+            self.dropped_frames += 1  # overwritten while copying it
+        self.next_sequence = sequence + 1
+        timestamp, img = frame
+        if bbox == self.bbox:
+            if img.raw == self.last_raw:
+                self.duplicate_frames += 1
+            self.last_raw = img.raw
+        return timestamp, img
+
+    def get_newest_sequence(self):
+        newest, closed = SharedMemoryFormat.HEADER.unpack_from(self.buffer, 0)
+        if closed and self.next_sequence > newest:
+            raise FramesExhausted("the shared capture was closed")
+        return newest
+
+    def wait_for_next_frames(self):
+        """The sequence of the next frame set to read, once it's there."""
+        newest = self.get_newest_sequence()
+        while self.next_sequence > newest:
+            time.sleep(self.POLL_INTERVAL)
+            newest = self.get_newest_sequence()
+        oldest = max(0, newest - self.ring_size + 2)  # the one after the oldest could be being written
+        if self.next_sequence < oldest:
+            self.dropped_frames += oldest - self.next_sequence
+            self.next_sequence = oldest
+        self.max_occupancy = max(self.max_occupancy, newest - self.next_sequence + 1)
+        return self.next_sequence
+
+    def copy_frame(self, sequence, index, bbox):
+        slot = SharedMemoryFormat.HEADER.size + sequence % self.ring_size * self.slot_size
+        if SharedMemoryFormat.SLOT_HEADER.unpack_from(self.buffer, slot)[0] != sequence:
+            return None
+        start = slot + self.region_offsets[index]
+        timestamp = SharedMemoryFormat.TIMESTAMP.unpack_from(self.buffer, start)[0]
+        start += SharedMemoryFormat.TIMESTAMP.size
+        region = self.regions[index]
+        raw = self.buffer[start:start + get_area(region) * BYTES_PER_PIXEL]
+        raw = bytearray(crop_raw(raw, region, bbox))  # a view would change under the reader
+        if SharedMemoryFormat.SLOT_HEADER.unpack_from(self.buffer, slot)[0] != sequence:
+            return None
+        return timestamp, ScreenShot.from_size(raw, bbox[2] - bbox[0], bbox[3] - bbox[1])
+
+    def grab(self, bbox):
+        return self.timestamped_grab(bbox)[1]
+
+    def skip_old_frames(self):
+        if self.buffer is None:
+            self.attach()
+        self.next_sequence = SharedMemoryFormat.HEADER.unpack_from(self.buffer, 0)[0] + 1
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+        self.skip_old_frames()  # like a SharedFrameSource
+
+    def change_bbox(self, bbox):
+        self.bbox = bbox
+        self.skip_old_frames()
+
+    def take_statistics(self):
+        if self.buffer is None:
+            self.attach()
+        sequence = SharedMemoryFormat.HEADER.unpack_from(self.buffer, 0)[0]
+        statistics = {"captured": sequence + 1 - self.first_sequence, "dropped": self.dropped_frames,
+                      "duplicates": self.duplicate_frames, "max_occupancy": self.max_occupancy}
+        self.first_sequence = sequence + 1
+        self.dropped_frames = self.duplicate_frames = self.max_occupancy = 0
+        return statistics
+
+    def close(self):
+        if self.direct_source is not None:
+            self.direct_source.close()
+        if self.memory is not None:
+            self.buffer.release()
+            self.buffer = None
+            self.memory.close()
+            self.memory = None
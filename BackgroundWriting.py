@@ -0,0 +1,109 @@
+import os
+import threading
+
+
+class BackgroundWriter:
+    """Writes files on its own thread so disk access doesn't delay reading ATs.
+
+    Appended text (or bytes) is written in order every flush_interval seconds. A replaced file
+    only gets its latest content, written to a temporary file first and renamed over
+    the old one, so nobody ever reads it half-written. Content can also be a function
+    returning bytes (e.g. PNG encoding), which then runs on the writer thread too."""
+    FLUSH_INTERVAL = .5
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self.condition = threading.Condition()
+        self.pending_appends = {}  # filepath: [texts]
+        self.pending_replaces = {}  # filepath: content
+        self.append_files = {}
+        self.flush_requested = False
+        self.writing = False
+        self.writes_done = 0
+        self.running = True
+        self.thread = threading.Thread(target=self.work, name="writer", daemon=True)
+        self.thread.start()
+
+    def append(self, filepath, text):
+        with self.condition:
+            self.pending_appends.setdefault(filepath, []).append(text)
+
+    def replace(self, filepath, content):
+        with self.condition:
+            self.pending_replaces[filepath] = content  # older content doesn't matter anymore
+
+    def flush(self):
+        """Blocks until everything queued so far is written."""
+        with self.condition:
+            # a write already going on might have missed the latest queued content
+            target = self.writes_done + (2 if self.writing else 1)
+            self.flush_requested = True
+            self.condition.notify_all()
+            while self.writes_done < target and self.thread.is_alive():
+                self.condition.wait(self.flush_interval)
+
+    def close(self):
+        if not self.running:
+            return
+        self.flush()
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join()
+        for file in self.append_files.values():
+            file.close()
+        self.append_files = {}
+
+    def work(self):
+        while True:
+            with self.condition:
+                if self.running and not self.flush_requested:
+                    self.condition.wait(self.flush_interval)
+                if not self.running:
+                    return
+                self.flush_requested = False
+                self.writing = True
+                appends, self.pending_appends = self.pending_appends, {}
+                replaces, self.pending_replaces = self.pending_replaces, {}
+            self.write_appends(appends)
+            self.write_replaces(replaces)
+            with self.condition:
+                self.writing = False
+                self.writes_done += 1
+                self.condition.notify_all()
+
+    def write_appends(self, appends):
+        for filepath, texts in appends.items():
+            try:
+                is_binary = isinstance(texts[0], bytes)
+                file = self.get_append_file(filepath, is_binary)
+                file.write((b"" if is_binary else "").join(texts))
+                file.flush()
+            except PermissionError:
+                print(f"---Permission error to {filepath}!")
+            except Exception as error:  # only these texts get lost, not the writer thread
+                print(f"---Couldn't write to {filepath}: {error}")
+
+    def get_append_file(self, filepath, is_binary=False):
+        if filepath not in self.append_files:
+            self.append_files[filepath] = open(filepath, "ab" if is_binary else "a")
+        return self.append_files[filepath]
+
+    def write_replaces(self, replaces):
+        for filepath, content in replaces.items():
+            try:
+                if callable(content):
+                    content = content()
+                self.replace_atomically(filepath, content)
+            except PermissionError:
+                print(f"---Permission error to {filepath}!")
+            except Exception as error:  # e.g. from encoding a PNG – only this file gets lost
+                print(f"---Couldn't write {filepath}: {error}")
+
+    @staticmethod
+    def replace_atomically(filepath, content):
+        temporary_filepath = filepath + ".tmp"
+        mode = "wb" if isinstance(content, bytes) else "w"
+        with open(temporary_filepath, mode) as file:
+            file.write(content)
+        os.replace(temporary_filepath, filepath)
@@ -0,0 +1,116 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+
+
+class OverlayServer:
+    """Serves the session's stats on localhost for stream overlays, on its own threads.
+
+    GET /stats returns all of them as JSON. GET /events is a Server-Sent Events stream
+    starting with all of them, then only the parts that changed whenever new ones get
+    published – right after every AT, no file polling needed. GET /metrics returns
+    the phase metrics for Prometheus, if there are any."""
+    HOST = "127.0.0.1"
+    KEEPALIVE_INTERVAL = 15  # seconds, so idle connections don't get dropped
+
+    def __init__(self, port):
+        self.port = port
+        self.condition = threading.Condition()
+        self.stats = {}
+        self.metrics = None  # Prometheus text
+        self.version = 0
+        self.running = True
+        self.server = ThreadingHTTPServer((self.HOST, port), OverlayRequestHandler)
+        self.server.daemon_threads = True
+        self.server.overlay = self
+        self.thread = threading.Thread(target=self.server.serve_forever, name="overlay", daemon=True)
+        self.thread.start()
+
+    def publish(self, stats):
+        with self.condition:
+            self.stats = stats
+            self.version += 1
+            self.condition.notify_all()
+
+    def publish_metrics(self, text):
+        with self.condition:
+            self.metrics = text
+
+    def get_metrics(self):
+        with self.condition:
+            return self.metrics
+
+    def get_stats(self):
+        with self.condition:
+            return self.stats
+
+    def wait_for_stats(self, known_version, timeout):
+        """Returns (version, stats) once there are newer stats than known_version,
+        or the same version again after timeout."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.version != known_version or not self.running, timeout)
+            return self.version, self.stats
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+    @staticmethod
+    def get_changes(old_stats, new_stats):
+        return {key: value for key, value in new_stats.items() if old_stats.get(key) != value}
+
+
+class OverlayRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        overlay = self.server.overlay
+        if self.path in ("/", "/stats"):
+            self.send_stats(overlay.get_stats())
+        elif self.path == "/events":
+            self.send_events(overlay)
+        elif self.path == "/metrics" and overlay.get_metrics() is not None:
+            self.send_metrics(overlay.get_metrics())
+        else:
+            self.send_error(404)
+
+    def send_headers(self, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Access-Control-Allow-Origin", "*")  # overlays are local pages
+
+    def send_stats(self, stats):
+        body = json.dumps(stats).encode()
+        self.send_headers("application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_metrics(self, text):
+        body = text.encode()
+        self.send_headers("text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_events(self, overlay):
+        self.send_headers("text/event-stream")
+        self.end_headers()
+        sent_version, sent_stats = None, {}
+        try:
+            while overlay.running:
+                version, stats = overlay.wait_for_stats(sent_version, overlay.KEEPALIVE_INTERVAL)
+                if version == sent_version:
+                    self.wfile.write(b": keepalive\n\n")
+                else:
+                    changes = stats if sent_version is None else overlay.get_changes(sent_stats, stats)
+                    self.wfile.write(b"data: " + json.dumps(changes).encode() + b"\n\n")
+                    sent_version, sent_stats = version, stats
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the overlay went away
+
+    def log_message(self, format, *args):
+        pass  # no printing for every request
@@ -1,82 +1,441 @@
+from collections import Counter
+import json
+import math
+import multiprocessing
 import os
+import threading
+import time
 from ATReading import *
-from ATLogging import ATLogger
+from ATArchiving import FrameArchiveFormat, FrameArchiver
+from ATLocating import ATLocator
+from ATCapturing import FlightRecorder, FrameRecording, FramesExhausted, LiveFrameSource, RecordingFrameSource, \
+    ThreadedFrameSource, PollingScheduler
+from ATLogging import ATLogger, BinaryATLogger
+from ATProfiling import PhaseProfiler
+from ATSharing import SharedCapture, SharedFrameSource, SharedMemoryCapture
+from ATAnalysing import LogIndexer
+from BackgroundWriting import BackgroundWriter
+from OverlayServing import OverlayServer
 from Preferences import PreferencesManager
 
 
 class Practise:
-    def __init__(self):
+    METRICS_INTERVAL = 5  # seconds between writing the phase metrics
+
+    def __init__(self, frame_source=None, target_number=1, bbox=None, writer=None):
+        self.frame_source = frame_source  # the live screen if None
+        self.target_number = target_number  # which of the ATs read at once (see MultiPractise)
         self.bbox, self.log_short, self.log_filename = None, None, None
+        self.log_binary = False
+        self.threaded_capture = False
+        self.use_regions = False
+        self.use_colour_table = False
+        self.idle_interval = PollingScheduler.IDLE_INTERVAL
+        self.write_interval = BackgroundWriter.FLUSH_INTERVAL
+        self.problem_frames = FlightRecorder.FRAMES
+        self.problem_quota = FlightRecorder.QUOTA // (1024 * 1024)
+        self.overlay_port = 0
+        self.auto_locate = False
         self.load_preferences()
-        self.reader = ATReader(self.bbox)
-        self.logger = ATLogger(self.log_short, self.log_filename)
-        self.all_time = AllTimeStats()
+        self.is_one_of_several = bbox is not None
+        if self.is_one_of_several:
+            self.bbox = bbox
+            self.threaded_capture = True  # the shared capture is
+            self.log_filename = self.get_target_filename(self.log_filename)
+        if self.frame_source is None:
+            self.frame_source = self.make_live_frame_source()
+        self.make_session_recording()
+        self.locator = self.make_locator()
+        self.owns_writer = writer is None
+        self.writer = writer or BackgroundWriter(self.write_interval)
+        self.flight_recorder = self.make_flight_recorder()
+        self.archiver = self.make_archiver()
+        self.profiler = self.make_profiler()
+        self.metrics_time = 0.  # perf_counter when the metrics were last written
+        self.reader = self.make_reader()
+        if self.locator is not None:
+            self.locate_at()
+        logger_class = BinaryATLogger if self.log_binary else ATLogger
+        self.logger = logger_class(self.log_short, self.log_filename, self.writer)
+        self.all_time = self.make_all_time_stats()
         self.session = Session()
-        self.info_text = InfoTextManager(self)
+        self.capture_timings = CaptureTimings()
+        self.overlay = self.make_overlay()
+        self.info_text = InfoTextManager(self, self.writer, self.overlay,
+                                         self.get_target_filename(InfoTextManager.INFO_FILENAME))
         self.info_text.update()
 
+    def get_target_filename(self, filename):
+        """The ATs after the first one get files of their own, e.g. ATs-2.log."""
+        if self.target_number == 1:
+            return filename
+        name, extension = os.path.splitext(filename)
+        return f"{name}-{self.target_number}{extension}"
+
+    def make_all_time_stats(self):
+        if self.target_number == 1:
+            return AllTimeStats(self.logger.filepath)
+        return AllTimeStats(self.logger.filepath, self.get_target_filename("allTimeCheckpoint.json"), None)
+
+    def make_live_frame_source(self):
+        if self.threaded_capture:
+            return ThreadedFrameSource(LiveFrameSource(), self.bbox)
+        return LiveFrameSource()
+
+    def make_session_recording(self):
+        """Records every frame of the AT for ATReanalysing, named by when the session started."""
+        if not self.record_sessions:
+            return
+        folder = ATLogger.DATA_FOLDER_NAME + "/recordings"
+        os.makedirs(folder, exist_ok=True)
+        filename = self.get_target_filename(time.strftime("%Y-%m-%d_%H-%M-%S") + FrameRecording.EXTENSION)
+        print(f"-Recording the session to {folder}/{filename}")
+        if self.use_regions:
+            print("-Capturing the whole strip while recording, a replay needs every frame of it.")
+            self.use_regions = False
+        self.frame_source = RecordingFrameSource(self.frame_source, folder + "/" + filename, self.bbox)
+
+    def make_locator(self):
+        if not self.auto_locate or self.target_number != 1:
+            return None  # the other ATs' locations aren't in prefs to keep up to date
+        if not ATLocator.is_available():
+            print("---Locating the AT automatically needs NumPy.")
+            return None
+        return ATLocator(self.frame_source)
+
+    def locate_at(self):
+        location = self.locator.get_cached_location()
+        if location is not None and not self.reader.is_at_showing_at(location):
+            location = None  # remembered, but something else is there now
+        location = location or self.locator.locate()
+        if location is None:
+            print("-No AT on screen to locate yet, it will be looked for while waiting.")
+        elif ATReader.construct_bbox(*location) != self.bbox:
+            print(f"-AT located: {location[0]}-{location[1]}, {location[2]}")
+            self.reader.change_bbox(ATReader.construct_bbox(*location))
+            self.bbox = self.reader.bbox
+            self.save_bbox_to_prefs()
+
+    def save_bbox_to_prefs(self):
+        prefs = PreferencesManager.get_instance()
+        x_left, x_right, y_top = ATReader.get_location(self.bbox)
+        prefs.set_value_by_key_name("xLeft", x_left)
+        prefs.set_value_by_key_name("xRight", x_right)
+        prefs.set_value_by_key_name("yTop", y_top)
+
+    def make_flight_recorder(self):
+        if self.problem_frames <= 0:
+            return None  # problem images get saved on their own like before
+        folder = ATLogger.DATA_FOLDER_NAME + "/" + self.get_target_filename("problems")
+        quota = self.problem_quota * 1024 * 1024
+        self.frame_source = FlightRecorder(self.frame_source, self.bbox, self.writer, folder,
+                                           self.problem_frames, quota)
+        return self.frame_source
+
+    def make_archiver(self):
+        if not self.archive_frames:
+            return None
+        folder = ATLogger.DATA_FOLDER_NAME + "/archives"
+        os.makedirs(folder, exist_ok=True)
+        filename = self.get_target_filename(time.strftime("%Y-%m-%d_%H-%M-%S") + FrameArchiveFormat.EXTENSION)
+        filepath = folder + "/" + filename
+        print(f"-Archiving every frame to {filepath}")
+        self.frame_source = FrameArchiver(self.frame_source, filepath)
+        return self.frame_source
+
+    def make_overlay(self):
+        if self.overlay_port <= 0 or self.target_number != 1:
+            return None
+        try:
+            overlay = OverlayServer(self.overlay_port)
+        except OSError as error:
+            print(f"---Overlay server couldn't start on port {self.overlay_port} ({error}), writing the text file instead.")
+            return None
+        print(f"Overlay stats at http://{OverlayServer.HOST}:{self.overlay_port}/events")
+        return overlay
+
+    def make_reader(self):
+        if self.use_colour_table:
+            reader_class = TableATReader  # with or without NumPy
+        elif VectorisedATReader.is_available():
+            reader_class = VectorisedATReader
+        else:
+            reader_class = RawATReader
+        scheduler = PollingScheduler(self.idle_interval, self.frame_source.sleep)
+        frame_source = self.frame_source
+        if self.profiler is not None:
+            frame_source = self.profiler.wrap(frame_source)  # counts the reader's grabs
+        reader = reader_class(self.bbox, frame_source, self.writer, self.use_regions, scheduler,
+                              self.flight_recorder, self.locator)
+        reader.watch_interval = self.get_watch_interval()
+        reader.profiler = self.profiler
+        reader.archiver = self.archiver
+        if self.is_one_of_several:
+            reader.name = f"AT {self.target_number}"
+            reader.last_result_filename = self.get_target_filename(reader.last_result_filename)
+        return reader
+
+    def make_profiler(self):
+        if not self.profiling and self.profile_slowest == 0:
+            return None
+        if self.profile_slowest > 0:
+            print(f"-Profiling every AT to keep the {self.profile_slowest} slowest – reading is slower meanwhile.")
+        return PhaseProfiler(self.profile_slowest, ATLogger.DATA_FOLDER_NAME + "/" + self.get_target_filename("profiles"))
+
+    def get_watch_interval(self):
+        """Capturing the bar every 2x ms is enough for the press timing to be known within ±x ms."""
+        if not self.bar_accuracy:
+            return None
+        if self.threaded_capture:
+            print("---Bar timing accuracy only applies without threaded capture, capturing flat out.")
+            return None
+        print(f"-Capturing the bar every {2 * self.bar_accuracy} ms (press timing within ±{self.bar_accuracy} ms).")
+        return 2 * self.bar_accuracy / 1000
+
     def load_preferences(self):
         prefs = PreferencesManager.get_instance()
         self.load_bbox_from_prefs(prefs)
         self.load_batch_from_prefs(prefs)
         self.load_log_from_prefs(prefs)
+        self.threaded_capture = self.get_yes_no_from_prefs(prefs, "threadedCapture", False)
+        self.use_regions = self.get_yes_no_from_prefs(prefs, "smallRegions", False)
+        self.use_colour_table = self.get_yes_no_from_prefs(prefs, "colourTable", False)
+        self.idle_interval = prefs.get_value_by_key_name("idleInterval") / 1000
+        self.write_interval = prefs.get_value_by_key_name("writeInterval") / 1000
+        self.problem_frames = prefs.get_value_by_key_name("problemFrames")
+        self.problem_quota = prefs.get_value_by_key_name("problemQuota")
+        self.overlay_port = prefs.get_value_by_key_name("overlayPort")
+        self.auto_locate = self.get_yes_no_from_prefs(prefs, "autoLocate", False)
+        self.bar_accuracy = prefs.get_value_by_key_name("barAccuracy")
+        self.profiling = self.get_yes_no_from_prefs(prefs, "profiling", False)
+        self.profile_slowest = prefs.get_value_by_key_name("profileSlowest")
+        self.archive_frames = self.get_yes_no_from_prefs(prefs, "archiveFrames", False)
+        self.record_sessions = self.get_yes_no_from_prefs(prefs, "recordSessions", False)
 
     def load_bbox_from_prefs(self, prefs):
+        self.bbox = self.get_bbox_from_prefs(prefs)
+
+    @staticmethod
+    def get_bbox_from_prefs(prefs):
         x_left = prefs.get_value_by_key_name("xLeft")
         x_right = prefs.get_value_by_key_name("xRight")
         y_top = prefs.get_value_by_key_name("yTop")
-        self.bbox = ATReader.construct_bbox(x_left, x_right, y_top)
+        return ATReader.construct_bbox(x_left, x_right, y_top)
+
+    @staticmethod
+    def get_more_bboxes_from_prefs(prefs):
+        """The bboxes of the ATs to read besides the one above, from "x left x right y top; ..."."""
+        bboxes = []
+        for location in prefs.get_value_by_key_name("moreATs").split(";"):
+            if not location.strip():
+                continue
+            try:
+                x_left, x_right, y_top = map(int, location.replace(",", " ").split())
+            except ValueError:
+                print(f"---Preference error: {location.strip()} isn't an AT location (x left, x right, y top).")
+                continue
+            bboxes.append(ATReader.construct_bbox(x_left, x_right, y_top))
+        return bboxes
 
     def load_batch_from_prefs(self, prefs):
         Session.BATCH_SIZE = prefs.get_value_by_key_name("batchSize")
         InfoTextManager.BATCHES_TO_SHOW = prefs.get_value_by_key_name("batchesToShow")
+        rolling_window = prefs.get_value_by_key_name("rollingWindow")
+        if rolling_window < 1:
+            print(f"---Preference error: a rolling window of {rolling_window} ATs, it has to be at least 1.")
+        else:
+            SessionStatistics.ROLLING_WINDOW = rolling_window
 
     def load_log_from_prefs(self, prefs):
-        log_short_yn = prefs.get_value_by_key_name("logShort")
-        if log_short_yn == "y":
-            self.log_short = True
-        elif log_short_yn == "n":
-            self.log_short = False
-        else:
-            print("---Preference error: unknown answer for y/n.")
-            self.log_short = True  # default
+        self.log_short = self.get_yes_no_from_prefs(prefs, "logShort", True)
         self.log_filename = prefs.get_value_by_key_name("logFilename")
+        self.log_binary = self.get_yes_no_from_prefs(prefs, "logBinary", False)
+
+    @staticmethod
+    def get_yes_no_from_prefs(prefs, key_name, default):
+        answer = prefs.get_value_by_key_name(key_name)
+        if answer == "y":
+            return True
+        elif answer == "n":
+            return False
+        print("---Preference error: unknown answer for y/n.")
+        return default
 
     def start(self):
-        print("Session started.")
+        target = f" for AT {self.target_number}" if self.is_one_of_several else ""
+        print(f"Session started{target}.")
         self.logger.log_new_session(self.reader.bbox)
-        while True:
-            action_test = self.reader.read_at()
-            self.process_action_test(action_test)
-            time.sleep(.1)  # a tiny bit for the result to settle down
+        try:
+            while True:
+                action_test = self.reader.read_at()
+                if self.reader.bbox != self.bbox:
+                    self.on_at_moved()
+                if self.profiler is None:
+                    self.process_action_test(action_test)
+                else:
+                    self.profiler.run_phase("processing", self.process_action_test, action_test)
+                    self.profiler.finish_at(self.reader.at_number)
+                    if time.perf_counter() - self.metrics_time >= self.METRICS_INTERVAL:
+                        self.export_metrics()
+        finally:
+            self.close()
+
+    def on_at_moved(self):
+        self.bbox = self.reader.bbox
+        self.save_bbox_to_prefs()
+        self.logger.log_new_session(self.bbox)  # the width may have changed
+
+    def close(self):
+        print(self.reader.scheduler.get_summary())
+        print(self.capture_timings.get_summary())
+        self.export_capture_timings()
+        if self.profiler is not None:
+            self.export_metrics()  # the ATs since it was last written
+            self.profiler.close()
+        self.frame_source.close()
+        if self.overlay is not None:
+            self.overlay.close()
+        if self.owns_writer:
+            self.writer.close()  # writes everything still waiting
+        else:
+            self.writer.flush()
+        self.all_time.save()
+
+    def export_capture_timings(self, filename="captureTimings.json"):
+        filepath = ATLogger.DATA_FOLDER_NAME + "/" + self.get_target_filename(filename)
+        report = json.dumps(self.capture_timings.get_report(), indent=2)
+        self.writer.replace(filepath, report)
+
+    def export_metrics(self, filename="metrics.prom"):
+        self.metrics_time = time.perf_counter()
+        text = self.profiler.get_metrics_text()
+        self.writer.replace(ATLogger.DATA_FOLDER_NAME + "/" + self.get_target_filename(filename), text)
+        if self.overlay is not None:
+            self.overlay.publish_metrics(text)
 
     def process_action_test(self, action_test):
         self.logger.log_at(action_test)
         self.session.add_action_test(action_test)
+        self.capture_timings.add_action_test(action_test)
         self.all_time.add_action_test(action_test, self.session.chain)
-        self.info_text.update()
+        self.info_text.update(action_test)
 
 
-class AllTimeStats:
-    DATA_FOLDER_NAME = ATLogger.DATA_FOLDER_NAME
+class MultiPractise:
+    """Reads several ATs at once – other clients or spectated players on the same screen –
+    from one SharedCapture, so every frame gets grabbed once however many ATs there are.
 
-    def __init__(self, filename="allTimeData.txt"):
-        self.filepath = self.DATA_FOLDER_NAME + "/" + filename
-        if not self.does_file_exist():
-            ATLogger.make_data_folder()
-            self.make_new_file()
-        self.greens, self.total_ats, self.best_chain = self.read_saved_data()
+    Every AT gets a Practise of its own, with its own reader, log, stats and files
+    (ATs-2.log, sessionInfo-2.txt, ...). The first one keeps the overlay and locating; the
+    others run on threads too, or in processes of their own to spread reading over the cores,
+    their frames shared through shared memory. The main thread only waits for the first one
+    to stop, so a Ctrl-C can't interrupt it while it holds the shared capture's lock."""
+    JOIN_INTERVAL = .2  # seconds, how often waiting on the main thread gets to handle a Ctrl-C
+
+    def __init__(self, frame_source=None):
+        prefs = PreferencesManager.get_instance()
+        self.bboxes = [Practise.get_bbox_from_prefs(prefs)] + Practise.get_more_bboxes_from_prefs(prefs)
+        self.use_processes = Practise.get_yes_no_from_prefs(prefs, "moreATsProcesses", False)
+        capture_class = SharedMemoryCapture if self.use_processes else SharedCapture
+        self.capture = capture_class(frame_source or LiveFrameSource(), self.bboxes)
+        self.writer = BackgroundWriter(prefs.get_value_by_key_name("writeInterval") / 1000)
+        self.practise = Practise(SharedFrameSource(self.capture, self.bboxes[0]), 1, self.bboxes[0], self.writer)
+        self.practise_thread = threading.Thread(target=self.practise_first_at, name="AT 1", daemon=True)
+        self.error = None  # of the first AT's Practise, raised again on the main thread
+        self.workers = [self.make_worker(target_number, bbox)
+                        for target_number, bbox in enumerate(self.bboxes[1:], 2)]
+
+    def make_worker(self, target_number, bbox):
+        name = f"AT {target_number}"
+        if self.use_processes:
+            frame_source = self.capture.make_frame_source(bbox)
+            return multiprocessing.Process(target=practise_until_stopped, name=name,
+                                           args=(frame_source, target_number, bbox))
+        frame_source = SharedFrameSource(self.capture, bbox)
+        return threading.Thread(target=practise_until_stopped, name=name, daemon=True,
+                                args=(frame_source, target_number, bbox, self.writer))
+
+    def start(self):
+        regions = len(self.capture.regions)
+        print(f"Reading {len(self.bboxes)} ATs, grabbing {regions} region{'s' if regions != 1 else ''} per frame.")
+        for worker in self.workers:
+            worker.start()
+        self.practise_thread.start()
+        try:
+            while self.practise_thread.is_alive():
+                self.practise_thread.join(self.JOIN_INTERVAL)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+        if self.error is not None:
+            raise self.error
+
+    def practise_first_at(self):
+        try:
+            self.practise.start()
+        except FramesExhausted:
+            pass
+        except Exception as error:
+            self.error = error
+
+    def close(self):
+        self.capture.stop_capturing()  # the ATs stop at their next grab
+        self.practise_thread.join()
+        for worker in self.workers:
+            worker.join()
+        self.capture.close()  # only now, a process could still be attaching to its shared memory
+        print(self.capture.get_summary())
+        self.writer.close()
+
+
+def practise_until_stopped(frame_source, target_number, bbox, writer=None):
+    """Reads one of MultiPractise's ATs until the shared capture stops, or was closed before
+    it got going (FramesExhausted either way)."""
+    try:
+        Practise(frame_source, target_number, bbox, writer).start()
+    except (FramesExhausted, KeyboardInterrupt):
+        pass
 
-    def does_file_exist(self):
-        return os.path.isfile(self.filepath)
 
-    def make_new_file(self):
-        default_text = "0;0;0"
-        self.override_file(default_text)
+class AllTimeStats:
+    """All-time statistics, derived from the AT log by a LogIndexer.
 
-    def read_saved_data(self):
-        line = self.read_file()
-        return map(int, line.split(";"))
+    Only the log written since the last checkpoint gets read at startup. ATs counted in
+    the old allTimeData.txt file but missing from the log are kept as a baseline."""
+    DATA_FOLDER_NAME = ATLogger.DATA_FOLDER_NAME
+
+    def __init__(self, log_filepath, filename="allTimeCheckpoint.json", legacy_filename="allTimeData.txt"):
+        self.filepath = self.DATA_FOLDER_NAME + "/" + filename
+        self.legacy_filepath = None  # only the first AT's log replaced the old file
+        if legacy_filename is not None:
+            self.legacy_filepath = self.DATA_FOLDER_NAME + "/" + legacy_filename
+        ATLogger.make_data_folder()
+        self.indexer = LogIndexer(log_filepath, self.filepath)
+        self.indexer.update()
+        if not self.indexer.had_checkpoint:
+            self.indexer.extra["baseline"] = self.get_legacy_baseline()
+            self.indexer.save_checkpoint()
+        self.greens, self.total_ats, self.best_chain = self.get_totals()
+
+    def get_totals(self):
+        baseline = self.indexer.extra.get("baseline", [0, 0, 0])
+        greens = baseline[0] + self.indexer.get_state("greens")
+        total_ats = baseline[1] + self.indexer.get_state("total_ats")
+        best_chain = max(baseline[2], self.indexer.get_state("chains")["best"])
+        return greens, total_ats, best_chain
+
+    def get_legacy_baseline(self):
+        if self.legacy_filepath is None or not os.path.isfile(self.legacy_filepath):
+            return [0, 0, 0]
+        try:
+            with open(self.legacy_filepath, "r") as file:
+                greens, total_ats, best_chain = map(int, file.read().split(";"))
+        except ValueError:
+            return [0, 0, 0]
+        logged_greens = self.indexer.get_state("greens")
+        logged_ats = self.indexer.get_state("total_ats")
+        return [max(0, greens - logged_greens), max(0, total_ats - logged_ats), best_chain]
 
     def add_action_test(self, action_test, chain=0):
         self.total_ats += 1
@@ -84,27 +443,12 @@ class AllTimeStats:
             self.greens += 1
         if chain > self.best_chain:
             self.best_chain = chain
-        self.save()
 
     def save(self):
-        data = map(str, [self.greens, self.total_ats, self.best_chain])
-        to_write = ";".join(list(data))
-        self.override_file(to_write)
-
-    def read_file(self):
-        file = open(self.filepath, "r")
-        text = file.read()
-        file.close()
-        return text
-
-    def override_file(self, to_write):
-        try:
-            file = open(self.filepath, "w")
-        except PermissionError:
-            print(f"---Permission error to {self.filepath}!")
-            return
-        file.write(to_write)
-        file.close()
+        """Call once the log is written – catches the indexer up with it."""
+        self.indexer.update()
+        self.indexer.save_checkpoint()
+        self.greens, self.total_ats, self.best_chain = self.get_totals()
 
 
 class Session:
@@ -119,8 +463,10 @@ class Session:
         self.chain = 0
         self.best_chain = 0
         self.batches = []
+        self.statistics = SessionStatistics()
 
     def add_action_test(self, action_test):
+        self.statistics.add_action_test(action_test)
         if self.total_ats % self.BATCH_SIZE == 0:
             self.add_new_batch()
         self.increment_total_ats()
@@ -143,17 +489,276 @@ class Session:
         self.best_chain = max(self.chain, self.best_chain)
 
 
+class SessionStatistics:
+    """Statistics of the session that take the same time to update after every AT, however
+    long it goes on: green rate over the last ROLLING_WINDOW ATs, streaks, and how early
+    or late the bar got stopped (last bar position – green position, in pixels)."""
+    ROLLING_WINDOW = 50
+    TIMING_PERCENTILES = (10, 50, 90)
+
+    def __init__(self):
+        self.recent_greens = RollingCount(self.ROLLING_WINDOW)
+        self.early = 0
+        self.late = 0
+        self.timing_offsets = OffsetHistogram()
+        self.streak = 0
+        self.finished_streaks = 0
+        self.finished_streak_ats = 0
+
+    def add_action_test(self, action_test):
+        is_green = action_test.result == ATResult.GREEN
+        self.recent_greens.add(is_green)
+        self.add_streak(is_green)
+        if action_test.bar_positions and action_test.green_position is not None:
+            offset = action_test.bar_positions[-1] - action_test.green_position
+            self.timing_offsets.add(offset)
+            if not is_green:
+                if offset > 0:
+                    self.late += 1
+                else:
+                    self.early += 1
+
+    def add_streak(self, is_green):
+        if is_green:
+            self.streak += 1
+        elif self.streak:
+            self.finished_streaks += 1
+            self.finished_streak_ats += self.streak
+            self.streak = 0
+
+    def get_mean_streak(self):
+        if self.finished_streaks == 0:
+            return None
+        return self.finished_streak_ats / self.finished_streaks
+
+    def get_timing_percentiles(self):
+        return self.timing_offsets.get_percentiles(self.TIMING_PERCENTILES)
+
+    def get_report(self):
+        return {"recent_ats": self.recent_greens.count, "recent_greens": self.recent_greens.total,
+                "early": self.early, "late": self.late, "mean_streak": self.get_mean_streak(),
+                "timing_offsets": {f"p{percentile}": offset for percentile, offset
+                                   in zip(self.TIMING_PERCENTILES, self.get_timing_percentiles())}}
+
+
+class RollingCount:
+    """How many of the last size values were true, in a ring buffer."""
+
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError(f"a rolling count needs room for at least one value, not {size}")
+        self.values = bytearray(size)
+        self.next_index = 0
+        self.count = 0
+        self.total = 0
+
+    def add(self, value):
+        if self.count == len(self.values):
+            self.total -= self.values[self.next_index]  # falls out of the window
+        else:
+            self.count += 1
+        self.values[self.next_index] = value
+        self.total += value
+        self.next_index = (self.next_index + 1) % len(self.values)
+
+
+class OffsetHistogram:
+    """Counts whole-pixel offsets. There are only as many different ones as the AT is wide,
+    so percentiles are exact without keeping every value."""
+
+    def __init__(self):
+        self.counts = Counter()
+        self.total = 0
+        self.percentiles = {}  # kept until the next add()
+
+    def add(self, offset):
+        self.counts[offset] += 1
+        self.total += 1
+        self.percentiles.clear()
+
+    def get_percentiles(self, percentiles):
+        """Walks the sorted offsets once for all the percentiles not known since the last add()."""
+        if self.total == 0:
+            return tuple(None for _ in percentiles)
+        missing = sorted(set(percentiles) - self.percentiles.keys())
+        if missing:
+            seen = 0
+            index = 0
+            for offset in sorted(self.counts):
+                seen += self.counts[offset]
+                while index < len(missing) and seen >= self.total * missing[index] / 100:
+                    self.percentiles[missing[index]] = offset
+                    index += 1
+                if index == len(missing):
+                    break
+            for percentile in missing[index:]:
+                self.percentiles[percentile] = offset
+        return tuple(self.percentiles[percentile] for percentile in percentiles)
+
+    def get_percentile(self, percentile):
+        return self.get_percentiles((percentile,))[0]
+
+
+class IntervalHistogram:
+    """Counts time intervals in logarithmic buckets (BUCKETS_PER_DECADE per power of ten
+    nanoseconds), so percentiles need constant memory however long the session."""
+    BUCKETS_PER_DECADE = 20
+    DECADES = 11  # up to 100 s
+
+    def __init__(self):
+        self.counts = [0] * (self.BUCKETS_PER_DECADE * self.DECADES + 1)
+        self.total = 0
+        self.max = 0
+
+    def add(self, interval_ns):
+        if interval_ns <= 0:
+            index = 0
+        else:
+            index = int(math.log10(interval_ns) * self.BUCKETS_PER_DECADE) + 1
+        self.counts[min(index, len(self.counts) - 1)] += 1
+        self.total += 1
+        self.max = max(self.max, interval_ns)
+
+    def get_percentile(self, percentile):
+        """The upper edge of the bucket the percentile falls into, in nanoseconds."""
+        if self.total == 0:
+            return None
+        wanted = self.total * percentile / 100
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted:
+                return min(self.max, int(10 ** (index / self.BUCKETS_PER_DECADE)))
+        return self.max
+
+    def get_report(self):
+        report = {"count": self.total, "max_ms": self.max / 1e6}
+        for percentile in (50, 95, 99):
+            value = self.get_percentile(percentile)
+            report[f"p{percentile}_ms"] = value / 1e6 if value is not None else None
+        return report
+
+
+class CaptureTimings:
+    """Inter-frame intervals of a session's captures, to tell capture problems from reading ones."""
+    STALL_THRESHOLD_NS = 20 * 10**6  # longer gaps while watching the bar are stalls
+
+    def __init__(self):
+        self.waiting = IntervalHistogram()
+        self.watching = IntervalHistogram()
+        self.watching_captures = 0
+        self.still_frames = 0
+        self.stalls = 0
+
+    def add_action_test(self, action_test):
+        self.add_intervals(self.waiting, action_test.wait_frame_times)
+        stalls = self.add_intervals(self.watching, action_test.frame_times)
+        self.stalls += stalls
+        self.watching_captures += len(action_test.frame_times)
+        self.still_frames += action_test.still_frames or 0
+
+    def add_intervals(self, histogram, frame_times):
+        stalls = 0
+        for previous, current in zip(frame_times, frame_times[1:]):
+            interval = current - previous
+            histogram.add(interval)
+            if interval > self.STALL_THRESHOLD_NS:
+                stalls += 1
+        return stalls
+
+    def get_still_frame_ratio(self):
+        if self.watching_captures == 0:
+            return None
+        return self.still_frames / self.watching_captures
+
+    def get_report(self):
+        return {"waiting": self.waiting.get_report(), "watching": self.watching.get_report(),
+                "still_frame_ratio": self.get_still_frame_ratio(), "stalls": self.stalls}
+
+    def get_summary(self):
+        watching = self.watching.get_report()
+        if not watching["count"]:
+            return "Capture timing: nothing watched yet"
+        still_percentage = in_percent(self.still_frames, self.watching_captures, 1)
+        return (f"Capture timing: p50 {watching['p50_ms']:.2f} ms, p99 {watching['p99_ms']:.2f} ms, "
+                f"max {watching['max_ms']:.2f} ms, {still_percentage}% still frames, {self.stalls} stalls")
+
+
 class InfoTextManager:
+    """Keeps sessionInfo.txt up to date, or publishes the stats to the overlay server instead.
+    Only the sections whose numbers changed get made again, and the file only gets written
+    if its text changed."""
     INFO_FILENAME = "sessionInfo.txt"
     BATCHES_TO_SHOW = 5
 
-    def __init__(self, practise_object):
+    def __init__(self, practise_object, writer=None, overlay=None, filename=INFO_FILENAME):
         self.practise = practise_object
-
-    def update(self):
-        sections = [self.get_all_time_section(), self.get_session_section(), self.get_batches_section()]
+        self.writer = writer
+        self.overlay = overlay
+        self.filename = filename
+        self.section_keys = {}  # section function: the numbers it was made from
+        self.section_texts = {}
+        self.batch_texts = []  # finished batches don't change anymore
+        self.last_text = None
+
+    def update(self, last_action_test=None):
+        if self.overlay is not None:
+            self.overlay.publish(self.get_stats(last_action_test))
+            return
+        sections = [self.get_section(self.get_all_time_section, self.get_all_time_key()),
+                    self.get_section(self.get_session_section, self.get_session_key()),
+                    self.get_section(self.get_batches_section, self.get_batches_key()),
+                    self.get_section(self.get_recent_section, self.get_recent_key())]
         to_write = "\n\n".join(sections)
-        self.override_info_file(to_write)
+        if to_write != self.last_text:
+            self.override_info_file(to_write)
+            self.last_text = to_write
+
+    def get_stats(self, last_action_test=None):
+        all_time, session = self.practise.all_time, self.practise.session
+        batches = session.batches[-self.BATCHES_TO_SHOW:]
+        first_batch_number = len(session.batches) - len(batches) + 1
+        stats = {"all_time": {"action_tests": all_time.total_ats, "greens": all_time.greens,
+                              "best_streak": all_time.best_chain},
+                 "session": {"action_tests": session.total_ats, "greens": session.greens,
+                             "best_streak": session.best_chain, "current_streak": session.chain},
+                 "batches": [{"number": number, "greens": batch[Session.BATCH_GREENS],
+                              "action_tests": batch[Session.BATCH_TOTAL]}
+                             for number, batch in enumerate(batches, first_batch_number)],
+                 "recent": session.statistics.get_report(),
+                 "last_at": None}
+        if last_action_test is not None:
+            bar_positions = last_action_test.bar_positions
+            stats["last_at"] = {"result": ATResult.get_result_name(last_action_test.result),
+                                "green_position": last_action_test.green_position,
+                                "white_positions": list(last_action_test.white_positions),
+                                "last_bar_position": bar_positions[-1] if bar_positions else None}
+        return stats
+
+    def get_section(self, section_function, key):
+        if self.section_keys.get(section_function) != key:
+            self.section_texts[section_function] = section_function()
+            self.section_keys[section_function] = key
+        return self.section_texts[section_function]
+
+    def get_all_time_key(self):
+        all_time = self.practise.all_time
+        return all_time.greens, all_time.total_ats, all_time.best_chain
+
+    def get_session_key(self):
+        session = self.practise.session
+        return session.greens, session.total_ats, session.best_chain, session.chain
+
+    def get_batches_key(self):
+        batches = self.practise.session.batches
+        return len(batches), tuple(batches[-1]) if batches else None
+
+    def get_recent_key(self):
+        statistics = self.practise.session.statistics
+        recent = statistics.recent_greens
+        # a full window's count stays the same, and the percentiles mostly do too
+        return (recent.count, recent.total, statistics.early, statistics.late,
+                statistics.get_mean_streak(), statistics.get_timing_percentiles())
 
     def get_all_time_section(self):
         greens = self.practise.all_time.greens
@@ -181,12 +786,27 @@ Current streak: {current_chain}"""
 
     def get_batches_section(self):
         batch_amount = len(self.practise.session.batches)
+        del self.batch_texts[batch_amount:]
+        if self.batch_texts:
+            self.batch_texts.pop()  # the last one might have changed
+        for batch_index in range(len(self.batch_texts), batch_amount):
+            self.batch_texts.append(self.get_batch_text_with_index(batch_index))
         start_batch_index = max(0, batch_amount - self.BATCHES_TO_SHOW)
-        batch_texts = ["---BATCHES---"]
-        for batch_index in range(start_batch_index, batch_amount):
-            text = self.get_batch_text_with_index(batch_index)
-            batch_texts.append(text)
-        return "\n".join(batch_texts)
+        return "\n".join(["---BATCHES---"] + self.batch_texts[start_batch_index:])
+
+    def get_recent_section(self):
+        statistics = self.practise.session.statistics
+        recent = statistics.recent_greens
+        percentage = in_percent(recent.total, recent.count, 1)
+        mean_streak = statistics.get_mean_streak()
+        mean_streak = round(mean_streak, 1) if mean_streak is not None else "None"
+        p10, p50, p90 = statistics.get_timing_percentiles()
+        section = f"""---RECENT---
+Last {recent.count}: {recent.total} greens ({percentage}%)
+Early/late misses: {statistics.early}/{statistics.late}
+Average streak: {mean_streak}
+Timing p10/p50/p90 (px): {p10} / {p50} / {p90}"""
+        return section
 
     def get_batch_text_with_index(self, index):
         batch = self.practise.session.batches[index]
@@ -196,11 +816,14 @@ Current streak: {current_chain}"""
         return f"{index+1}) {greens}/{total_ats} ({percentage}%)"
 
     def override_info_file(self, to_write):
+        if self.writer is not None:
+            self.writer.replace(self.filename, to_write)
+            return
         try:
-            with open(self.INFO_FILENAME, "w") as file:
+            with open(self.filename, "w") as file:
                 file.write(to_write)
         except PermissionError:
-            print(f"---Permission error to {self.INFO_FILENAME}!")
+            print(f"---Permission error to {self.filename}!")
 
 
 def in_percent(portion, total, decimal_places=1):
@@ -213,5 +836,8 @@ def in_percent(portion, total, decimal_places=1):
 
 
 if __name__ == "__main__":
-    practise = Practise()
+    if Practise.get_more_bboxes_from_prefs(PreferencesManager.get_instance()):
+        practise = MultiPractise()
+    else:
+        practise = Practise()
     practise.start()
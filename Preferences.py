@@ -11,8 +11,31 @@ class PreferencesManager:
                 ("AT top right X", 1084),
                 ("AT top Y", 895),
                 ("short logs (y/n)", "y"),
-                ("log filename", "ATs.log")]
-    KEY_NAMES = ["batchSize", "batchesToShow", "xLeft", "xRight", "yTop", "logShort", "logFilename"]
+                ("log filename", "ATs.log"),
+                ("threaded capture (y/n)", "n"),
+                ("file write interval (ms)", 500),
+                ("capture small regions (y/n)", "n"),
+                ("idle poll interval (ms)", 10),
+                ("binary log (y/n)", "n"),
+                ("colour lookup table (y/n)", "n"),
+                ("problem frames kept", 120),
+                ("problem frames disk quota (MB)", 50),
+                ("rolling window (ATs)", 50),
+                ("overlay server port (0 = off)", 0),
+                ("locate AT automatically (y/n)", "n"),
+                ("bar timing accuracy (ms, 0 = capture flat out)", 0),
+                ("phase metrics (y/n)", "n"),
+                ("profile slowest ATs (0 = off)", 0),
+                ("archive every frame (y/n)", "n"),
+                ("more ATs (x left x right y top; ...)", ""),
+                ("more ATs in own processes (y/n)", "n"),
+                ("record whole sessions (y/n)", "n")]
+    KEY_NAMES = ["batchSize", "batchesToShow", "xLeft", "xRight", "yTop", "logShort", "logFilename",
+                 "threadedCapture", "writeInterval", "smallRegions",
+                 "idleInterval", "logBinary", "colourTable", "problemFrames", "problemQuota",
+                 "rollingWindow", "overlayPort",
+                 "autoLocate", "barAccuracy", "profiling", "profileSlowest", "archiveFrames",
+                 "moreATs", "moreATsProcesses", "recordSessions"]
     _instance = None  # singleton
 
     def __init__(self):
@@ -33,11 +56,24 @@ class PreferencesManager:
         index = self.KEY_NAMES.index(key_name)
         return self.chosen_values[index]
 
+    def set_value_by_key_name(self, key_name, value):
+        if key_name not in self.KEY_NAMES:
+            raise Exception("Wrong preference key name: " + key_name)
+        index = self.KEY_NAMES.index(key_name)
+        self.chosen_values[index] = value
+        lines = []
+        for default, chosen_value in zip(self.DEFAULTS, self.chosen_values):
+            lines.append(default[0] + ": " + str(chosen_value))
+        self.override_file("\n".join(lines))
+
     def load_values(self):
         if not self.does_file_exist():
             ATLogger.make_data_folder()
             self.make_new_file()
         lines = self.read_file_lines()
+        if len(lines) < len(self.DEFAULTS) and self.are_lines_from_older_version(lines):
+            self.add_missing_defaults(lines)
+            lines = self.read_file_lines()
         if len(lines) < len(self.DEFAULTS):
             input("-Prefs file incomplete. Press enter to revert to defaults:")
             self.repair_file_and_reload()
@@ -53,6 +89,20 @@ class PreferencesManager:
         if self.repair_file_later:
             self.offer_file_repair()
 
+    def are_lines_from_older_version(self, lines):
+        # newer versions only add preferences to the end
+        for line, default in zip(lines, self.DEFAULTS):
+            if not line.startswith(default[0] + ":"):
+                return False
+        return True
+
+    def add_missing_defaults(self, lines):
+        new_lines = [line.rstrip("\n") for line in lines]
+        for default in self.DEFAULTS[len(lines):]:
+            new_lines.append(default[0] + ": " + str(default[1]))
+            print(f"-New preference added to prefs file: {default[0]}")
+        self.override_file("\n".join(new_lines))
+
     def get_value_via_lines_and_index(self, lines, index):
         line = lines[index]
         try:
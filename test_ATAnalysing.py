@@ -0,0 +1,160 @@
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+from ATAnalysing import AllTimeMetric, Chains, Greens, LogIndexer, SessionAnalysis, TotalATs
+from ATLogging import BinaryLogFormat, TextLogFormat
+from ATReading import ActionTest, ATResult
+
+
+class SessionAnalysisTest(unittest.TestCase):
+    """The rolling green rate slides over the last ATs rather than jumping a whole window at a time."""
+
+    @staticmethod
+    def make_at(result):
+        action_test = ActionTest()
+        action_test.result = result
+        return action_test
+
+    def test_rolling_green_rates(self):
+        analysis = SessionAnalysis()
+        results = [ATResult.GREEN] * 150 + [ATResult.RED] * 150
+        for result in results:
+            analysis.add_action_test(self.make_at(result))
+        window, step = SessionAnalysis.ROLLING_WINDOW, SessionAnalysis.ROLLING_STEP
+        expected = [results[end - window:end].count(ATResult.GREEN) / window
+                    for end in range(window, len(results) + 1, step)]
+        self.assertEqual(analysis.rolling_green_rates, expected)
+        self.assertIn(.5, analysis.rolling_green_rates)  # halfway through the change to red
+
+    def test_no_rolling_rate_before_a_full_window(self):
+        analysis = SessionAnalysis()
+        for _ in range(SessionAnalysis.ROLLING_WINDOW - 1):
+            analysis.add_action_test(self.make_at(ATResult.GREEN))
+        self.assertEqual(analysis.rolling_green_rates, [])
+
+
+class CountingMetric(AllTimeMetric):
+    """Counts the ATs it gets shown, to tell which ones got read again."""
+    name = "read"
+
+    def add_action_test(self, state, action_test):
+        return state + 1
+
+
+class LogIndexerTest(unittest.TestCase):
+    """The checkpoint has to give the same metrics as reading the whole log, while only reading
+    what got appended – unless the log isn't the one the checkpoint was made for."""
+    SESSION_LINE = TextLogFormat.get_session_line(1.3, "01. 02. 2022 10:00", 250)
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.log_filepath = os.path.join(self.folder.name, "ATs.log")
+        self.checkpoint_filepath = os.path.join(self.folder.name, "allTime.json")
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    @staticmethod
+    def make_line(result):
+        action_test = ActionTest()
+        action_test.result = result
+        action_test.green_position = 120
+        action_test.white_positions = [100, 140]
+        action_test.bar_positions.append(121)
+        action_test.still_frames = 3
+        action_test.captures_per_second = 400.
+        return action_test.get_log_line(True) + "\n"
+
+    def write(self, text, mode="a"):
+        with open(self.log_filepath, mode) as file:
+            file.write(text)
+
+    def write_session(self, results, mode="a"):
+        self.write(self.SESSION_LINE + "\n" + "".join(self.make_line(result) for result in results), mode)
+
+    def index(self, metrics=None):
+        indexer = LogIndexer(self.log_filepath, self.checkpoint_filepath,
+                             (metrics or [TotalATs(), Greens(), Chains()]) + [CountingMetric()])
+        indexer.update()
+        indexer.save_checkpoint()
+        return indexer
+
+    def test_resumes_from_the_checkpoint(self):
+        green, red = ATResult.GREEN, ATResult.RED
+        self.write_session([green, green, red, green])
+        self.index()
+        self.write_session([green, green, green, red])
+        indexer = self.index()
+        self.assertTrue(indexer.had_checkpoint)
+        self.assertEqual(indexer.get_state("read"), 8)  # the same counting state, carried on
+        self.assertEqual(indexer.get_state("total_ats"), 8)
+        self.assertEqual(indexer.get_state("greens"), 6)
+        self.assertEqual(indexer.get_state("chains"), {"current": 0, "best": 3})
+        os.remove(self.checkpoint_filepath)
+        self.assertEqual(self.index().states, indexer.states)
+
+    def test_only_appended_ats_get_read(self):
+        self.write_session([ATResult.GREEN] * 3)
+        self.index()
+        self.write(self.make_line(ATResult.RED))
+        indexer = LogIndexer(self.log_filepath, self.checkpoint_filepath, [CountingMetric()])
+        indexer.states["read"] = 0  # so only what gets read now counts
+        indexer.update()
+        self.assertEqual(indexer.get_state("read"), 1)
+
+    def test_unfinished_line_waits(self):
+        self.write_session([ATResult.GREEN])
+        line = self.make_line(ATResult.GREEN)
+        self.write(line[:10])  # still being written
+        self.assertEqual(self.index().get_state("total_ats"), 1)
+        self.write(line[10:])
+        self.assertEqual(self.index().get_state("total_ats"), 2)
+
+    def test_unfinished_binary_record_waits(self):
+        action_test = TextLogFormat.parse_line(self.make_line(ATResult.GREEN))[1][0]
+        record = BinaryLogFormat.pack_at(action_test, True)
+        with open(self.log_filepath, "wb") as file:
+            file.write(BinaryLogFormat.MAGIC + BinaryLogFormat.pack_session("1.3", "01. 02. 2022 10:00", 250)
+                       + record + record[:5])
+        self.assertEqual(self.index().get_state("total_ats"), 1)
+        with open(self.log_filepath, "ab") as file:
+            file.write(record[5:] + record)
+        self.assertEqual(self.index().get_state("total_ats"), 3)
+
+    def test_other_log_gets_read_from_the_start(self):
+        self.write_session([ATResult.GREEN] * 5)
+        self.index()
+        self.write_session([ATResult.RED] * 6, mode="w")  # replaced by a longer one
+        indexer = self.index()
+        self.assertEqual(indexer.get_state("total_ats"), 6)
+        self.assertEqual(indexer.get_state("greens"), 0)
+
+    def test_shortened_log_gets_read_from_the_start(self):
+        self.write_session([ATResult.GREEN] * 5)
+        self.index()
+        self.write_session([ATResult.GREEN] * 2, mode="w")
+        self.assertEqual(self.index().get_state("total_ats"), 2)
+
+    def test_new_metric_gets_replayed(self):
+        self.write_session([ATResult.GREEN, ATResult.RED, ATResult.GREEN])
+        self.index([TotalATs()])
+        self.write_session([ATResult.GREEN])
+        indexer = self.index([TotalATs(), Greens()])
+        self.assertEqual(indexer.get_state("total_ats"), 4)
+        self.assertEqual(indexer.get_state("greens"), 3)
+
+    def test_broken_checkpoint_gets_rebuilt(self):
+        self.write_session([ATResult.GREEN] * 2)
+        with open(self.checkpoint_filepath, "w") as file:
+            file.write("{broken")
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            indexer = self.index()
+        self.assertFalse(indexer.had_checkpoint)
+        self.assertIn("broken", output.getvalue())
+        self.assertEqual(indexer.get_state("total_ats"), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,34 @@
+import contextlib
+import copy
+import io
+import unittest
+from ATBenchmarking import CASES, Benchmark, CorpusSource, MemoryFrameSource
+from ATReading import RawATReader
+
+
+class ATBenchmarkingTest(unittest.TestCase):
+    """Every case has to read as the ATs it recorded, or its timings measure something else."""
+
+    def test_every_case_reads_its_ats(self):
+        for case in CASES:
+            with self.subTest(case=case.name):
+                source = MemoryFrameSource(CorpusSource(case).record(Benchmark.CYCLES))
+                reader = Benchmark.make_reader(RawATReader, case, source)
+                with contextlib.redirect_stdout(io.StringIO()):  # problems get printed
+                    self.assertEqual(Benchmark.read_all(reader), Benchmark.CYCLES)
+
+    def test_noise_keeps_colours_classified(self):
+        for case in [case for case in CASES if case.noise]:
+            source = CorpusSource(case)
+            clean_case = copy.copy(case)
+            clean_case.noise = 0
+            clean = CorpusSource(clean_case)
+            for t in (0., source.gap_time + source.settle_time + .05):  # background and bar moving
+                noisy_img, clean_img = source.get_frame_at(t), clean.get_frame_at(t)
+                self.assertNotEqual(noisy_img.raw, clean_img.raw)
+                for i in range(0, len(clean_img.raw), 4):
+                    self.assertEqual(source.classify(noisy_img.raw[i:i + 3]), source.classify(clean_img.raw[i:i + 3]))
+
+
+if __name__ == "__main__":
+    unittest.main()
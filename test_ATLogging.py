@@ -0,0 +1,151 @@
+from array import array
+import os
+import tempfile
+import unittest
+from ATLogging import BinaryATLogger, BinaryLogFormat, BinaryLogReader, LogEntry, TextLogFormat, \
+    convert_binary_to_text, convert_text_to_binary
+from ATReading import ActionTest, ATResult
+
+
+class BinaryLogTest(unittest.TestCase):
+    """The binary log has to hold everything the text log does, and converting between them
+    may only lose what text can't hold – the capture times of the bar positions."""
+    BBOX = (0, 2, 250, 5)
+    TEXT_LINES = ["---New Session (v1.2) (01. 02. 2022 10:00) (250 pixels wide)",
+                  "green 120 100-140 [2, 5, 9, 120] 3 412.5",
+                  "white 120 100-140 118 3 412.5",
+                  "red None None-None ? None None",
+                  "red 120 100-140 [] 5 100.25",
+                  "garbage line",
+                  "",
+                  "white 120 100-140 [1,2] 3 412.5",  # not how it gets logged – kept as text
+                  "red 120 100-140 99999999 3 412.5",  # too big for a position – kept as text
+                  "---New Session (v1.3) (01. 02. 2022 11:00) (500 pixels wide)",
+                  "red 120 100-140 130 5 100.25 +6.3+-2.1ms",
+                  "white 120 100-140 [7, 9, 111] 3 412.5 +40.0+-2.5ms +90.0/-30.5ms"]
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.old_cwd = os.getcwd()
+        os.chdir(self.folder.name)
+
+    def tearDown(self):
+        os.chdir(self.old_cwd)
+        self.folder.cleanup()
+
+    @staticmethod
+    def make_at(result=ATResult.WHITE, bar_positions=(3, 50, 98, 111), press_timing=(40., 2.5),
+                white_offsets=(90., -30.5)):
+        action_test = ActionTest()
+        action_test.result = result
+        action_test.green_position = 120
+        action_test.white_positions = [100, 140]
+        action_test.still_frames = 3
+        action_test.captures_per_second = 412.5
+        action_test.bar_positions = array("H", bar_positions)
+        action_test.bar_times = array("q", [1_000_000 * i + 123 for i in range(len(bar_positions))])
+        action_test.press_offset, action_test.press_uncertainty = press_timing or (None, None)
+        action_test.white_offsets = list(white_offsets) if white_offsets else None
+        return action_test
+
+    def assert_same_at(self, action_test, expected, bar_times=None):
+        for name in ("result", "green_position", "white_positions", "still_frames", "captures_per_second",
+                     "bar_positions", "press_offset", "press_uncertainty", "white_offsets"):
+            self.assertEqual(getattr(action_test, name), getattr(expected, name), name)
+        self.assertEqual(action_test.bar_times, expected.bar_times if bar_times is None else bar_times)
+
+    def unpack(self, record):
+        kind, data, end = BinaryLogFormat.unpack_entry(record, 0)
+        self.assertEqual(end, len(record))
+        return kind, data
+
+    def test_at_records(self):
+        for action_test in (self.make_at(), self.make_at(ATResult.RED, (), None, None),
+                            self.make_at(ATResult.GREEN, white_offsets=None)):
+            kind, (unpacked, log_short) = self.unpack(BinaryLogFormat.pack_at(action_test, False))
+            self.assertEqual((kind, log_short), (LogEntry.AT, False))
+            self.assert_same_at(unpacked, action_test)
+
+    def test_short_at_record_keeps_the_last_position(self):
+        action_test = self.make_at()
+        kind, (unpacked, log_short) = self.unpack(BinaryLogFormat.pack_at(action_test, True))
+        self.assertTrue(log_short)
+        self.assertEqual(unpacked.bar_positions, action_test.bar_positions[-1:])
+        self.assertEqual(unpacked.bar_times, action_test.bar_times[-1:])
+        self.assertEqual(unpacked.get_log_line(True), action_test.get_log_line(True))
+
+    def test_unknown_values(self):
+        action_test = self.make_at(ATResult.RED, (), None, None)
+        action_test.green_position = None
+        action_test.white_positions = [None, None]
+        action_test.still_frames = None
+        action_test.captures_per_second = None
+        kind, (unpacked, log_short) = self.unpack(BinaryLogFormat.pack_at(action_test, False))
+        self.assert_same_at(unpacked, action_test)
+
+    def test_session_and_text_records(self):
+        session = ("1.3", "01. 02. 2022 10:00", 250)
+        self.assertEqual(self.unpack(BinaryLogFormat.pack_entry(LogEntry.SESSION, session)),
+                         (LogEntry.SESSION, session))
+        self.assertEqual(self.unpack(BinaryLogFormat.pack_entry(LogEntry.TEXT, "ümlaut")), (LogEntry.TEXT, "ümlaut"))
+
+    def test_logger_and_index(self):
+        logger = BinaryATLogger()
+        ats = [self.make_at(), self.make_at(ATResult.GREEN), self.make_at(ATResult.RED, (4, 9), None, None)]
+        logger.log_new_session(self.BBOX)
+        logger.log_at(ats[0])
+        logger.log_at(ats[1])
+        logger.log_new_session(self.BBOX)
+        logger.log_at(ats[2])
+        logger.file.close()
+        reader = BinaryLogReader(logger.filepath)
+        try:
+            self.assertEqual(reader.get_session_offsets(), reader.find_session_offsets())
+            self.assertEqual(len(reader.get_session_offsets()), 2)
+            entries = list(reader.read_session(1))
+            self.assertEqual([kind for kind, data in entries], [LogEntry.SESSION, LogEntry.AT])
+            self.assertEqual(entries[0][1][2], self.BBOX[2] - self.BBOX[0])
+            self.assert_same_at(entries[1][1][0], ats[2])
+            self.assertEqual(len(list(reader.read_entries())), 5)
+        finally:
+            reader.close()
+
+    def test_text_to_binary_and_back(self):
+        with open("ATs.log", "w") as file:
+            file.write("\n".join(self.TEXT_LINES) + "\n")
+        convert_text_to_binary("ATs.log", "ATs.bin")
+        convert_binary_to_text("ATs.bin", "ATs2.log")
+        with open("ATs2.log", "r") as file:
+            self.assertEqual(file.read().split("\n")[:-1], self.TEXT_LINES)
+        reader = BinaryLogReader("ATs.bin")
+        try:
+            kinds = [kind for kind, data in reader.read_entries()]
+            self.assertEqual(kinds.count(LogEntry.TEXT), 4)
+            self.assertEqual(len(reader.get_session_offsets()), 2)  # from the index written alongside
+        finally:
+            reader.close()
+
+    def test_binary_to_text_loses_only_the_bar_times(self):
+        logger = BinaryATLogger()
+        ats = [self.make_at(), self.make_at(ATResult.GREEN, press_timing=(-6.3, 2.1), white_offsets=None)]
+        logger.log_new_session(self.BBOX)
+        for action_test in ats:
+            logger.log_at(action_test)
+        logger.file.close()
+        convert_binary_to_text(logger.filepath, "ATs.log")
+        entries = list(TextLogFormat.read_entries("ATs.log"))
+        self.assertEqual(entries[0][0], LogEntry.SESSION)
+        for (kind, (action_test, log_short)), expected in zip(entries[1:], ats):
+            self.assertEqual(kind, LogEntry.AT)
+            self.assert_same_at(action_test, expected, bar_times=array("q"))
+        convert_text_to_binary("ATs.log", "ATs.bin")
+        reader = BinaryLogReader("ATs.bin")
+        try:
+            for (kind, (action_test, log_short)), expected in zip(list(reader.read_entries())[1:], ats):
+                self.assert_same_at(action_test, expected, bar_times=array("q"))
+        finally:
+            reader.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
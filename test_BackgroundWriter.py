@@ -0,0 +1,70 @@
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+from BackgroundWriting import BackgroundWriter
+
+
+class BackgroundWriterTest(unittest.TestCase):
+    """Whatever goes wrong with one write, the writer thread has to keep writing the rest."""
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.writer = BackgroundWriter(flush_interval=.01)
+
+    def tearDown(self):
+        self.writer.close()
+        self.folder.cleanup()
+
+    def path(self, filename):
+        return os.path.join(self.folder.name, filename)
+
+    def read(self, filename, mode="r"):
+        with open(self.path(filename), mode) as file:
+            return file.read()
+
+    def test_appends_in_order(self):
+        for line in ("a\n", "b\n", "c\n"):
+            self.writer.append(self.path("log.txt"), line)
+        self.writer.flush()
+        self.writer.append(self.path("log.txt"), "d\n")
+        self.writer.close()
+        self.assertEqual(self.read("log.txt"), "a\nb\nc\nd\n")
+
+    def test_replace_keeps_latest_content(self):
+        self.writer.replace(self.path("info.txt"), "old")
+        self.writer.replace(self.path("info.txt"), "new")
+        self.writer.replace(self.path("frames.bin"), lambda: b"\x00\x01")
+        self.writer.flush()
+        self.assertEqual(self.read("info.txt"), "new")
+        self.assertEqual(self.read("frames.bin", "rb"), b"\x00\x01")
+        self.assertEqual(sorted(os.listdir(self.folder.name)), ["frames.bin", "info.txt"])  # no .tmp left
+
+    def test_failing_content_function(self):
+        def encode():
+            raise ValueError("can't encode")
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.writer.replace(self.path("broken.png"), encode)
+            self.writer.replace(self.path("info.txt"), "written anyway")
+            self.writer.flush()
+            self.writer.append(self.path("log.txt"), "later\n")
+            self.writer.flush()
+        self.assertTrue(self.writer.thread.is_alive())
+        self.assertIn("broken.png", output.getvalue())
+        self.assertFalse(os.path.exists(self.path("broken.png")))
+        self.assertEqual(self.read("info.txt"), "written anyway")
+        self.assertEqual(self.read("log.txt"), "later\n")
+
+    def test_failing_append(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.writer.append(self.path("missing/log.txt"), "lost\n")
+            self.writer.flush()
+        self.writer.append(self.path("log.txt"), "kept\n")
+        self.writer.flush()
+        self.assertTrue(self.writer.thread.is_alive())
+        self.assertEqual(self.read("log.txt"), "kept\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+from array import array
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+from ATBenchmarking import BenchmarkCase, CorpusSource, MemoryFrameSource
+from ATReading import ActionTest, BarMotion, RawATReader
+
+
+class BarMotionTest(unittest.TestCase):
+    """The press timing comes from a line through the captured bar positions – it has to be
+    right to within the uncertainty it gives, however often the bar got captured."""
+    SPEED = 250.  # pixels per second
+    GREEN = 120
+    WHITE = [100, 140]
+
+    def capture(self, press_position, interval, start_wait=0., first_time=1_000_000_000):
+        """The positions and times a reader capturing every interval seconds would get, and when
+        it first saw the bar gone. The bar waits at x = 1 for start_wait seconds first."""
+        press_time = start_wait + (press_position - 1) / self.SPEED
+        positions, times = array("H"), array("q")
+        t = 0.
+        while t <= press_time:
+            x = 1 + int(max(0., t - start_wait) * self.SPEED)
+            if not positions or x != positions[-1]:
+                positions.append(x)
+                times.append(first_time + round(t * 1e9))
+            t += interval
+        return positions, times, first_time + round(t * 1e9)
+
+    def get_true_offset(self, press_position, x):
+        return (press_position - x) / self.SPEED * 1000
+
+    def test_press_timing(self):
+        for interval in (.001, .004, .01):
+            for press_position in (60, 118, 121, 135):
+                with self.subTest(interval=interval, press_position=press_position):
+                    motion = BarMotion.fit(*self.capture(press_position, interval))
+                    self.assertAlmostEqual(motion.speed, self.SPEED, delta=self.SPEED * .05)
+                    error = motion.get_offset(self.GREEN) - self.get_true_offset(press_position, self.GREEN)
+                    self.assertLessEqual(abs(error), motion.get_uncertainty() + 1000 / self.SPEED)  # ± a pixel
+
+    def test_uncertainty_grows_with_the_capture_interval(self):
+        uncertainties = [BarMotion.fit(*self.capture(121, interval)).get_uncertainty()
+                         for interval in (.001, .004, .01)]
+        self.assertEqual(uncertainties, sorted(uncertainties))
+        self.assertLess(uncertainties[0], 5)
+
+    def test_wait_at_the_start_is_left_out(self):
+        motion = BarMotion.fit(*self.capture(121, .004, start_wait=.3))
+        self.assertAlmostEqual(motion.speed, self.SPEED, delta=self.SPEED * .05)
+
+    def test_not_enough_to_go_on(self):
+        positions, times, gone_time = self.capture(121, .004)
+        self.assertIsNone(BarMotion.fit(positions[:3], times[:3], gone_time))
+        self.assertIsNone(BarMotion.fit(positions, times[:-1], gone_time))  # times missing
+        self.assertIsNone(BarMotion.fit(array("H", [5, 5, 5, 5]), times[:4], gone_time))  # not moving
+        self.assertIsNone(BarMotion.fit(positions[:5], array("q", [times[0]] * 5), gone_time))
+
+    def test_without_gone_time(self):
+        positions, times, gone_time = self.capture(121, .004)
+        motion = BarMotion.fit(positions, times)
+        self.assertAlmostEqual(motion.stop_gap, .004, delta=.001)  # a typical gap instead
+
+    def test_white_offsets(self):
+        action_test = ActionTest()
+        action_test.green_position = self.GREEN
+        action_test.white_positions = list(self.WHITE)
+        press_position = 135
+        action_test.apply_bar_motion(BarMotion.fit(*self.capture(press_position, .004)))
+        for x, offset in zip(self.WHITE, action_test.white_offsets):
+            error = offset - self.get_true_offset(press_position, x)
+            self.assertLessEqual(abs(error), action_test.press_uncertainty + 1000 / self.SPEED)
+        # all from the same line, so exactly the sections' distances apart
+        self.assertAlmostEqual(action_test.white_offsets[0] - action_test.press_offset,
+                               (self.GREEN - self.WHITE[0]) / action_test.bar_speed * 1000)
+
+    def test_white_offsets_need_both_ends(self):
+        action_test = ActionTest()
+        action_test.green_position = self.GREEN
+        action_test.white_positions = [self.WHITE[0], None]
+        action_test.apply_bar_motion(BarMotion.fit(*self.capture(121, .004)))
+        self.assertIsNotNone(action_test.press_offset)
+        self.assertIsNone(action_test.white_offsets)
+
+    def test_reading_recorded_ats(self):
+        press_position = 131
+        case = BenchmarkCase("timing", 250, self.GREEN, self.WHITE, bar_speed=self.SPEED,
+                             press_position=press_position)
+        recording = CorpusSource(case).record(cycles=2)
+        reader = RawATReader(case.get_bbox(), MemoryFrameSource(recording))
+        old_cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as folder:  # for lastResult.png
+            os.chdir(folder)
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    action_tests = [reader.read_at() for _ in range(2)]
+            finally:
+                os.chdir(old_cwd)
+        for action_test in action_tests:
+            # the screen refreshes 144 times a second, so that's how precise it can get
+            tolerance = action_test.press_uncertainty + 1000 / 144
+            self.assertAlmostEqual(action_test.press_offset, self.get_true_offset(press_position, self.GREEN),
+                                   delta=tolerance)
+            self.assertAlmostEqual(action_test.white_offsets[1],
+                                   self.get_true_offset(press_position, self.WHITE[1]), delta=tolerance)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+import random
+import unittest
+from mss.screenshot import ScreenShot
+from ATCapturing import SyntheticFrameSource
+from ATReading import ATReader, Colour, ColourTable, TableATReader, VectorisedATReader, np
+
+
+@unittest.skipIf(np is None, "building the colour table in reasonable time needs NumPy")
+class ColourTableTest(unittest.TestCase):
+    """The colour table has to give exactly what the Colour predicates give."""
+    BBOX = ATReader.construct_bbox(0, 249, 2)
+    STRIPS = 300
+    # the AT's colours, to be mixed with noise so they land on both sides of the thresholds
+    COLOURS = [SyntheticFrameSource.BACKGROUND, SyntheticFrameSource.DARK, SyntheticFrameSource.GREEN,
+               SyntheticFrameSource.WHITE, SyntheticFrameSource.RED, SyntheticFrameSource.BAR,
+               SyntheticFrameSource.RESULT_RED, SyntheticFrameSource.RESULT_GREEN]
+
+    @classmethod
+    def setUpClass(cls):
+        cls.table = ColourTable.build()
+        ColourTable._instance = cls.table  # so TableATReader doesn't load one from the data folder
+
+    @classmethod
+    def tearDownClass(cls):
+        ColourTable._instance = None
+
+    def test_table_matches_predicates(self):
+        self.table.verify(step=251)  # a prime, so every channel value gets sampled
+
+    def test_table_matches_predicates_near_at_colours(self):
+        rng = random.Random(12)
+        for _ in range(20000):
+            rgb = self.make_colour(rng)
+            bits = self.table.classify(rgb)
+            for bit, name in enumerate(ColourTable.PREDICATE_NAMES):
+                self.assertEqual(bool(bits & (1 << bit)), getattr(Colour, name)(rgb), f"{name}{rgb}")
+
+    def make_colour(self, rng):
+        if rng.random() < .2:
+            return tuple(rng.randrange(256) for _ in range(3))
+        return self.add_noise(rng, rng.choice(self.COLOURS), 40)
+
+    @staticmethod
+    def add_noise(rng, colour, amount):
+        return tuple(min(255, max(0, channel + rng.randint(-amount, amount))) for channel in colour)
+
+    def make_strip(self, rng):
+        x_left, y_top, x_right, y_bottom = self.BBOX
+        width, height = x_right - x_left, y_bottom - y_top
+        rows = [[None] * width for _ in range(height)]
+        dark_top = rng.random() < .5  # like an AT's, mostly
+        x = 0
+        while x < width:  # runs of colours, like an AT's sections
+            end = min(width, x + rng.randint(1, 40))
+            for y in range(height):
+                colour = self.make_colour(rng)
+                if y == 0 and dark_top and rng.random() < .9:
+                    colour = self.add_noise(rng, SyntheticFrameSource.DARK, 15)
+                for column in range(x, end):
+                    rows[y][column] = colour if rng.random() < .9 else self.make_colour(rng)
+            x = end
+        raw = bytearray()
+        for row in rows:
+            for r, g, b in row:
+                raw += bytes((b, g, r, 255))
+        return ScreenShot.from_size(raw, width, height)
+
+    def read(self, reader, img):
+        reader.reporting_problems = False
+        return (reader.find_sections(img), reader.find_bar(img, 0), reader.find_bar(img, 100),
+                reader.is_result_red(img), reader.is_result_green(img), reader.contains_at(img))
+
+    def test_readers_match_on_random_strips(self):
+        rng = random.Random(7)
+        reference = ATReader(self.BBOX)
+        readers = [TableATReader(self.BBOX)]
+        if VectorisedATReader.is_available():
+            vectorised = VectorisedATReader(self.BBOX)
+            vectorised.colour_table = self.table
+            readers.append(vectorised)
+        for _ in range(self.STRIPS):
+            img = self.make_strip(rng)
+            expected = self.read(reference, img)
+            for reader in readers:
+                self.assertEqual(self.read(reader, img), expected, type(reader).__name__)
+
+    def test_table_is_per_reader(self):
+        TableATReader(self.BBOX)
+        self.assertIsNone(ATReader(self.BBOX).colour_table)
+
+
+if __name__ == "__main__":
+    unittest.main()
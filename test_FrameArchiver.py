@@ -0,0 +1,165 @@
+import contextlib
+import io
+import os
+import random
+import tempfile
+import threading
+import unittest
+from mss.screenshot import ScreenShot
+from ATArchiving import FrameArchiveFormat, FrameArchiver, FrameArchiveReader, export_at
+from ATCapturing import FrameSource, ReplayFrameSource
+
+
+class ListFrameSource(FrameSource):
+    def __init__(self, frames):
+        self.frames = iter(frames)
+
+    def timestamped_grab(self, bbox):
+        return next(self.frames)
+
+    def grab(self, bbox):
+        return self.timestamped_grab(bbox)[1]
+
+
+class StalledFrameArchiver(FrameArchiver):
+    """Only writes once allowed to, like a disk that can't keep up."""
+
+    def __init__(self, *args, **kwargs):
+        self.may_write = threading.Event()
+        super().__init__(*args, **kwargs)
+
+    def write_block(self, frames):
+        self.may_write.wait()
+        super().write_block(frames)
+
+
+class FrameArchiverTest(unittest.TestCase):
+    """Every archived frame has to come back exactly, found through the index without
+    reading the rest of the archive – and a slow disk may only cost frames, not memory."""
+    WIDTH = 20
+    HEIGHT = 3
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.filepath = os.path.join(self.folder.name, "frames" + FrameArchiveFormat.EXTENSION)
+        self.random = random.Random(3)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def make_frames(self, count, width=WIDTH, height=HEIGHT):
+        """(timestamp, ScreenShot) pairs: mostly repeated, some changed a little, some all new."""
+        frames = []
+        raw = bytearray(self.random.randbytes(width * height * 4))
+        for index in range(count):
+            choice = self.random.random()
+            if choice < .1:
+                raw = bytearray(self.random.randbytes(len(raw)))
+            elif choice < .5:
+                raw = bytearray(raw)
+                raw[self.random.randrange(len(raw))] ^= 0xFF
+            frames.append((1_000_000 * index, ScreenShot.from_size(bytearray(raw), width, height)))
+        return frames
+
+    def archive(self, frames_per_at, archiver_class=FrameArchiver, block_frames=8, **kwargs):
+        all_frames = [frame for frames in frames_per_at for frame in frames]
+        archiver = archiver_class(ListFrameSource(all_frames), self.filepath, **kwargs)
+        archiver.BLOCK_FRAMES = block_frames
+        return archiver
+
+    @staticmethod
+    def run_archiver(archiver, frames_per_at):
+        for at_number, frames in enumerate(frames_per_at, 1):
+            archiver.start_at(at_number)
+            for _ in frames:
+                archiver.grab(None)
+
+    @staticmethod
+    def to_tuples(frames):
+        return [(timestamp, img.size.width, img.size.height, bytes(img.raw)) for timestamp, img in frames]
+
+    def test_block_round_trip(self):
+        small, wide = self.make_frames(40), self.make_frames(40, width=35)
+        frames = [(timestamp, index // 10, img.size.width, img.size.height, bytes(img.raw))
+                  for index, (timestamp, img) in enumerate(frame for pair in zip(small, wide) for frame in pair)]
+        block = FrameArchiveFormat.encode_block(frames)
+        self.assertLess(len(block), sum(len(frame[4]) for frame in frames) / 4)
+        decoded = FrameArchiveFormat.decode_block(b"padding" + block, len(b"padding"))
+        self.assertEqual([frame[:4] + (bytes(frame[4]),) for frame in decoded], frames)
+
+    def test_reading_ats_and_frames(self):
+        frames_per_at = [self.make_frames(count) for count in (3, 20, 1, 17, 8)]
+        archiver = self.archive(frames_per_at)
+        self.run_archiver(archiver, frames_per_at)
+        archiver.close()
+        reader = FrameArchiveReader(self.filepath)
+        try:
+            all_frames = [frame for frames in frames_per_at for frame in frames]
+            self.assertEqual(reader.get_frame_count(), len(all_frames))
+            self.assertEqual(reader.get_last_at_number(), len(frames_per_at))
+            for at_number, frames in enumerate(frames_per_at, 1):
+                self.assertEqual(self.to_tuples(reader.read_at(at_number)), self.to_tuples(frames))
+            self.assertEqual(reader.read_at(len(frames_per_at) + 1), [])
+            for frame_number, (timestamp, img) in enumerate(all_frames):
+                self.assertEqual(self.to_tuples([reader.read_frame(frame_number)[::2]]),
+                                 self.to_tuples([(timestamp, img)]))
+            with self.assertRaises(IndexError):
+                reader.read_frame(len(all_frames))
+        finally:
+            reader.close()
+
+    def test_block_search(self):
+        frames_per_at = [self.make_frames(count) for count in (5, 30, 2, 9)]
+        archiver = self.archive(frames_per_at, block_frames=4)
+        self.run_archiver(archiver, frames_per_at)
+        archiver.close()
+        reader = FrameArchiveReader(self.filepath)
+        try:
+            entries = [reader.get_entry(block) for block in range(reader.block_count)]
+            for at_number in range(len(frames_per_at) + 2):
+                expected = next((block for block, entry in enumerate(entries) if entry[4] >= at_number),
+                                len(entries))
+                self.assertEqual(reader.find_first_block(lambda entry: entry[4] >= at_number), expected)
+            for frame_number in range(reader.get_frame_count() + 1):
+                expected = next((block for block, entry in enumerate(entries) if entry[1] + entry[5] > frame_number),
+                                len(entries))
+                self.assertEqual(reader.find_first_block(lambda entry: entry[1] + entry[5] > frame_number), expected)
+        finally:
+            reader.close()
+
+    def test_export_at(self):
+        frames_per_at = [self.make_frames(count) for count in (4, 11)]
+        archiver = self.archive(frames_per_at)
+        self.run_archiver(archiver, frames_per_at)
+        archiver.close()
+        recording_filepath = os.path.join(self.folder.name, "AT2.frames")
+        self.assertEqual(export_at(self.filepath, 2, recording_filepath), 11)
+        with ReplayFrameSource(recording_filepath, realtime=False) as source:
+            replayed = [source.take_next_frame() for _ in range(11)]  # with the recorded timestamps
+        self.assertEqual(self.to_tuples(replayed), self.to_tuples(frames_per_at[1]))
+
+    def test_queue_quota(self):
+        frames_per_at = [self.make_frames(8) for _ in range(6)]  # a block per AT
+        block_bytes = 8 * self.WIDTH * self.HEIGHT * 4
+        archiver = self.archive(frames_per_at, StalledFrameArchiver, queue_quota=2 * block_bytes)
+        self.run_archiver(archiver, frames_per_at)
+        archiver.finish_block()
+        # the writer holds the first block and one more fits the quota, the other four get dropped
+        self.assertEqual(archiver.dropped_frames, 4 * 8)
+        self.assertLessEqual(archiver.queued_bytes, archiver.queue_quota)
+        archiver.may_write.set()
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            archiver.close()
+        self.assertIn("32 frames left out", output.getvalue())
+        self.assertEqual(archiver.queued_bytes, 0)
+        reader = FrameArchiveReader(self.filepath)
+        try:
+            self.assertEqual(reader.get_frame_count(), 2 * 8)
+            self.assertEqual(self.to_tuples(reader.read_at(2)), self.to_tuples(frames_per_at[1]))
+            self.assertEqual(reader.read_at(3), [])
+        finally:
+            reader.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,177 @@
+import pickle
+import threading
+import time
+import unittest
+from mss.screenshot import ScreenShot
+from ATCapturing import FrameSource, FramesExhausted
+from ATReading import ATReader
+from ATSharing import SharedCapture, SharedFrameSource, SharedMemoryCapture, crop_raw, group_bboxes
+
+
+class GatedFrameSource(FrameSource):
+    """Only grabs when allowed to, so the test decides how many frame sets get captured.
+    Every pixel of frame set n has all its bytes n (or values[n] if given), its timestamp is n."""
+
+    def __init__(self, region_count, values=None):
+        self.region_count = region_count
+        self.values = values
+        self.permits = threading.Semaphore(0)
+        self.grabs = 0
+        self.closed = False
+
+    def allow(self, frame_sets):
+        for _ in range(frame_sets * self.region_count):
+            self.permits.release()
+
+    def timestamped_grab(self, bbox):
+        self.permits.acquire()
+        if self.closed:
+            raise FramesExhausted()
+        frame_set = self.grabs // self.region_count
+        self.grabs += 1
+        value = self.values[frame_set] if self.values is not None else frame_set % 256
+        width, height = bbox[2] - bbox[0], bbox[3] - bbox[1]
+        return frame_set, ScreenShot.from_size(bytearray([value]) * (width * height * 4), width, height)
+
+    def grab(self, bbox):
+        return self.timestamped_grab(bbox)[1]
+
+    def close(self):
+        self.closed = True
+        self.permits.release()  # out of waiting for one
+
+
+class SharedCaptureTest(unittest.TestCase):
+    """Every AT reads every shared frame set in order, each at its own pace – the ones pushed
+    out of the ring before being read count as dropped, and nothing gets lost without being counted."""
+    BBOXES = [ATReader.construct_bbox(0, 249, 2), ATReader.construct_bbox(300, 549, 2),
+              ATReader.construct_bbox(0, 249, 500)]  # the first two side by side, the third far below
+    RING_SIZE = 4
+    TIMEOUT = 5.
+
+    capture_class = SharedCapture
+
+    def setUp(self):
+        self.source = GatedFrameSource(len(group_bboxes(self.BBOXES)))
+        self.capture = self.capture_class(self.source, self.BBOXES, self.RING_SIZE)
+
+    def tearDown(self):
+        self.source.close()
+        self.capture.close()
+
+    def make_frame_source(self, bbox):
+        return SharedFrameSource(self.capture, bbox)
+
+    def capture_frame_sets(self, count):
+        target = self.capture.sequence + count
+        self.source.allow(count)
+        deadline = time.perf_counter() + self.TIMEOUT
+        while self.capture.sequence < target:
+            self.assertLess(time.perf_counter(), deadline)
+            time.sleep(.001)
+
+    def assert_frame(self, frame_source, bbox, frame_set):
+        timestamp, img = frame_source.timestamped_grab(bbox)
+        self.assertEqual(timestamp, frame_set)
+        self.assertEqual((img.size.width, img.size.height), (bbox[2] - bbox[0], bbox[3] - bbox[1]))
+        self.assertEqual(bytes(img.raw), bytes([frame_set % 256]) * len(img.raw))
+
+    def test_regions(self):
+        self.assertEqual(self.capture.regions, [(0, 0, 550, 3), (0, 498, 250, 501)])
+
+    def test_crop(self):
+        region = (10, 20, 14, 23)
+        raw = bytes(range(4 * 3 * 4))
+        self.assertEqual(bytes(crop_raw(raw, region, (10, 21, 14, 23))), raw[16:])  # whole rows
+        self.assertEqual(bytes(crop_raw(raw, region, (12, 21, 13, 22))), raw[24:28])
+
+    def test_every_frame_in_order(self):
+        frame_sources = [self.make_frame_source(bbox) for bbox in self.BBOXES]
+        self.capture_frame_sets(3)
+        for frame_set in range(3):
+            for frame_source, bbox in zip(frame_sources, self.BBOXES):
+                self.assert_frame(frame_source, bbox, frame_set)
+        for frame_source in frame_sources:
+            statistics = frame_source.take_statistics()
+            self.assertEqual((statistics["captured"], statistics["dropped"]), (3, 0))
+
+    def test_dropped_frames(self):
+        frame_source = self.make_frame_source(self.BBOXES[0])
+        self.capture_frame_sets(10)
+        oldest = self.get_oldest_readable(10)
+        self.assert_frame(frame_source, self.BBOXES[0], oldest)
+        statistics = frame_source.take_statistics()
+        self.assertEqual(statistics["captured"], 10)
+        self.assertEqual(statistics["dropped"], oldest)
+        self.assertEqual(statistics["max_occupancy"], 10 - oldest)  # counting the one being read
+        self.capture_frame_sets(1)
+        for frame_set in range(oldest + 1, 11):
+            self.assert_frame(frame_source, self.BBOXES[0], frame_set)
+        statistics = frame_source.take_statistics()  # only since the last time
+        self.assertEqual((statistics["captured"], statistics["dropped"]), (1, 0))
+
+    def get_oldest_readable(self, frame_sets):
+        return frame_sets - self.RING_SIZE
+
+    def test_duplicates(self):
+        self.source.values = [7, 7, 8, 8, 8]
+        frame_source = self.make_frame_source(self.BBOXES[2])
+        self.capture_frame_sets(2)
+        for _ in range(2):
+            frame_source.grab(self.BBOXES[2])
+        self.capture_frame_sets(3)
+        for _ in range(3):
+            frame_source.grab(self.BBOXES[2])
+        self.assertEqual(frame_source.take_statistics()["duplicates"], 3)
+
+    def test_sleeping_skips_what_got_captured_meanwhile(self):
+        frame_source = self.make_frame_source(self.BBOXES[1])
+        self.capture_frame_sets(2)
+        frame_source.sleep(0.)
+        self.capture_frame_sets(1)
+        self.assert_frame(frame_source, self.BBOXES[1], 2)
+        self.assertEqual(frame_source.take_statistics()["dropped"], 0)
+
+    def test_stopping(self):
+        frame_source = self.make_frame_source(self.BBOXES[0])
+        self.capture_frame_sets(2)
+        self.source.close()
+        self.capture.stop_capturing()
+        for frame_set in range(2):  # what's left still gets read
+            self.assert_frame(frame_source, self.BBOXES[0], frame_set)
+        with self.assertRaises(FramesExhausted):
+            frame_source.grab(self.BBOXES[0])
+
+
+class SharedMemoryCaptureTest(SharedCaptureTest):
+    """The same through shared memory, as read by the ATs in their own processes."""
+    capture_class = SharedMemoryCapture
+
+    def setUp(self):
+        super().setUp()
+        self.frame_sources = []
+
+    def tearDown(self):
+        for frame_source in self.frame_sources:
+            frame_source.close()
+        super().tearDown()
+
+    def make_frame_source(self, bbox):
+        frame_source = pickle.loads(pickle.dumps(self.capture.make_frame_source(bbox)))  # like to a process
+        frame_source.skip_old_frames()  # attached when the process starts
+        self.frame_sources.append(frame_source)
+        return frame_source
+
+    def get_oldest_readable(self, frame_sets):
+        return frame_sets - self.RING_SIZE + 1  # the oldest slot could be being written
+
+    def test_attaching_after_closing(self):
+        frame_source = self.capture.make_frame_source(self.BBOXES[0])
+        self.source.close()
+        self.capture.close()
+        with self.assertRaises(FramesExhausted):
+            frame_source.grab(self.BBOXES[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
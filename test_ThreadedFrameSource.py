@@ -0,0 +1,78 @@
+import contextlib
+import io
+import os
+import tempfile
+import threading
+import time
+import unittest
+from ATCapturing import SyntheticFrameSource, ThreadedFrameSource
+from ATReading import ATReader, RawATReader
+
+
+class ThreadedFrameSourceTest(unittest.TestCase):
+    """The capture thread and the reader wait on each other – neither may be left waiting."""
+    BBOX = ATReader.construct_bbox(0, 249, 2)
+    OTHER_BBOX = ATReader.construct_bbox(0, 249, 5)
+    TIMEOUT = 5.
+
+    def setUp(self):
+        self.synthetic = SyntheticFrameSource(120, [100, 140], press_position=121, gap_time=.05,
+                                              at_bbox=self.BBOX)
+        self.source = ThreadedFrameSource(self.synthetic, self.BBOX)
+        self.folder = tempfile.TemporaryDirectory()  # for lastResult.png and problem PNGs
+        self.old_cwd = os.getcwd()
+        os.chdir(self.folder.name)
+
+    def tearDown(self):
+        self.source.close()
+        os.chdir(self.old_cwd)
+        self.folder.cleanup()
+
+    def run_with_timeout(self, function):
+        results = []
+        thread = threading.Thread(target=lambda: results.append(function()), daemon=True)
+        thread.start()
+        thread.join(self.TIMEOUT)
+        self.assertFalse(thread.is_alive(), "deadlocked")
+        return results[0]
+
+    def wait_for_woken_frame(self):
+        self.source.sleep(0.)
+        deadline = time.perf_counter() + self.TIMEOUT
+        while not self.source.ring:  # the capture thread now waits for it to be read
+            self.assertLess(time.perf_counter(), deadline)
+            time.sleep(.001)
+
+    def test_bbox_change_while_waking(self):
+        self.wait_for_woken_frame()
+        self.source.change_bbox(self.OTHER_BBOX)
+        img = self.run_with_timeout(lambda: self.source.grab(self.OTHER_BBOX))
+        self.assertEqual(img.size.height, 3)
+
+    def test_sleeping_again_while_waking(self):
+        self.wait_for_woken_frame()
+        self.source.sleep(0.)
+        self.run_with_timeout(lambda: self.source.grab(self.BBOX))
+
+    def test_wakes_up_to_a_fresh_frame(self):
+        self.source.grab(self.BBOX)
+        wake_up_time = time.perf_counter_ns() + 20_000_000
+        self.source.sleep(.02)
+        timestamp, img = self.run_with_timeout(lambda: self.source.timestamped_grab(self.BBOX))
+        self.assertGreaterEqual(timestamp, wake_up_time)
+
+    def test_frames_come_in_order(self):
+        timestamps = [self.run_with_timeout(lambda: self.source.timestamped_grab(self.BBOX))[0]
+                      for _ in range(200)]
+        self.assertEqual(timestamps, sorted(timestamps))
+
+    def test_reading_with_regions(self):
+        # the region grabs bypass the ring, while sleeping and bbox changes go through it
+        reader = RawATReader(self.BBOX, frame_source=self.source, use_regions=True)
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = self.run_with_timeout(lambda: [reader.read_at().result for _ in range(3)])
+        self.assertEqual(len(results), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()